@@ -0,0 +1,54 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Throughput of bulk_import_users() against a loop of create_user() calls.
+
+    python bench/bench_bulk_import.py [num_users] [batch_size]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import tempfile
+
+from wimms.sql import SQLMetadata
+
+
+def _make_backend():
+    fd, filename = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    backend = SQLMetadata('sqlite:///' + filename, create_tables=True)
+    backend.add_service('sync-1.5', '{node}/1.5/{uid}')
+    for i in range(10):
+        backend.add_node('sync-1.5', 'https://node%d' % i, 10000000)
+    return backend, filename
+
+
+def main(num_users=20000, batch_size=1000):
+    backend, filename = _make_backend()
+    try:
+        count = min(num_users, 2000)
+        start = time.time()
+        for i in range(count):
+            backend.create_user('sync-1.5', 'user%d@example.com' % i)
+        elapsed = time.time() - start
+        print('create_user:       %8.0f users/sec' % (count / elapsed))
+    finally:
+        os.remove(filename)
+
+    backend, filename = _make_backend()
+    try:
+        records = ({'email': 'user%d@example.com' % i}
+                   for i in range(num_users))
+        start = time.time()
+        backend.bulk_import_users('sync-1.5', records, batch_size)
+        elapsed = time.time() - start
+        print('bulk_import_users: %8.0f users/sec' % (num_users / elapsed))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,87 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Cost per request of generating a user's endpoint URL.
+
+    python bench/bench_endpoints.py [num_requests] [sqluri]
+
+Compares fetching the patterns with get_patterns() and formatting them with
+str.format() for each request, formatting a pattern fetched beforehand,
+get_endpoint(), and get_endpoints() for all the users at once.  By default
+this uses a temporary sqlite database.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import tempfile
+
+from wimms.sql import SQLMetadata
+
+
+PATTERN = '{node}/1.5/{uid}'
+
+
+def run(func, users):
+    start = time.time()
+    func(users)
+    return (time.time() - start) * 1000000 / len(users)
+
+
+def main(num_requests=100000, sqluri=None):
+    filename = None
+    if sqluri is None:
+        fd, filename = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        sqluri = 'sqlite:///' + filename
+    try:
+        backend = SQLMetadata(sqluri, create_tables=True)
+        backend.add_service('sync-1.5', PATTERN)
+        users = [{'node': 'https://node%d' % (i % 10), 'uid': i}
+                 for i in range(num_requests)]
+
+        def get_patterns(users):
+            # Only a sample of the requests, it's rather slow.
+            for user in users[:len(users) // 100]:
+                for row in backend.get_patterns():
+                    if row.service == 'sync-1.5':
+                        row.pattern.format(service='sync-1.5',
+                                           node=user['node'],
+                                           uid=user['uid'])
+            return len(users) // 100
+
+        # As read back from the database, which may return unicode.
+        pattern = backend.get_patterns()[0].pattern
+
+        def str_format(users):
+            return [pattern.format(service='sync-1.5', node=user['node'],
+                                   uid=user['uid']) for user in users]
+
+        def get_endpoint(users):
+            for user in users:
+                backend.get_endpoint('sync-1.5', user)
+
+        def get_endpoints(users):
+            backend.get_endpoints('sync-1.5', users)
+
+        results = [
+            ('get_patterns + str.format',
+             run(get_patterns, users) * 100),
+            ('str.format', run(str_format, users)),
+            ('get_endpoint', run(get_endpoint, users)),
+            ('get_endpoints', run(get_endpoints, users)),
+        ]
+    finally:
+        if filename is not None:
+            os.remove(filename)
+
+    print('%d requests' % num_requests)
+    for label, usecs in results:
+        print('  %-28s %10.2f us/request' % (label + ':', usecs))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*[int(arg) for arg in args[:1]] + args[1:])
@@ -0,0 +1,69 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Micro-benchmark of the CPU time spent in SQLMetadata.get_user().
+
+The database is replaced by a canned result set, so this measures only the
+python-side work of fetching, sorting and packaging the user record.
+
+    python bench/bench_get_user.py [num_rows] [iterations]
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+from wimms.sql import SQLMetadata, pack_client_states
+
+
+class _FakeCursor(object):
+
+    def __init__(self, rows):
+        self._rows = rows
+
+    def fetchall(self):
+        return list(self._rows)
+
+
+class _FakeResult(object):
+
+    def __init__(self, rows):
+        self.cursor = _FakeCursor(rows)
+
+    def close(self):
+        pass
+
+
+class _MockedMetadata(SQLMetadata):
+    """SQLMetadata whose queries all return the same canned rows."""
+
+    def __init__(self, rows):
+        super(_MockedMetadata, self).__init__('sqlite://')
+        self._rows = rows
+
+    def _safe_execute(self, *args, **kwds):
+        return _FakeResult(self._rows)
+
+
+def main(num_rows=20, iterations=100000):
+    now = int(time.time() * 1000)
+    # (uid, node, generation, client_state, created_at, replaced_at,
+    #  client_state_history)
+    rows = [(1000 + i, 'https://phx12', 10, '%032x' % i, now - i, now, None)
+            for i in range(num_rows)]
+    # The current record carries the previous client states, as written by
+    # this version; the older ones predate the history column.
+    history = pack_client_states(row[3] for row in rows[1:])
+    rows[0] = rows[0][:5] + (None, history)
+    backend = _MockedMetadata(rows)
+    start = time.time()
+    for _ in range(iterations):
+        backend.get_user('sync-1.5', 'test@mozilla.com')
+    elapsed = time.time() - start
+    print('%d rows: %.2f us per get_user call'
+          % (num_rows, elapsed / iterations * 1000000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
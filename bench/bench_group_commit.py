@@ -0,0 +1,69 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Concurrent create_user() throughput with and without group commit.
+
+Reports calls/sec, commits/sec and mean per-call latency at 1, 16 and 64
+threads.  Uses sqlite unless WIMMS_SQLURI is set.
+
+    python bench/bench_group_commit.py [calls_per_thread] [delay_seconds]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import tempfile
+import threading
+
+from wimms.sql import SQLMetadata
+
+
+def _run(num_threads, calls_per_thread, delay):
+    fd, filename = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    sqluri = os.environ.get('WIMMS_SQLURI', 'sqlite:///' + filename)
+    backend = SQLMetadata(sqluri, create_tables=True,
+                          group_commit_delay=delay)
+    backend.add_service('sync-1.5', '{node}/1.5/{uid}')
+    for i in range(4):
+        backend.add_node('sync-1.5', 'https://node%d' % i, 10000000)
+    latencies = []
+
+    def worker(n):
+        for i in range(calls_per_thread):
+            start = time.time()
+            backend.create_user('sync-1.5', 'user%d-%d@example.com' % (n, i))
+            latencies.append(time.time() - start)
+
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in range(num_threads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    calls = num_threads * calls_per_thread
+    if delay:
+        commits = backend.get_group_commit_stats()['batches']
+    else:
+        # an autocommitted INSERT plus the node counter UPDATE.
+        commits = calls * 2
+    print('%2d threads, delay %.3fs: %7.0f calls/s %7.0f commits/s '
+          '%6.2f ms/call' % (num_threads, delay, calls / elapsed,
+                             commits / elapsed,
+                             sum(latencies) / len(latencies) * 1000))
+    os.remove(filename)
+
+
+def main(calls_per_thread=20, delay=0.005):
+    for num_threads in (1, 16, 64):
+        _run(num_threads, calls_per_thread, 0)
+        _run(num_threads, calls_per_thread, delay)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 0.005)
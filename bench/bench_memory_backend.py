@@ -0,0 +1,61 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Throughput of the in-memory backend compared with sqlite.
+
+    python bench/bench_memory_backend.py [num_users] [num_lookups]
+
+Creates num_users users and then does num_lookups get_user() calls, with
+a client-state change for one call in ten, on each backend.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import tempfile
+
+from wimms.sql import SQLMetadata
+from wimms.memory import MemoryMetadata
+
+
+def run(backend, num_users, num_lookups):
+    backend.add_service('sync-1.5', '{node}/1.5/{uid}')
+    for i in range(10):
+        backend.add_node('sync-1.5', 'https://node%d' % i, 10000000)
+
+    start = time.time()
+    for i in range(num_users):
+        backend.create_user('sync-1.5', 'user%d@example.com' % i)
+    creates = num_users / (time.time() - start)
+
+    start = time.time()
+    for i in range(num_lookups):
+        email = 'user%d@example.com' % (i % num_users)
+        if i % 10:
+            backend.get_user('sync-1.5', email)
+        else:
+            backend.get_user('sync-1.5', email, client_state='%032x' % i)
+    lookups = num_lookups / (time.time() - start)
+    return creates, lookups
+
+
+def main(num_users=1000, num_lookups=10000):
+    fd, filename = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        sqlite = SQLMetadata('sqlite:///' + filename, create_tables=True)
+        sqlite_results = run(sqlite, num_users, num_lookups)
+    finally:
+        os.remove(filename)
+    memory_results = run(MemoryMetadata(), num_users, num_lookups)
+
+    print('%d users, %d lookups' % (num_users, num_lookups))
+    print('             %12s %12s' % ('creates/s', 'lookups/s'))
+    print('  sqlite:    %12.0f %12.0f' % sqlite_results)
+    print('  memory:    %12.0f %12.0f' % memory_results)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,79 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Overhead of checking out a connection for every statement of a request,
+compared with pinning one for the whole request with session().
+
+    python bench/bench_session.py [num_requests] [sqluri]
+
+Each simulated token request looks up a user and creates them if they're
+new.  By default this uses a temporary sqlite database, which opens a new
+connection for each checkout; pass a MySQL sqluri to measure the cost of
+pool checkouts and reset-on-return rollbacks instead.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import tempfile
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from wimms.sql import SQLMetadata
+
+
+@contextmanager
+def no_session():
+    yield
+
+
+def run(backend, prefix, num_requests, session):
+    checkouts = []
+
+    def count_checkout(*args):
+        checkouts.append(1)
+
+    event.listen(backend._engine, 'checkout', count_checkout)
+    start = time.time()
+    for i in range(num_requests):
+        email = '%s%d@example.com' % (prefix, i % (num_requests // 2))
+        with session():
+            user = backend.get_user('sync-1.5', email, generation=1)
+            if user is None:
+                backend.create_user('sync-1.5', email, generation=1)
+    elapsed = time.time() - start
+    return num_requests / elapsed, len(checkouts) / float(num_requests)
+
+
+def main(num_requests=2000, sqluri=None):
+    filename = None
+    if sqluri is None:
+        fd, filename = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        sqluri = 'sqlite:///' + filename
+    try:
+        backend = SQLMetadata(sqluri, create_tables=True)
+        backend.add_service('sync-1.5', '{node}/1.5/{uid}')
+        backend.add_node('sync-1.5', 'https://node', 10000000)
+        results = [
+            ('no session', run(backend, 'a', num_requests, no_session)),
+            ('session', run(backend, 'b', num_requests, backend.session)),
+            ('transaction', run(backend, 'c', num_requests,
+                                lambda: backend.session(transaction=True))),
+        ]
+    finally:
+        if filename is not None:
+            os.remove(filename)
+
+    print('%d requests' % num_requests)
+    print('  %-14s %12s %12s' % ('', 'requests/s', 'checkouts'))
+    for label, (rate, checkouts) in results:
+        print('  %-14s %12.0f %12.1f' % (label + ':', rate, checkouts))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*[int(arg) for arg in args[:1]] + args[1:])
@@ -0,0 +1,61 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Startup time of ShardedSQLMetadata with many shards.
+
+    python bench/bench_sharded_startup.py [num_shards] [num_rounds]
+
+Each shard gets its own sqlite database.  This reports the time to construct
+the backend with and without create_tables, and the time taken by the first
+call to one shard.
+"""
+from __future__ import print_function
+
+import sys
+import time
+import shutil
+import tempfile
+
+from wimms.shardedsql import ShardedSQLMetadata
+
+
+def main(num_shards=50, num_rounds=20):
+    tempdir = tempfile.mkdtemp()
+    try:
+        databases = ','.join(
+            'service%d-1.0;sqlite:///%s/shard%d.db' % (i, tempdir, i)
+            for i in range(num_shards))
+
+        start = time.time()
+        ShardedSQLMetadata(databases, create_tables=True)
+        create = time.time() - start
+
+        start = time.time()
+        for _ in range(num_rounds):
+            ShardedSQLMetadata(databases, create_tables=True)
+        check = (time.time() - start) / num_rounds
+
+        start = time.time()
+        for _ in range(num_rounds):
+            ShardedSQLMetadata(databases)
+        lazy = (time.time() - start) / num_rounds
+
+        start = time.time()
+        for _ in range(num_rounds):
+            backend = ShardedSQLMetadata(databases)
+            backend.get_patterns()
+        all_shards = (time.time() - start) / num_rounds - lazy
+    finally:
+        shutil.rmtree(tempdir)
+
+    print('%d shards' % num_shards)
+    for label, elapsed in (('creating tables', create),
+                           ('checking tables', check),
+                           ('lazy startup', lazy),
+                           ('first query, all shards', all_shards)):
+        print('  %-24s %8.1f ms' % (label + ':', elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
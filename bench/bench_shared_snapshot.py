@@ -0,0 +1,84 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Node allocations per second from many worker processes, with and without
+the shared snapshot of the services and nodes tables.
+
+    python bench/bench_shared_snapshot.py [num_workers] [num_allocations]
+                                          [sqluri]
+
+num_allocations is per worker.  By default this uses a temporary sqlite
+database, where the writes done by each allocation are serialized anyway;
+pass a MySQL sqluri to see the difference under realistic concurrency.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import tempfile
+import multiprocessing
+
+from wimms.sql import SQLMetadata
+
+
+def worker(sqluri, snapshot_file, num_allocations, start_event):
+    kwds = {}
+    if snapshot_file is not None:
+        kwds['snapshot_file'] = snapshot_file
+    backend = SQLMetadata(sqluri, **kwds)
+    start_event.wait()
+    for _ in range(num_allocations):
+        backend.get_best_node('sync-1.5')
+
+
+def run(sqluri, snapshot_file, num_workers, num_allocations):
+    start_event = multiprocessing.Event()
+    workers = [multiprocessing.Process(target=worker,
+                                       args=(sqluri, snapshot_file,
+                                             num_allocations, start_event))
+               for _ in range(num_workers)]
+    for process in workers:
+        process.start()
+    # Give the workers time to set up their backends.
+    time.sleep(1)
+    start = time.time()
+    start_event.set()
+    for process in workers:
+        process.join()
+    return num_workers * num_allocations / (time.time() - start)
+
+
+def main(num_workers=32, num_allocations=200, sqluri=None):
+    filename = snapshot_file = None
+    if sqluri is None:
+        fd, filename = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        sqluri = 'sqlite:///' + filename
+    fd, snapshot_file = tempfile.mkstemp(suffix='.snapshot')
+    os.close(fd)
+    try:
+        backend = SQLMetadata(sqluri, create_tables=True,
+                              snapshot_file=snapshot_file)
+        backend.add_service('sync-1.5', '{node}/1.5/{uid}')
+        for i in range(20):
+            backend.add_node('sync-1.5', 'https://node%d' % i, 10000000)
+
+        plain = run(sqluri, None, num_workers, num_allocations)
+        backend._snapshot.acquire_writer()
+        backend.refresh_snapshot()
+        shared = run(sqluri, snapshot_file, num_workers, num_allocations)
+    finally:
+        os.remove(snapshot_file)
+        if filename is not None:
+            os.remove(filename)
+
+    print('%d workers, %d allocations each' % (num_workers, num_allocations))
+    print('  without snapshot: %8.0f allocations/s' % plain)
+    print('  with snapshot:    %8.0f allocations/s' % shared)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*[int(arg) for arg in args[:2]] + args[2:])
@@ -0,0 +1,79 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Round trips and latency of the token-request path.
+
+Compares a get_user() followed, when the generation number has moved
+forward, by update_user(), with the combined get_user(generation=...)
+call.  Both take the same number of round trips, one when the generation
+number is unchanged and two when it has moved forward; the combined call
+only saves the caller from checking the record itself.
+
+    python bench/bench_token_request.py [iterations]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import tempfile
+
+from wimms.sql import SQLMetadata
+
+
+class _CountingMetadata(SQLMetadata):
+
+    round_trips = 0
+
+    def _safe_execute(self, *args, **kwds):
+        self.round_trips += 1
+        return super(_CountingMetadata, self)._safe_execute(*args, **kwds)
+
+
+def _separate_calls(backend, email, generation):
+    user = backend.get_user('sync-1.5', email)
+    if generation > user['generation']:
+        backend.update_user('sync-1.5', user, generation=generation)
+
+
+def _combined_call(backend, email, generation):
+    backend.get_user('sync-1.5', email, generation=generation)
+
+
+def _run(backend, label, request, iterations, bump):
+    email = 'user@example.com'
+    generation = backend.get_user('sync-1.5', email)['generation']
+    backend.round_trips = 0
+    start = time.time()
+    for _ in range(iterations):
+        if bump:
+            generation += 1
+        request(backend, email, generation)
+    elapsed = time.time() - start
+    print('%-42s %4.1f round trips, %7.1f us per request'
+          % (label, float(backend.round_trips) / iterations,
+             elapsed / iterations * 1000000))
+
+
+def main(iterations=1000):
+    fd, filename = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        backend = _CountingMetadata('sqlite:///' + filename,
+                                    create_tables=True)
+        backend.add_service('sync-1.5', '{node}/1.5/{uid}')
+        backend.add_node('sync-1.5', 'https://node', 10000000)
+        backend.create_user('sync-1.5', 'user@example.com')
+        for bump in (False, True):
+            suffix = ' (new generation)' if bump else ''
+            _run(backend, 'get_user + update_user' + suffix,
+                 _separate_calls, iterations, bump)
+            _run(backend, 'get_user(generation=...)' + suffix,
+                 _combined_call, iterations, bump)
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,58 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Cost of get_user() for unknown users, with and without the user filter.
+
+    python bench/bench_user_filter.py [num_users] [num_lookups]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import tempfile
+
+from wimms.sql import SQLMetadata
+
+
+def main(num_users=100000, num_lookups=5000):
+    fd, filename = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        backend = SQLMetadata('sqlite:///' + filename, create_tables=True,
+                              user_filter_capacity=num_users * 2)
+        backend.add_service('sync-1.5', '{node}/1.5/{uid}')
+        backend.add_node('sync-1.5', 'https://node', 10000000)
+        records = ({'email': 'user%d@example.com' % i}
+                   for i in range(num_users))
+        backend.bulk_import_users('sync-1.5', records, 10000)
+
+        start = time.time()
+        for i in range(num_lookups):
+            backend.get_user('sync-1.5', 'unknown%d@example.com' % i)
+        plain = (time.time() - start) / num_lookups
+
+        start = time.time()
+        backend.rebuild_user_filter()
+        rebuild = time.time() - start
+
+        start = time.time()
+        for i in range(num_lookups):
+            backend.get_user('sync-1.5', 'unknown%d@example.com' % i)
+        filtered = (time.time() - start) / num_lookups
+
+        stats = backend.get_user_filter_stats()
+        print('plain lookup:    %8.1f us' % (plain * 1000000))
+        print('filtered lookup: %8.1f us' % (filtered * 1000000))
+        print('rebuild time:    %8.2f s for %d users' % (rebuild, num_users))
+        print('memory:          %8d bytes' % stats['memory_bytes'])
+        print('false positives: %8.4f expected, %.4f observed'
+              % (stats['expected_false_positive_rate'],
+                 stats['observed_false_positive_rate']))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
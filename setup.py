@@ -39,5 +39,6 @@ setup(name='wimms',
       include_package_data=True,
       zip_safe=False,
       install_requires=requires,
+      extras_require={'analytics': ['numpy']},
       tests_require=requires,
       test_suite="wimms")
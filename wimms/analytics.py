@@ -0,0 +1,249 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Capacity and churn analytics over the users and nodes tables.
+
+The user records of a service are streamed out with iter_service_users()
+and converted into NumPy arrays one chunk at a time, so the aggregates can
+be computed with vectorized operations in constant memory however many
+records there are.  Point it at a replica or a sqlite copy of the database
+rather than the primary:
+
+    python -m wimms.analytics sqluri service [--new-users N]
+                              [--capacity node=capacity ...]
+
+This needs NumPy, which is installed with the "analytics" extra.
+"""
+from __future__ import print_function
+
+import sys
+import time
+import argparse
+import itertools
+from collections import defaultdict, namedtuple
+
+import numpy
+from mozsvc.exceptions import BackendError
+
+from wimms.sql import SQLMetadata, _NodeAllocator
+
+
+DAY = 24 * 60 * 60 * 1000  # in milliseconds, like the record timestamps
+
+# Column positions in the rows produced by iter_service_users().
+(_NODE, _CREATED_AT, _REPLACED_AT, _HISTORY) = (2, 5, 6, 7)
+
+NodeAllocation = namedtuple('NodeAllocation', ['node', 'capacity',
+                                               'current_load', 'assigned'])
+
+
+def iter_user_chunks(backend, service, chunk_size=100000):
+    """Stream the user records of a service as chunks of column arrays.
+
+    Each chunk is a dict holding, for up to chunk_size records:
+
+    - 'node': the node names, as an object array.
+    - 'created_at', 'replaced_at': float arrays of timestamps, with NaN
+      for records that haven't been replaced.
+    - 'client_state_changes': the number of previous client-state values
+      kept in each record's history.
+    """
+    rows = backend.iter_service_users(service, include_replaced=True,
+                                      batch_size=chunk_size)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        columns = zip(*chunk)
+        del chunk
+        history = numpy.array(columns[_HISTORY], dtype=object)
+        history[numpy.equal(history, None)] = u''
+        yield {
+            'node': numpy.array(columns[_NODE], dtype=object),
+            'created_at': numpy.array(columns[_CREATED_AT], dtype=float),
+            'replaced_at': numpy.array(columns[_REPLACED_AT], dtype=float),
+            'client_state_changes': numpy.char.count(
+                history.astype(unicode), u','),
+        }
+
+
+def _add_counts(counts, values):
+    """Add the number of occurrences of each of the values to counts."""
+    if len(values):
+        keys, key_counts = numpy.unique(values, return_counts=True)
+        for key, count in zip(keys.tolist(), key_counts.tolist()):
+            counts[key] += count
+
+
+class UsageStats(object):
+    """Aggregates of the user records of a service, built chunk by chunk."""
+
+    def __init__(self, service):
+        self.service = service
+        self.records = 0
+        self.active = 0
+        self.active_per_node = defaultdict(int)
+        self.created_per_day = defaultdict(int)
+        self.replaced_per_day = defaultdict(int)
+        self.client_state_changes = numpy.zeros(1, dtype=numpy.int64)
+
+    @property
+    def replaced(self):
+        return self.records - self.active
+
+    def add(self, chunk):
+        replaced_at = chunk['replaced_at']
+        active = numpy.isnan(replaced_at)
+        self.records += len(replaced_at)
+        self.active += int(active.sum())
+        _add_counts(self.active_per_node, chunk['node'][active])
+        _add_counts(self.created_per_day,
+                    numpy.floor_divide(chunk['created_at'], DAY).astype(int))
+        _add_counts(self.replaced_per_day,
+                    numpy.floor_divide(replaced_at[~active], DAY).astype(int))
+        # Only the active records carry the user's complete history.
+        changes = numpy.bincount(chunk['client_state_changes'][active])
+        if len(changes) > len(self.client_state_changes):
+            changes[:len(self.client_state_changes)] += \
+                self.client_state_changes
+            self.client_state_changes = changes
+        else:
+            self.client_state_changes[:len(changes)] += changes
+
+    def churn_per_day(self):
+        """Get (day, replaced, rate) for each day, oldest first.
+
+        The rate is the fraction of the currently active users whose
+        records were replaced that day.
+        """
+        return [(day, count, count * 1.0 / max(self.active, 1))
+                for day, count in sorted(self.replaced_per_day.items())]
+
+
+def collect_stats(backend, service, chunk_size=100000):
+    """Compute the UsageStats of a service in a single pass over its users."""
+    stats = UsageStats(service)
+    for chunk in iter_user_chunks(backend, service, chunk_size):
+        stats.add(chunk)
+    return stats
+
+
+def simulate_allocation(nodes, new_users, capacities=None):
+    """Simulate get_best_node() assigning new_users users to the nodes.
+
+    'nodes' are (node, available, capacity, current_load) rows for the
+    nodes that aren't downed, as returned by get_node_loads(), and
+    'capacities' optionally maps node names to proposed new capacities.
+    Returns a list of NodeAllocation tuples, and the number of users who
+    couldn't be assigned a node at all.
+
+    This uses the same allocator as the batch operations of the backends.
+    It orders the nodes by current_load / capacity as get_best_node() does
+    on sqlite; on MySQL, get_best_node() orders them by the ratio of the
+    logarithms instead, so its choices may differ somewhat.
+    """
+    capacities = capacities or {}
+    rows = []
+    for name, available, capacity, current_load in nodes:
+        name = str(name)
+        new_capacity = capacities.get(name, capacity)
+        # A change of capacity adds or removes as many slots.
+        available += new_capacity - capacity
+        rows.append((name, available, new_capacity, current_load))
+    allocator = _NodeAllocator(rows)
+    assigned = dict((row[0], 0) for row in rows)
+    placed = 0
+    try:
+        while placed < new_users:
+            assigned[allocator.allocate()] += 1
+            placed += 1
+    except BackendError:
+        pass
+    allocations = [NodeAllocation(node, capacity, current_load,
+                                  assigned[node])
+                   for node, _, capacity, current_load in rows]
+    return allocations, new_users - placed
+
+
+def _format_day(day):
+    return time.strftime('%Y-%m-%d', time.gmtime(day * DAY / 1000))
+
+
+def format_report(stats, allocations=None, unplaced=0):
+    """Format the stats, and optionally a simulation, as a text report."""
+    lines = ['Service %s: %d records, %d active, %d replaced'
+             % (stats.service, stats.records, stats.active, stats.replaced)]
+
+    lines += ['', 'Active users per node:']
+    for node, count in sorted(stats.active_per_node.items()):
+        lines.append('  %-40s %10d' % (node, count))
+
+    lines += ['', 'Previous client states per active user:']
+    for changes, count in enumerate(stats.client_state_changes.tolist()):
+        if count:
+            lines.append('  %-10d %10d %7.2f%%'
+                         % (changes, count, count * 100.0 / stats.active))
+
+    lines += ['', 'Records created and replaced per day:',
+              '  %-10s %10s %10s %8s' % ('day', 'created', 'replaced',
+                                         'churn')]
+    churn = dict((day, (count, rate))
+                 for day, count, rate in stats.churn_per_day())
+    for day in sorted(set(stats.created_per_day) | set(churn)):
+        replaced, rate = churn.get(day, (0, 0.0))
+        lines.append('  %-10s %10d %10d %7.2f%%'
+                     % (_format_day(day), stats.created_per_day.get(day, 0),
+                        replaced, rate * 100))
+
+    if allocations is not None:
+        new_users = sum(a.assigned for a in allocations) + unplaced
+        lines += ['', 'Simulated allocation of %d new users:' % new_users,
+                  '  %-40s %10s %10s %10s %7s'
+                  % ('node', 'capacity', 'load', 'assigned', 'ratio')]
+        for a in allocations:
+            final_load = a.current_load + a.assigned
+            lines.append('  %-40s %10d %10d %10d %6.1f%%'
+                         % (a.node, a.capacity, final_load, a.assigned,
+                            final_load * 100.0 / max(a.capacity, 1)))
+        if unplaced:
+            lines.append('  %d users could not be assigned a node'
+                         % unplaced)
+    return '\n'.join(lines)
+
+
+def _parse_capacity(value):
+    node, _, capacity = value.rpartition('=')
+    if not node:
+        raise argparse.ArgumentTypeError('expected node=capacity')
+    return node, int(capacity)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Report on the users and nodes of a service.')
+    parser.add_argument('sqluri', help='database to read, ideally a replica')
+    parser.add_argument('service')
+    parser.add_argument('--chunk-size', type=int, default=100000,
+                        help='number of records to process at a time')
+    parser.add_argument('--new-users', type=int, default=0,
+                        help='simulate assigning this many new users')
+    parser.add_argument('--capacity', type=_parse_capacity, action='append',
+                        default=[], metavar='NODE=CAPACITY',
+                        help='proposed capacity of a node, for the '
+                             'simulation')
+    args = parser.parse_args(args)
+
+    backend = SQLMetadata(args.sqluri)
+    stats = collect_stats(backend, args.service, args.chunk_size)
+    allocations, unplaced = None, 0
+    if args.new_users or args.capacity:
+        nodes = backend.get_node_loads(args.service)
+        allocations, unplaced = simulate_allocation(
+            nodes, args.new_users, dict(args.capacity))
+    print(format_report(stats, allocations, unplaced))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
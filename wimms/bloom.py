@@ -0,0 +1,167 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+A simple Bloom filter, for compact set membership tests.
+
+A Bloom filter can say that a key is definitely not in the set, or that it
+probably is.  The chance of a false "probably" grows with the number of
+keys added, and is set by choosing the size of the filter up front.
+"""
+import math
+import struct
+import hashlib
+import threading
+
+
+class BloomFilter(object):
+    """Bloom filter sized for 'capacity' keys at the given error rate."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        num_bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.num_bits = int(math.ceil(num_bits))
+        num_hashes = self.num_bits * math.log(2) / capacity
+        self.num_hashes = max(1, int(round(num_hashes)))
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        # Derive all the bit positions from one digest, using the
+        # double-hashing scheme of Kirsch and Mitzenmacher.
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in xrange(self.num_hashes)]
+
+    def add(self, key):
+        bits = self._bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    @property
+    def memory_footprint(self):
+        """Size of the filter's bit array, in bytes."""
+        return len(self._bits)
+
+    @property
+    def false_positive_rate(self):
+        """Expected false-positive rate given the keys added so far."""
+        fill = 1 - math.exp(-float(self.num_hashes) * self.count /
+                            self.num_bits)
+        return fill ** self.num_hashes
+
+
+class UserFilter(object):
+    """Tracks which (service, email) pairs might have any user records.
+
+    This lets get_user() answer "no such user" for unknown accounts without
+    querying the database.  It knows nothing until rebuild() has been run
+    over the existing records, after which it must be told about each new
+    user via add().  Records created by other processes are only picked up
+    on the next rebuild, so a "no such user" answer may be stale when
+    several processes create users.  create_user() checks the database
+    for users the filter hasn't seen, so that doesn't lead to duplicate
+    assignments.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self._capacity = capacity
+        self._error_rate = error_rate
+        self._lock = threading.Lock()
+        self._filter = None
+        self._building = None
+        self.lookups = 0
+        self.skipped = 0
+        self.false_positives = 0
+
+    def _key(self, service, email):
+        return u'%s\0%s' % (service, email)
+
+    def might_exist(self, service, email):
+        """Returns False if the user definitely has no records."""
+        bloom = self._filter
+        if bloom is None:
+            return True
+        found = self._key(service, email) in bloom
+        with self._lock:
+            self.lookups += 1
+            if not found:
+                self.skipped += 1
+        return found
+
+    def has_seen(self, service, email):
+        """Like might_exist(), without counting it as a lookup."""
+        bloom = self._filter
+        return bloom is None or self._key(service, email) in bloom
+
+    def record_false_positive(self):
+        """Note that a user that might_exist() turned out not to."""
+        if self._filter is not None:
+            with self._lock:
+                self.false_positives += 1
+
+    def add(self, service, email):
+        key = self._key(service, email)
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(key)
+            if self._building is not None:
+                self._building.add(key)
+
+    def rebuild(self, users):
+        """Replace the filter contents with the given (service, email) pairs.
+
+        Users added while the rebuild is in progress are included in the
+        new filter, which then atomically replaces the old one.
+        """
+        bloom = BloomFilter(self._capacity, self._error_rate)
+        with self._lock:
+            self._building = bloom
+        try:
+            for service, email in users:
+                key = self._key(service, email)
+                with self._lock:
+                    bloom.add(key)
+        except Exception:
+            with self._lock:
+                self._building = None
+            raise
+        with self._lock:
+            self._building = None
+            self._filter = bloom
+            self.lookups = self.skipped = self.false_positives = 0
+
+    def get_stats(self):
+        with self._lock:
+            bloom = self._filter
+            lookups = self.lookups
+            skipped = self.skipped
+            false_positives = self.false_positives
+        if bloom is None:
+            return {'ready': False}
+        # Only the lookups of users with no records can be false positives.
+        negatives = false_positives + skipped
+        if negatives:
+            observed_rate = float(false_positives) / negatives
+        else:
+            observed_rate = 0.0
+        return {
+            'ready': True,
+            'memory_bytes': bloom.memory_footprint,
+            'keys': bloom.count,
+            'expected_false_positive_rate': bloom.false_positive_rate,
+            'observed_false_positive_rate': observed_rate,
+            'lookups': lookups,
+            'skipped': skipped,
+            'false_positives': false_positives,
+        }
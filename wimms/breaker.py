@@ -0,0 +1,178 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Failing fast when the database is struggling.
+
+The CircuitBreaker watches the error rate of calls to a database.  When too
+many of them fail it "trips" and rejects all calls outright for a while,
+rather than letting each request thread block on a dead connection pool.
+After that it lets a single trial call through, and closes again if the
+trial succeeds.
+
+The ConcurrencyLimiter bounds the number of calls in flight at once, with a
+small bounded queue of waiters; anything beyond that is rejected at once.
+"""
+import time
+import threading
+
+from mozsvc.exceptions import BackendError
+
+
+class CircuitOpenError(BackendError):
+    """Raised when a call is rejected because the circuit breaker is open."""
+    pass
+
+
+class OverloadedError(BackendError):
+    """Raised when a call is rejected because too many are in flight."""
+    pass
+
+
+class CircuitBreaker(object):
+    """Trips when the failure rate over a rolling window gets too high.
+
+    The breaker trips once at least 'min_calls' calls were made within the
+    last 'window' seconds and at least 'failure_rate' of them failed.  It
+    stays open for 'reset_timeout' seconds before allowing a trial call.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_rate=0.5, min_calls=20, window=10,
+                 reset_timeout=30):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._opened_at = None
+        self._trial_running = False
+        self.state = self.CLOSED
+        self.trips = 0
+        self.rejected = 0
+
+    def before_call(self):
+        """Check that a call may go ahead, raising CircuitOpenError if not."""
+        if self.state == self.CLOSED:
+            return
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.time() - self._opened_at >= self.reset_timeout:
+                    self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+            if self.state == self.CLOSED:
+                return
+            self.rejected += 1
+        raise CircuitOpenError('database circuit breaker is open',
+                               retry_after=self.reset_timeout)
+
+    def after_call(self, success):
+        """Record the outcome of a call that was allowed to go ahead."""
+        now = time.time()
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._trial_running:
+                self._trial_running = False
+                if success:
+                    self.state = self.CLOSED
+                    self._buckets.clear()
+                else:
+                    self._trip(now)
+                return
+            # Count calls in one-second buckets over the rolling window.
+            bucket = int(now)
+            counts = self._buckets.get(bucket)
+            if counts is None:
+                self._expire(bucket)
+                counts = self._buckets[bucket] = [0, 0]
+            counts[0] += 1
+            if not success:
+                counts[1] += 1
+                if self.state == self.CLOSED:
+                    calls, failures = self._totals()
+                    if calls >= self.min_calls and \
+                            failures >= calls * self.failure_rate:
+                        self._trip(now)
+
+    def _trip(self, now):
+        self.state = self.OPEN
+        self._opened_at = now
+        self.trips += 1
+
+    def _expire(self, bucket):
+        for old_bucket in list(self._buckets):
+            if old_bucket <= bucket - self.window:
+                del self._buckets[old_bucket]
+
+    def _totals(self):
+        calls = failures = 0
+        for bucket_calls, bucket_failures in self._buckets.values():
+            calls += bucket_calls
+            failures += bucket_failures
+        return calls, failures
+
+    def get_stats(self):
+        with self._lock:
+            self._expire(int(time.time()))
+            calls, failures = self._totals()
+            return {
+                'state': self.state,
+                'calls': calls,
+                'failures': failures,
+                'trips': self.trips,
+                'rejected': self.rejected,
+            }
+
+
+class ConcurrencyLimiter(object):
+    """Allows at most 'max_inflight' concurrent calls.
+
+    Up to 'max_queued' further callers wait for up to 'queue_timeout'
+    seconds for a slot; any others are rejected with OverloadedError.
+    """
+
+    def __init__(self, max_inflight, max_queued=0, queue_timeout=1.0):
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition(threading.Lock())
+        self.inflight = 0
+        self.queued = 0
+        self.overloaded = 0
+
+    def acquire(self):
+        with self._cond:
+            if self.inflight >= self.max_inflight:
+                if self.queued >= self.max_queued:
+                    self.overloaded += 1
+                    raise OverloadedError('too many database calls queued')
+                self.queued += 1
+                try:
+                    deadline = time.time() + self.queue_timeout
+                    while self.inflight >= self.max_inflight:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.overloaded += 1
+                            raise OverloadedError('timed out waiting for '
+                                                  'a database call slot')
+                        self._cond.wait(remaining)
+                finally:
+                    self.queued -= 1
+            self.inflight += 1
+
+    def release(self):
+        with self._cond:
+            self.inflight -= 1
+            self._cond.notify()
+
+    def get_stats(self):
+        return {
+            'inflight': self.inflight,
+            'queued': self.queued,
+            'overloaded': self.overloaded,
+        }
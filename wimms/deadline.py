@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Per-call deadlines.
+
+The public methods of the metadata backends accept an optional 'timeout'
+keyword argument giving the number of seconds the call may take.  The
+resulting deadline is kept in a thread-local, so that it covers every query
+made by the call, including those of any nested calls, and the backends
+pass the time remaining on to the database driver for each query.
+"""
+import time
+import types
+import functools
+import threading
+from contextlib import contextmanager
+
+from mozsvc.exceptions import BackendTimeoutError
+
+
+class DeadlineExceeded(BackendTimeoutError):
+    """Raised when a call runs past its deadline."""
+    pass
+
+
+_local = threading.local()
+
+
+def get_deadline():
+    """Get the current thread's deadline as a timestamp, or None."""
+    return getattr(_local, 'deadline', None)
+
+
+def time_left():
+    """Get the seconds left until the current thread's deadline, or None."""
+    expires = get_deadline()
+    if expires is None:
+        return None
+    return max(0.0, expires - time.time())
+
+
+def is_expired():
+    """Returns True if the current thread's deadline has passed."""
+    expires = get_deadline()
+    return expires is not None and expires <= time.time()
+
+
+@contextmanager
+def deadline(timeout):
+    """Bound everything done within the block to 'timeout' seconds.
+
+    This nests with any deadline that is already in effect, with the
+    earliest one winning.
+    """
+    outer = get_deadline()
+    new = time.time() + timeout
+    if outer is not None and outer < new:
+        new = outer
+    _local.deadline = new
+    try:
+        yield new
+    finally:
+        _local.deadline = outer
+
+
+def _iter_with_deadline(iterator, expires):
+    while True:
+        with deadline(expires - time.time()):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def with_timeout(func):
+    """Decorate a method to accept an optional 'timeout' argument.
+
+    If the method returns a generator, the deadline also applies to the
+    queries made while iterating over it.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwds):
+        timeout = kwds.pop('timeout', None)
+        if timeout is None:
+            return func(*args, **kwds)
+        with deadline(timeout) as expires:
+            result = func(*args, **kwds)
+        if isinstance(result, types.GeneratorType):
+            return _iter_with_deadline(result, expires)
+        return result
+    return wrapper
@@ -0,0 +1,156 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Formatting of the endpoint URLs of user records.
+
+Each service has an endpoint pattern such as "{node}/1.5/{uid}", which can
+use the keys {uid}, {node} and {service}.  Rather than having every caller
+fetch all the patterns and run str.format() on them for each request, the
+backends keep them compiled into %-style templates, which are a good deal
+cheaper to fill in, and reload them every so often to pick up any changes.
+"""
+import time
+import threading
+import traceback
+from string import Formatter
+
+from mozsvc.exceptions import BackendError
+
+from wimms import logger
+
+
+_FIELDS = ('uid', 'node', 'service')
+
+# How often a lookup for an unknown service may trigger a reload.
+_MISS_RELOAD_INTERVAL = 1
+
+
+class EndpointPattern(object):
+    """A service endpoint pattern, parsed once and for all.
+
+    Patterns that only use plain {uid}, {node} and {service} fields are
+    turned into a %-style template.  Anything fancier, such as a format
+    spec, is left to str.format().
+    """
+
+    __slots__ = ('pattern', '_template')
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self._template = self._compile(pattern)
+
+    @staticmethod
+    def _compile(pattern):
+        template = []
+        try:
+            for literal, field, spec, conversion in Formatter().parse(pattern):
+                template.append(literal.replace('%', '%%'))
+                if field is None:
+                    continue
+                if spec or conversion or field not in _FIELDS:
+                    return None
+                template.append('%(' + field + ')s')
+        except ValueError:
+            # Malformed, so have str.format() raise the error when used.
+            return None
+        return ''.join(template)
+
+    def format(self, service, node, uid):
+        if self._template is None:
+            return self.pattern.format(uid=uid, node=node, service=service)
+        return self._template % {'uid': uid, 'node': node, 'service': service}
+
+    def format_users(self, service, users):
+        """Format the endpoints of several user records at once."""
+        template = self._template
+        if template is None:
+            format = self.pattern.format
+            return [format(uid=user['uid'], node=user['node'],
+                           service=service) for user in users]
+        return [template % {'uid': user['uid'], 'node': user['node'],
+                            'service': service} for user in users]
+
+
+class EndpointPatterns(object):
+    """The compiled endpoint patterns of all services, reloaded as needed.
+
+    'load' is called with the name of the service being looked up, or None
+    when listing them all, to get (service, pattern) pairs for all services,
+    whenever the patterns are more than 'max_age' seconds old.  Only one
+    thread reloads them at a time, while the others carry on with the ones
+    they already have.
+    """
+
+    def __init__(self, load, max_age=300):
+        self._load = load
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._patterns = {}
+        self._loaded_at = 0
+
+    def invalidate(self):
+        """Have the patterns reloaded on their next use."""
+        self._loaded_at = 0
+
+    def get(self, service):
+        """Get the EndpointPattern of the given service."""
+        patterns = self._patterns
+        age = time.time() - self._loaded_at
+        if age > self.max_age or \
+                (service not in patterns and age > _MISS_RELOAD_INTERVAL):
+            patterns = self._reload(service, patterns)
+        try:
+            pattern = patterns[service]
+        except KeyError:
+            raise BackendError('unknown service: ' + service)
+        if pattern is None:
+            raise BackendError('no endpoint pattern for service: ' + service)
+        return pattern
+
+    def get_services(self):
+        """Get the names of all the known services."""
+        patterns = self._patterns
+        if time.time() - self._loaded_at > self.max_age:
+            patterns = self._reload(None, patterns)
+        return list(patterns)
+
+    @staticmethod
+    def _knows(service, patterns):
+        # Listing the services can make do with whichever we have.
+        if service is None:
+            return bool(patterns)
+        return service in patterns
+
+    def _reload(self, service, patterns):
+        if not self._lock.acquire(False):
+            if self._knows(service, patterns):
+                return patterns
+            self._lock.acquire()
+        try:
+            if self._patterns is not patterns:
+                # Another thread reloaded them while we were waiting.
+                return self._patterns
+            try:
+                loaded = self._load(service)
+            except Exception:
+                if not self._knows(service, patterns):
+                    raise
+                # Keep using what we have, and try again later.
+                logger.error(traceback.format_exc())
+                self._loaded_at = time.time()
+                return patterns
+            new_patterns = {}
+            for name, pattern in loaded:
+                old = patterns.get(name)
+                if old is not None and old.pattern == pattern:
+                    new_patterns[name] = old
+                elif pattern is not None:
+                    new_patterns[name] = EndpointPattern(pattern)
+                else:
+                    new_patterns[name] = None
+            self._patterns = new_patterns
+            self._loaded_at = time.time()
+            return new_patterns
+        finally:
+            self._lock.release()
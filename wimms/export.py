@@ -0,0 +1,50 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Helpers for exporting streams of user records.
+
+These consume the rows produced by SQLMetadata.iter_node_users() and
+iter_service_users() one at a time and write them straight out to a file
+object, so an export never holds more than a single page of rows in memory.
+"""
+import csv
+import json
+
+
+EXPORT_FIELDS = ('uid', 'email', 'node', 'generation', 'client_state',
+                 'created_at', 'replaced_at', 'client_state_history')
+
+
+def write_ndjson(rows, stream):
+    """Write user records to the stream as newline-delimited JSON.
+
+    Returns the number of records written.
+    """
+    count = 0
+    for row in rows:
+        stream.write(json.dumps(dict(zip(EXPORT_FIELDS, row))))
+        stream.write('\n')
+        count += 1
+    return count
+
+
+def write_csv(rows, stream, header=True):
+    """Write user records to the stream as CSV.
+
+    Returns the number of records written, not counting the header line.
+    """
+    writer = csv.writer(stream)
+    if header:
+        writer.writerow(EXPORT_FIELDS)
+    count = 0
+    for row in rows:
+        writer.writerow([_encode(value) for value in row])
+        count += 1
+    return count
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return value
@@ -0,0 +1,100 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Group-commit batching of concurrent writes.
+
+When many threads each need to write a small record, having every one of
+them run its own transaction means the database spends most of its time
+syncing commits to disk.  A GroupCommitter collects the writes submitted
+within a short window and hands them to a flush function as a single batch,
+so they can be written in one transaction.  Each caller blocks until its
+batch has been written, then gets back its own result.
+
+The first thread to submit into an empty queue becomes the leader for that
+batch: it sleeps for the window, takes everything queued up in the meantime
+and runs the flush on behalf of the others.  There is no background thread.
+
+The others only wait for as long as their own deadline allows.  The flush
+runs under the leader's deadline, so if that runs out first, the others
+submit their writes again rather than failing along with it.
+"""
+import sys
+import time
+import threading
+
+from wimms.deadline import DeadlineExceeded, time_left, is_expired
+
+
+class _PendingWrite(object):
+
+    __slots__ = ('item', 'result', 'exc_info', 'done')
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+
+class GroupCommitter(object):
+    """Batches concurrently-submitted items into calls to flush(items).
+
+    The flush function must return a list with one result per item, in
+    order.  If it raises, the error is re-raised in every submitting thread.
+    """
+
+    def __init__(self, flush, delay):
+        self._flush = flush
+        self._delay = delay
+        self._lock = threading.Lock()
+        self._queue = []
+        self._leading = False
+        self.batches = 0
+        self.items = 0
+
+    def submit(self, item):
+        """Queue an item for writing, and wait for its result."""
+        while True:
+            pending = _PendingWrite(item)
+            with self._lock:
+                self._queue.append(pending)
+                leader = not self._leading
+                self._leading = True
+            if leader:
+                time.sleep(self._delay)
+                with self._lock:
+                    batch, self._queue = self._queue, []
+                    self._leading = False
+                self._write(batch)
+            elif not pending.done.wait(time_left()):
+                with self._lock:
+                    # Don't write the item if it hasn't been taken yet.
+                    if pending in self._queue:
+                        self._queue.remove(pending)
+                raise DeadlineExceeded('deadline exceeded')
+            if pending.exc_info is not None:
+                exc_type, exc_value, tb = pending.exc_info
+                if not leader and issubclass(exc_type, DeadlineExceeded) \
+                        and not is_expired():
+                    # The batch ran out of the leader's time, not ours.
+                    continue
+                raise exc_type, exc_value, tb
+            return pending.result
+
+    def _write(self, batch):
+        try:
+            results = self._flush([pending.item for pending in batch])
+        except Exception:
+            exc_info = sys.exc_info()
+            for pending in batch:
+                pending.exc_info = exc_info
+        else:
+            for pending, result in zip(batch, results):
+                pending.result = result
+        finally:
+            with self._lock:
+                self.batches += 1
+                self.items += len(batch)
+            for pending in batch:
+                pending.done.set()
@@ -0,0 +1,658 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+In-memory Service Metadata.
+
+This implementation provides the same interface as SQLMetadata, but keeps
+everything in indexed in-process structures guarded by a single lock.  It
+is meant for load-testing and unit-testing the code around it at full
+speed, without any database; nothing is persisted or shared between
+processes.
+
+Records are timestamped and compared exactly as in the database, so the
+changes made to a user within the same millisecond can't be told apart by
+time.  Tests can pass a clock that ticks on each call, much as every
+statement takes a while to run against a real database.
+"""
+import time
+import bisect
+import itertools
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+from mozsvc.exceptions import BackendError
+
+from wimms.sql import (MAX_GENERATION, UserRecord, get_timestamp,
+                       check_client_state, pack_client_states,
+                       unpack_client_states,
+                       _grace_period_cutoff, _NodeAllocator)
+from wimms.deadline import get_deadline, with_timeout, DeadlineExceeded
+from wimms.endpoints import EndpointPatterns
+
+
+# The rows produced for user records, with the same fields in the same
+# order as those of SQLMetadata.iter_service_users().
+UserRow = namedtuple('UserRow', ['uid', 'email', 'node', 'generation',
+                                 'client_state', 'created_at', 'replaced_at',
+                                 'client_state_history'])
+
+ServiceRow = namedtuple('ServiceRow', ['id', 'service', 'pattern'])
+
+
+class _Record(object):
+    """A mutable user record, as stored in the users "table"."""
+
+    __slots__ = ('uid', 'service', 'email', 'node', 'generation',
+                 'client_state', 'created_at', 'replaced_at',
+                 'client_state_history')
+
+    def __init__(self, uid, service, email, node, generation, client_state,
+                 created_at, replaced_at, client_state_history):
+        self.uid = uid
+        self.service = service
+        self.email = email
+        self.node = node
+        self.generation = generation
+        self.client_state = client_state
+        self.created_at = created_at
+        self.replaced_at = replaced_at
+        self.client_state_history = client_state_history
+
+    def row(self):
+        return UserRow(self.uid, self.email, self.node, self.generation,
+                       self.client_state, self.created_at, self.replaced_at,
+                       self.client_state_history)
+
+
+class _Node(object):
+
+    __slots__ = ('node', 'order', 'available', 'current_load', 'capacity',
+                 'downed', 'backoff')
+
+    def __init__(self, node, order, available, current_load, capacity,
+                 downed, backoff):
+        self.node = node
+        self.order = order
+        self.available = available
+        self.current_load = current_load
+        self.capacity = capacity
+        self.downed = downed
+        self.backoff = backoff
+
+
+def _current_key(record):
+    """Order of precedence of a user's records, most up-to-date first."""
+    return (-record.generation, -record.created_at, -record.uid)
+
+
+class MemoryMetadata(object):
+
+    def __init__(self, endpoint_patterns_max_age=300, clock=get_timestamp,
+                 **kw):
+        self._lock = threading.RLock()
+        # Gets the current timestamp, in milliseconds.
+        self._clock = clock
+        self._services = {}
+        self._service_ids = itertools.count(1)
+        # Nodes by service id and then node name.
+        self._nodes = {}
+        self._node_order = itertools.count()
+        # Records by uid, along with the indexes used to look them up:
+        # uids by (service id, email), and sorted lists of uids by service
+        # id and by (service id, node) for iterating in uid order.
+        self._records = {}
+        self._uids = itertools.count(1)
+        self._by_email = {}
+        self._by_service = {}
+        self._by_node = {}
+        self._endpoint_patterns = EndpointPatterns(
+            self._load_endpoint_patterns, float(endpoint_patterns_max_age))
+
+    @contextmanager
+    def _transaction(self):
+        expires = get_deadline()
+        if expires is not None and expires <= time.time():
+            raise DeadlineExceeded('deadline exceeded')
+        with self._lock:
+            yield
+
+    @contextmanager
+    def session(self, transaction=False):
+        """Accepted for compatibility with SQLMetadata.session().
+
+        There are no connections to pin here, and changes are applied as
+        they are made, so they are not rolled back if the block raises.
+        """
+        yield
+
+    def _get_service_id(self, service):
+        try:
+            return self._services[service].id
+        except KeyError:
+            raise BackendError('unknown service: ' + service)
+
+    #
+    # Methods for the users "table".
+    #
+
+    def _insert(self, service_id, email, node, generation, client_state,
+                created_at, replaced_at=None, client_state_history=None):
+        uid = next(self._uids)
+        record = _Record(uid, service_id, email, node, generation,
+                         client_state, created_at, replaced_at,
+                         client_state_history)
+        self._records[uid] = record
+        self._by_email.setdefault((service_id, email), []).append(uid)
+        # New uids are always the largest yet, so the lists stay sorted.
+        self._by_service.setdefault(service_id, []).append(uid)
+        self._by_node.setdefault((service_id, node), []).append(uid)
+        return uid
+
+    def _delete(self, record):
+        del self._records[record.uid]
+        for index, key in ((self._by_email, (record.service, record.email)),
+                           (self._by_service, record.service),
+                           (self._by_node, (record.service, record.node))):
+            uids = index[key]
+            if index is self._by_email:
+                uids.remove(record.uid)
+            else:
+                del uids[bisect.bisect_left(uids, record.uid)]
+            if not uids:
+                del index[key]
+
+    def _user_records(self, service_id, email):
+        uids = self._by_email.get((service_id, email), ())
+        return [self._records[uid] for uid in uids]
+
+    def _service_records(self, service_id):
+        uids = self._by_service.get(service_id, ())
+        return [self._records[uid] for uid in uids]
+
+    #
+    # Methods for the node-assignment API.
+    #
+
+    @with_timeout
+    def get_user(self, service, email, generation=None, client_state=None):
+        """Get the current record for a user, or None if they have none.
+
+        If generation or client_state are given, the record is also updated
+        with them just as update_user() would do, unless the user has been
+        retired.
+        """
+        user = self._get_user(service, email)
+        if user is not None and user.generation < MAX_GENERATION:
+            if client_state is not None:
+                if client_state != user.client_state:
+                    self.update_user(service, user, generation, client_state)
+                    return user
+            if generation is not None and generation > user.generation:
+                self.update_user(service, user, generation)
+        return user
+
+    def _get_user(self, service, email):
+        with self._transaction():
+            service_id = self._get_service_id(service)
+            records = self._user_records(service_id, email)
+            if not records:
+                return None
+            records.sort(key=_current_key)
+            cur = records[0]
+            old_client_states = {}
+            for record in records:
+                old_client_states[record.client_state] = True
+                for state in unpack_client_states(record.client_state_history):
+                    old_client_states[state] = True
+            old_client_states.pop(cur.client_state, None)
+            # Make sure each old record is marked as replaced.
+            for record in records[1:]:
+                if record.replaced_at is None:
+                    record.replaced_at = cur.created_at
+            if cur.replaced_at is None or cur.generation == MAX_GENERATION:
+                return UserRecord(email, cur.uid, cur.node, cur.generation,
+                                  cur.client_state, old_client_states)
+        # They've been moved off their node, so give them a new one.
+        return self.create_user(service, email, cur.generation,
+                                cur.client_state, None, old_client_states)
+
+    @with_timeout
+    def get_user_all_services(self, email, services=None):
+        """Get the user's current record for each of several services.
+
+        Returns a dict mapping the name of each service for which the user
+        has any records to their record.
+        """
+        if services is None:
+            services = self._endpoint_patterns.get_services()
+        users = {}
+        for service in services:
+            user = self._get_user(service, email)
+            if user is not None:
+                users[service] = user
+        return users
+
+    @with_timeout
+    def create_user(self, service, email, generation=0, client_state='',
+                    timestamp=None, old_client_states=()):
+        check_client_state(client_state)
+        if timestamp is None:
+            timestamp = self._clock()
+        old_client_states = dict.fromkeys(old_client_states, True)
+        with self._transaction():
+            service_id = self._get_service_id(service)
+            node = self.get_best_node(service)
+            uid = self._insert(service_id, email, node, generation,
+                               client_state, timestamp,
+                               client_state_history=pack_client_states(
+                                   old_client_states))
+        return UserRecord(email, uid, node, generation, client_state,
+                          old_client_states)
+
+    @with_timeout
+    def update_user(self, service, user, generation=None, client_state=None):
+        with self._transaction():
+            service_id = self._get_service_id(service)
+            if client_state is None:
+                # uid can stay the same, just update the generation number.
+                if generation is not None:
+                    for record in self._user_records(service_id,
+                                                     user['email']):
+                        if record.generation < generation and \
+                                record.replaced_at is None:
+                            record.generation = generation
+                    user['generation'] = max(generation, user['generation'])
+                return
+            check_client_state(client_state)
+            # reject previously-seen client-state strings.
+            if client_state == user['client_state']:
+                raise BackendError('previously seen client-state string')
+            if client_state in user['old_client_states']:
+                raise BackendError('previously seen client-state string')
+            # need to create a new record for new client_state.
+            if generation is not None:
+                generation = max(user['generation'], generation)
+            else:
+                generation = user['generation']
+            now = self._clock()
+            history = list(user['old_client_states'])
+            history.append(user['client_state'])
+            uid = self._insert(service_id, user['email'], user['node'],
+                               generation, client_state, now, None,
+                               pack_client_states(history))
+            user['uid'] = uid
+            user['generation'] = generation
+            user['old_client_states'][user['client_state']] = True
+            user['client_state'] = client_state
+            # mark old records as having been replaced.
+            self._replace_user_records(service_id, user['email'], now)
+
+    @with_timeout
+    def retire_user(self, email):
+        now = self._clock()
+        with self._transaction():
+            for service in self._services.values():
+                for record in self._user_records(service.id, email):
+                    if record.replaced_at is None:
+                        record.replaced_at = now
+                        record.generation = MAX_GENERATION
+
+    #
+    # Methods for low-level user record management.
+    #
+
+    @with_timeout
+    def get_user_records(self, service, email):
+        """Get all the user's records for a service, including the old ones."""
+        with self._transaction():
+            records = self._user_records(self._get_service_id(service), email)
+            records.sort(key=lambda record: (record.created_at, -record.uid))
+            return [record.row() for record in records]
+
+    @with_timeout
+    def iter_node_users(self, service, node, include_replaced=False,
+                        batch_size=1000):
+        """Stream all the user records assigned to a node, in uid order."""
+        service_id = self._get_service_id(service)
+        return self._iter_user_records(self._by_node, (service_id, node),
+                                       include_replaced, batch_size)
+
+    @with_timeout
+    def iter_service_users(self, service, include_replaced=False,
+                           batch_size=1000):
+        """Stream all the user records for a service, in uid order."""
+        service_id = self._get_service_id(service)
+        return self._iter_user_records(self._by_service, service_id,
+                                       include_replaced, batch_size)
+
+    def _iter_user_records(self, index, key, include_replaced, batch_size):
+        # The lock is only held while taking each page of rows, so that
+        # other threads can carry on while the consumer works through it.
+        last_uid = -1
+        while True:
+            rows = []
+            with self._transaction():
+                uids = index.get(key, ())
+                pos = bisect.bisect_right(uids, last_uid)
+                while pos < len(uids) and len(rows) < batch_size:
+                    record = self._records[uids[pos]]
+                    if include_replaced or record.replaced_at is None:
+                        rows.append(record.row())
+                    pos += 1
+                    last_uid = record.uid
+                more = pos < len(uids)
+            for row in rows:
+                yield row
+            if not more:
+                break
+
+    @with_timeout
+    def bulk_import_users(self, service, records, batch_size=1000, skip=0,
+                          checkpoint=None, update_node_counts=True):
+        """Insert many user records for a service, in batches.
+
+        This takes the same records and arguments as
+        SQLMetadata.bulk_import_users(), and each batch is applied at once.
+        """
+        service_id = self._get_service_id(service)
+        records = itertools.islice(records, skip, None)
+        done = skip
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            with self._transaction():
+                self._import_batch(service_id, batch, update_node_counts)
+            done += len(batch)
+            if checkpoint is not None:
+                checkpoint(done)
+        return done
+
+    def _import_batch(self, service_id, batch, update_node_counts):
+        allocator = None
+        node_counts = {}
+        rows = []
+        now = self._clock()
+        for record in batch:
+            node = record.get('node')
+            if node is None:
+                if allocator is None:
+                    allocator = _NodeAllocator(self._node_loads(service_id))
+                node = allocator.allocate()
+            check_client_state(record.get('client_state'))
+            replaced_at = record.get('replaced_at')
+            if replaced_at is None:
+                node_counts[node] = node_counts.get(node, 0) + 1
+            history = record.get('old_client_states')
+            if history is not None:
+                history = pack_client_states(history)
+            rows.append((service_id, record['email'], node,
+                         record.get('generation', 0),
+                         record.get('client_state', ''),
+                         record.get('created_at', now), replaced_at, history))
+        # Only insert once the whole batch is known to be valid, as there's
+        # no rolling it back.
+        for row in rows:
+            self._insert(*row)
+        if update_node_counts:
+            self._add_node_load(service_id, node_counts)
+
+    @with_timeout
+    def get_old_user_records(self, service, grace_period=-1, limit=100):
+        """Get user records that were replaced outside the grace period."""
+        cutoff = _grace_period_cutoff(grace_period, self._clock())
+        with self._transaction():
+            records = [record for record in
+                       self._service_records(self._get_service_id(service))
+                       if record.replaced_at is not None and
+                       record.replaced_at < cutoff]
+            records.sort(key=lambda record: (-record.replaced_at,
+                                             -record.uid))
+            return [record.row() for record in records[:limit]]
+
+    @with_timeout
+    def compact_user_records(self, service, grace_period=-1, limit=100):
+        """Fold old replaced records into their user's current record.
+
+        Returns the number of records deleted.
+        """
+        cutoff = _grace_period_cutoff(grace_period, self._clock())
+        emails = set()
+        for row in self.get_old_user_records(service, grace_period, limit):
+            emails.add(row.email)
+        count = 0
+        for email in sorted(emails):
+            count += self._compact_user(service, email, cutoff)
+        return count
+
+    @with_timeout
+    def migrate_client_state_history(self, service, grace_period=-1,
+                                     batch_size=1000):
+        """Fill in the client-state history for all of a service's users.
+
+        Returns the count of users that were updated.
+        """
+        cutoff = _grace_period_cutoff(grace_period, self._clock())
+        count = 0
+        for row in list(self.iter_service_users(service,
+                                                batch_size=batch_size)):
+            if row.client_state_history is None:
+                self._compact_user(service, row.email, cutoff)
+                count += 1
+        return count
+
+    def _compact_user(self, service, email, cutoff):
+        with self._transaction():
+            records = self._user_records(self._get_service_id(service), email)
+            if not records:
+                return 0
+            cur = min(records, key=_current_key)
+            history = set(unpack_client_states(cur.client_state_history))
+            old_records = []
+            for record in records:
+                if record is cur:
+                    continue
+                history.add(record.client_state)
+                history.update(
+                    unpack_client_states(record.client_state_history))
+                if record.replaced_at is not None and \
+                        record.replaced_at < cutoff:
+                    old_records.append(record)
+            history.discard(cur.client_state)
+            cur.client_state_history = pack_client_states(history)
+            for record in old_records:
+                self._delete(record)
+            return len(old_records)
+
+    @with_timeout
+    def replace_user_records(self, service, email, timestamp=None):
+        """Mark all existing service records for a user as replaced."""
+        if timestamp is None:
+            timestamp = self._clock()
+        with self._transaction():
+            self._replace_user_records(self._get_service_id(service), email,
+                                       timestamp)
+
+    def _replace_user_records(self, service_id, email, timestamp):
+        for record in self._user_records(service_id, email):
+            if record.replaced_at is None and record.created_at < timestamp:
+                record.replaced_at = timestamp
+
+    @with_timeout
+    def replace_user_record(self, service, uid, timestamp=None):
+        """Mark an existing service record as replaced."""
+        if timestamp is None:
+            timestamp = self._clock()
+        with self._transaction():
+            record = self._records.get(uid)
+            if record is not None and \
+                    record.service == self._get_service_id(service):
+                record.replaced_at = timestamp
+
+    @with_timeout
+    def delete_user_record(self, service, uid):
+        """Delete the user record with the given uid."""
+        with self._transaction():
+            record = self._records.get(uid)
+            if record is not None and \
+                    record.service == self._get_service_id(service):
+                self._delete(record)
+
+    #
+    # Nodes management
+    #
+
+    @with_timeout
+    def get_patterns(self):
+        """Returns all the service URL patterns."""
+        with self._transaction():
+            return sorted(self._services.values())
+
+    @with_timeout
+    def add_service(self, service, pattern, **kwds):
+        """Add definition for a new service."""
+        with self._transaction():
+            if service in self._services:
+                raise BackendError('service already exists: ' + service)
+            service_id = next(self._service_ids)
+            self._services[service] = ServiceRow(service_id, service, pattern)
+            self._nodes[service_id] = {}
+            self._endpoint_patterns.invalidate()
+            return service_id
+
+    def _load_endpoint_patterns(self, service):
+        return [(row.service, row.pattern) for row in self.get_patterns()]
+
+    @with_timeout
+    def get_endpoint(self, service, user):
+        """Get the endpoint URL of a user record for the given service."""
+        pattern = self._endpoint_patterns.get(service)
+        return pattern.format(service, user['node'], user['uid'])
+
+    @with_timeout
+    def get_endpoints(self, service, users):
+        """Get the endpoint URLs of several user records, in order."""
+        pattern = self._endpoint_patterns.get(service)
+        return pattern.format_users(service, users)
+
+    @with_timeout
+    def drop_service_users(self, service):
+        """Delete all the user records for a service."""
+        with self._transaction():
+            service_id = self._get_service_id(service)
+            for record in self._service_records(service_id):
+                self._delete(record)
+
+    @with_timeout
+    def add_node(self, service, node, capacity, **kwds):
+        """Add definition for a new node."""
+        with self._transaction():
+            nodes = self._nodes[self._get_service_id(service)]
+            if node in nodes:
+                raise BackendError('node already exists: ' + node)
+            nodes[node] = _Node(node, next(self._node_order),
+                                kwds.get('available', capacity),
+                                kwds.get('current_load', 0), capacity,
+                                kwds.get('downed', 0), kwds.get('backoff', 0))
+
+    @with_timeout
+    def remove_node(self, service, node, timestamp=None):
+        """Remove definition for a node."""
+        with self._transaction():
+            self._nodes[self._get_service_id(service)].pop(node, None)
+            self.unassign_node(service, node, timestamp)
+
+    @with_timeout
+    def unassign_node(self, service, node, timestamp=None):
+        """Clear any assignments to a node."""
+        if timestamp is None:
+            timestamp = self._clock()
+        with self._transaction():
+            service_id = self._get_service_id(service)
+            for uid in self._by_node.get((service_id, node), ()):
+                self._records[uid].replaced_at = timestamp
+
+    @with_timeout
+    def drain_node(self, service, node, batch_size=100, interval=1.0,
+                   max_batches=None, checkpoint=None):
+        """Move all users off a node, a batch at a time.
+
+        This works just like SQLMetadata.drain_node(), with each batch
+        applied at once.  Returns the total count of users moved.
+        """
+        with self._transaction():
+            service_id = self._get_service_id(service)
+            nodes = self._nodes[service_id]
+            if node in nodes:
+                nodes[node].downed = 1
+        moved = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            if batches > 0 and interval > 0:
+                time.sleep(interval)
+            with self._transaction():
+                rows = self.iter_node_users(service, node,
+                                            batch_size=batch_size)
+                rows = list(itertools.islice(rows, batch_size))
+                if not rows:
+                    break
+                self._move_users(service_id, rows)
+            moved += len(rows)
+            batches += 1
+            if checkpoint is not None:
+                checkpoint(moved)
+        return moved
+
+    def _move_users(self, service_id, rows):
+        allocator = _NodeAllocator(self._node_loads(service_id))
+        node_counts = {}
+        now = self._clock()
+        for row in rows:
+            node = allocator.allocate()
+            node_counts[node] = node_counts.get(node, 0) + 1
+            self._insert(service_id, row.email, node, row.generation,
+                         row.client_state, now, None,
+                         row.client_state_history)
+            self._records[row.uid].replaced_at = now
+        self._add_node_load(service_id, node_counts)
+
+    @with_timeout
+    def get_node_loads(self, service):
+        """Returns (node, available, capacity, current_load) for each node
+        that isn't downed.
+        """
+        with self._transaction():
+            return self._node_loads(self._get_service_id(service))
+
+    def _node_loads(self, service_id):
+        """Returns (node, available, capacity, current_load) for each node."""
+        return [(node.node, node.available, node.capacity, node.current_load)
+                for node in self._nodes[service_id].values()
+                if not node.downed]
+
+    def _add_node_load(self, service_id, node_counts):
+        nodes = self._nodes[service_id]
+        for node, count in node_counts.items():
+            if node in nodes:
+                nodes[node].available -= count
+                nodes[node].current_load += count
+
+    @with_timeout
+    def get_best_node(self, service):
+        """Returns the 'least loaded' node currently available, increments the
+        active count on that node, and decrements the slots currently available
+        """
+        with self._transaction():
+            nodes = self._nodes[self._get_service_id(service)]
+            candidates = [node for node in nodes.values()
+                          if node.available > 0 and not node.downed and
+                          node.capacity > node.current_load]
+            if not candidates:
+                raise BackendError('unable to get a node')
+            best = min(candidates, key=lambda node: (
+                node.current_load * 1.0 / node.capacity, node.order))
+            best.available -= 1
+            best.current_load += 1
+            return best.node
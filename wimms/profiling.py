@@ -0,0 +1,256 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Per-method profiling of the backends.
+
+When profiling is enabled, the public methods of a backend are wrapped as
+it's created, and each call records its wall time, the CPU time used by the
+calling thread, and the wall time spent executing statements.  The CPU
+time is wimms' own Python work and that of SQLAlchemy and the driver; the
+database time is spent waiting on the server.  A fraction of the calls can
+also be run under cProfile, with the results aggregated across calls.
+
+Nested calls, such as the create_user() made by get_user(), are counted
+as part of the outermost call.  For methods returning a generator, such as
+iter_service_users(), the call covers iterating over it as well, but not
+the time the caller spends between items.  Nothing is wrapped when
+profiling is off.
+
+Only the statements executed by the calling thread are attributed to the
+method.  Those run on other threads, such as the sharded backend's worker
+threads querying several shards at once, or the group commit thread
+writing a batch of user records, aren't counted in its database time.
+"""
+import os
+import sys
+import time
+import types
+import random
+import signal
+import ctypes
+import ctypes.util
+import pstats
+import cProfile
+import functools
+import threading
+import traceback
+from StringIO import StringIO
+
+from wimms import logger
+
+
+_CLOCK_THREAD_CPUTIME_ID = 3
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _get_thread_cpu_clock():
+    """Get a function returning the CPU time used by the current thread.
+
+    This falls back on the CPU time of the whole process where the thread
+    clock isn't available.
+    """
+    if not sys.platform.startswith('linux'):
+        return time.clock
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1')
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.clock
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def thread_cpu_time():
+        ts = _timespec()
+        clock_gettime(_CLOCK_THREAD_CPUTIME_ID, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    return thread_cpu_time
+
+
+thread_cpu_time = _get_thread_cpu_clock()
+
+
+class _MethodStats(object):
+
+    __slots__ = ('calls', 'errors', 'wall', 'cpu', 'db', 'statements',
+                 'profiled')
+
+    def __init__(self):
+        self.calls = self.errors = self.statements = self.profiled = 0
+        self.wall = self.cpu = self.db = 0.0
+
+
+class _Call(object):
+    """The time spent so far in a call to a profiled method."""
+
+    __slots__ = ('local', 'profile', 'wall', 'cpu', 'db')
+
+    def __init__(self, local, profile):
+        self.local = local
+        self.profile = profile
+        self.wall = self.cpu = 0.0
+        # Time spent executing statements, and how many there were.
+        self.db = [0.0, 0]
+
+    def run(self, func, *args, **kwds):
+        """Call func(*args, **kwds), adding the time taken to the call's."""
+        local = self.local
+        outer = getattr(local, 'current', None)
+        local.current = self.db
+        start_cpu = thread_cpu_time()
+        start = time.time()
+        try:
+            if self.profile is None:
+                return func(*args, **kwds)
+            return self.profile.runcall(func, *args, **kwds)
+        finally:
+            self.wall += time.time() - start
+            self.cpu += thread_cpu_time() - start_cpu
+            local.current = outer
+
+
+class Profiler(object):
+    """Collects the time spent in each method of a backend.
+
+    'sample_rate' is the fraction of calls that are run under cProfile.
+    """
+
+    def __init__(self, sample_rate=0):
+        self.sample_rate = sample_rate
+        # Reentrant, as the signal handler may interrupt a thread holding it.
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._methods = {}
+        self._pstats = None
+
+    def wrap(self, name, method):
+        """Wrap a bound method so that its calls are profiled."""
+        local = self._local
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwds):
+            if getattr(local, 'current', None) is not None:
+                return method(*args, **kwds)
+            profile = None
+            if self.sample_rate and random.random() < self.sample_rate:
+                profile = cProfile.Profile()
+            call = _Call(local, profile)
+            try:
+                result = call.run(method, *args, **kwds)
+            except BaseException:
+                self._record(name, call, True)
+                raise
+            if isinstance(result, types.GeneratorType):
+                # The work is done while iterating, so time that as well.
+                return self._iter_profiled(name, call, result)
+            self._record(name, call, False)
+            return result
+
+        return wrapper
+
+    def _iter_profiled(self, name, call, generator):
+        failed = True
+        try:
+            while True:
+                try:
+                    item = call.run(generator.next)
+                except StopIteration:
+                    break
+                yield item
+            failed = False
+        except GeneratorExit:
+            # The caller stopped iterating early.
+            failed = False
+            raise
+        finally:
+            generator.close()
+            self._record(name, call, failed)
+
+    def time_statement(self, execute, *args):
+        """Run execute(*args), counting the time as spent in the database."""
+        current = getattr(self._local, 'current', None)
+        if current is None:
+            return execute(*args)
+        start = time.time()
+        try:
+            return execute(*args)
+        finally:
+            current[0] += time.time() - start
+            current[1] += 1
+
+    def _record(self, name, call, failed):
+        profile = call.profile
+        with self._lock:
+            stats = self._methods.get(name)
+            if stats is None:
+                stats = self._methods[name] = _MethodStats()
+            stats.calls += 1
+            stats.errors += failed
+            stats.wall += call.wall
+            stats.cpu += call.cpu
+            stats.db += call.db[0]
+            stats.statements += call.db[1]
+            if profile is not None:
+                stats.profiled += 1
+                if self._pstats is None:
+                    self._pstats = pstats.Stats(profile)
+                else:
+                    self._pstats.add(profile)
+
+    def get_stats(self):
+        """Returns the totals for each method that was called."""
+        with self._lock:
+            return dict((name, {
+                'calls': stats.calls,
+                'errors': stats.errors,
+                'wall': stats.wall,
+                'cpu': stats.cpu,
+                'db': stats.db,
+                'statements': stats.statements,
+                'profiled': stats.profiled,
+            }) for name, stats in self._methods.items())
+
+    def dump(self, stream, limit=30):
+        """Write the method totals and any cProfile stats to the stream."""
+        stream.write('%-30s %8s %7s %10s %10s %10s %7s\n'
+                     % ('method', 'calls', 'errors', 'wall ms', 'cpu ms',
+                        'db ms', 'stmts'))
+        stats = self.get_stats()
+        for name in sorted(stats, key=lambda name: -stats[name]['wall']):
+            s = stats[name]
+            stream.write('%-30s %8d %7d %10.1f %10.1f %10.1f %7d\n'
+                         % (name, s['calls'], s['errors'], s['wall'] * 1000,
+                            s['cpu'] * 1000, s['db'] * 1000,
+                            s['statements']))
+        with self._lock:
+            if self._pstats is not None:
+                stream.write('\n')
+                # Stats.print_stats() writes to the stream it was given.
+                output = StringIO()
+                self._pstats.stream = output
+                self._pstats.sort_stats('cumulative').print_stats(limit)
+                stream.write(output.getvalue())
+
+    def dump_on_signal(self, signum, path):
+        """Write the stats to 'path' whenever the process gets 'signum'.
+
+        The path may contain "%(pid)d", since every worker process gets
+        the signal.
+        """
+        def handler(signum, frame):
+            try:
+                with open(path % {'pid': os.getpid()}, 'w') as stream:
+                    self.dump(stream)
+            except Exception:
+                logger.error(traceback.format_exc())
+
+        if isinstance(signum, basestring):
+            signum = getattr(signal, signum)
+        try:
+            signal.signal(signum, handler)
+        except ValueError:
+            # Signal handlers can only be set from the main thread.
+            logger.error('unable to set the profiling signal handler')
@@ -11,10 +11,12 @@ We have the following tables:
  users:  lists the user records for each service, along with their
          metadata and current node assignment.
 
+On MySQL the users table can optionally be partitioned by service, see
+_PartitionedUsersBase below.
 """
 
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy import Column, Integer, String, BigInteger, Index
+from sqlalchemy import Column, Integer, String, BigInteger, Index, Text
 
 
 bases = {}
@@ -24,11 +26,13 @@ def _add(name, base):
     bases[name] = base
 
 
-def get_cls(name, base_cls):
-    if name in base_cls.metadata.tables:
-        return base_cls.metadata.tables[name]
+def get_cls(name, base_cls, tablename=None):
+    if tablename is None:
+        tablename = name
+    if tablename in base_cls.metadata.tables:
+        return base_cls.metadata.tables[tablename]
 
-    args = {'__tablename__': name}
+    args = {'__tablename__': tablename}
     base = bases[name]
     return type(name, (base, base_cls), args).__table__
 
@@ -39,6 +43,11 @@ class _UsersBase(object):
     A user is uniquely identified by their email.  For each service they have
     a uid, an allocated node, and last-seen generation and client-state values.
     Rows are timestamped for easy cleanup of old records.
+
+    Each row also carries the client-state values previously seen for the
+    user, packed into a single string, so the current row is all that's
+    needed to check for re-use of an old client-state.  It's NULL for rows
+    written before this column was added.
     """
     uid = Column(BigInteger(), primary_key=True, autoincrement=True,
                  nullable=False)
@@ -49,6 +58,7 @@ class _UsersBase(object):
     client_state = Column(String(32), nullable=False)
     created_at = Column(BigInteger(), nullable=False)
     replaced_at = Column(BigInteger(), nullable=True)
+    client_state_history = Column(Text(), nullable=True)
 
     @declared_attr
     def __table_args__(cls):
@@ -66,6 +76,41 @@ class _UsersBase(object):
 _add('users', _UsersBase)
 
 
+class _PartitionedUsersBase(_UsersBase):
+    """Variant of the users table that can be partitioned by service.
+
+    MySQL requires the partitioning column to be part of every unique key,
+    so the service is included in the primary key.  Every query on the hot
+    path filters by service, so they each touch a single partition, and all
+    the records for a retired service can be dropped in one cheap operation
+    rather than deleted row by row.
+    """
+    service = Column(Integer(), primary_key=True, autoincrement=False,
+                     nullable=False)
+
+_add('partitioned_users', _PartitionedUsersBase)
+
+
+def _partition(service_id):
+    return 'PARTITION p%d VALUES IN (%d)' % (service_id, service_id)
+
+
+def partition_users_ddl(service_ids):
+    """DDL to partition an existing users table by the given services."""
+    partitions = ', '.join(_partition(id) for id in sorted(service_ids))
+    return 'ALTER TABLE users PARTITION BY LIST (service) (%s)' % partitions
+
+
+def add_users_partition_ddl(service_id):
+    """DDL to add the users table partition for a new service."""
+    return 'ALTER TABLE users ADD PARTITION (%s)' % _partition(service_id)
+
+
+def truncate_users_partition_ddl(service_id):
+    """DDL to drop all the users table records for a service."""
+    return 'ALTER TABLE users TRUNCATE PARTITION p%d' % service_id
+
+
 class _ServicesBase(object):
     """This table lists all the available services and their endpoint patterns.
 
@@ -8,6 +8,10 @@ This implementation provides the same interface as SQLMetadata, but uses
 a separate database for each service.  This can help with managing extremely
 high load, by keeping the sizes of each table smaller.
 """
+import sys
+import time
+import threading
+
 from mozsvc.exceptions import BackendError
 
 from sqlalchemy.ext.declarative import declarative_base
@@ -16,65 +20,296 @@ from sqlalchemy.pool import NullPool
 from sqlalchemy.sql import select
 
 from wimms.sql import SQLMetadata
+from wimms.deadline import get_deadline, deadline, with_timeout
 
 ENGINE_INDEX = 0
 SERVICES_INDEX = 1
 NODES_INDEX = 2
 USERS_INDEX = 3
 
+# The maximum number of shards to work on at once.
+MAX_SHARD_THREADS = 16
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def _refuse_connection():
+    raise BackendError('database was removed from the shard map')
+
+
+def _get_tables(is_sqlite, partition_users):
+    """Get the (services, nodes, users) tables for one kind of shard.
+
+    These aren't bound to any engine, so a single set of them is shared by
+    every shard of the same kind, and queries are always executed with an
+    explicit engine.
+    """
+    key = (is_sqlite, partition_users)
+    with _tables_lock:
+        tables = _tables.get(key)
+        if tables is None:
+            if is_sqlite:
+                from wimms.sqliteschemas import get_cls  # NOQA
+            else:
+                from wimms.schemas import get_cls   # NOQA
+            Base = declarative_base()
+            services = get_cls('services', Base)
+            nodes = get_cls('nodes', Base)
+            if partition_users:
+                users = get_cls('partitioned_users', Base, 'users')
+            else:
+                users = get_cls('users', Base)
+            tables = _tables[key] = (services, nodes, users)
+    return tables
+
+
+def _parallel_map(func, items):
+    """Call func on each of the items, using several threads.
+
+    The calling thread's deadline, if any, applies in each of the threads.
+    Returns the results in order, or re-raises the first error.
+    """
+    pending = list(enumerate(items))
+    results = [None] * len(pending)
+    errors = []
+    expires = get_deadline()
+
+    def worker():
+        while True:
+            try:
+                index, item = pending.pop()
+            except IndexError:
+                return
+            try:
+                if expires is None:
+                    results[index] = func(item)
+                else:
+                    with deadline(expires - time.time()):
+                        results[index] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(len(pending), MAX_SHARD_THREADS))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        exc_type, exc_value, tb = errors[0]
+        raise exc_type, exc_value, tb
+    return results
+
 
 class ShardedSQLMetadata(SQLMetadata):
 
     def __init__(self, databases, create_tables=False, pool_size=100,
                  pool_recycle=60, pool_timeout=30, max_overflow=10,
-                 pool_reset_on_return='rollback', **kw):
+                 pool_reset_on_return='rollback', partition_users=False,
+                 **kw):
 
         self._cached_service_ids = {}
-        # databases is a string containing one sqluri per service:
-        #   service1;sqluri1,service2;sqluri2
-        self._dbs = {}
+        self._init_features(**kw)
         if pool_reset_on_return.lower() in ('', 'none'):
             pool_reset_on_return = None
+        self._engine_options = {
+            'pool_size': pool_size,
+            'pool_recycle': pool_recycle,
+            'pool_timeout': pool_timeout,
+            'max_overflow': max_overflow,
+            'pool_reset_on_return': pool_reset_on_return,
+        }
+        self._echo = kw.get('echo', False)
+        self._partition_users_option = partition_users
 
+        # Engines are only created when a shard is first used, and shards
+        # with the same sqluri share an engine.
+        self._sqluris = self._parse_databases(databases)
+        self._engines = {}
+        self._dbs = {}
+        self._dbs_lock = threading.Lock()
+        self._set_backend_flags()
+
+        if create_tables:
+            self._create_all_tables()
+
+        self._start_snapshot_refresher()
+
+    def _parse_databases(self, databases):
+        """Parse a shard map into a dict mapping dbkeys to sqluris."""
+        # databases is a string containing one sqluri per service:
+        #   service1;sqluri1,service2;sqluri2
+        sqluris = {}
         for database in databases.split(','):
             database = database.split(';')
             service, sqluri = (el.strip() for el in database)
-            if self._dbkey(service) in self._dbs:
+            sqluris.setdefault(self._dbkey(service), sqluri)
+        return sqluris
+
+    def _set_backend_flags(self):
+        self._is_sqlite = all(self._is_sqlite_uri(sqluri)
+                              for sqluri in self._sqluris.values())
+        self._partition_users = self._partition_users_option and \
+            not self._is_sqlite
+
+    def _is_sqlite_uri(self, sqluri):
+        return sqluri.startswith('sqlite')
+
+    def _create_engine(self, sqluri):
+        if sqluri.startswith('mysql') or sqluri.startswith('pymysql'):
+            engine = create_engine(sqluri, logging_name='wimms',
+                                   **self._engine_options)
+        else:
+            # XXX will use a shared pool next
+            engine = create_engine(sqluri, poolclass=NullPool)
+        engine.echo = self._echo
+        return engine
+
+    def _get_db(self, dbkey):
+        """Get the (engine, services, nodes, users) tuple for a shard."""
+        try:
+            return self._dbs[dbkey]
+        except KeyError:
+            pass
+        with self._dbs_lock:
+            db = self._dbs.get(dbkey)
+            if db is None:
+                sqluri = self._sqluris[dbkey]
+                engine = self._engines.get(sqluri)
+                if engine is None:
+                    engine = self._engines[sqluri] = \
+                        self._create_engine(sqluri)
+                is_sqlite = self._is_sqlite_uri(sqluri)
+                partition_users = self._partition_users_option and \
+                    not is_sqlite
+                tables = _get_tables(is_sqlite, partition_users)
+                db = self._dbs[dbkey] = (engine,) + tables
+            return db
+
+    def _iter_dbs(self, dbkeys=None):
+        """Iterate over the (engine, services, nodes, users) of the shards.
+
+        Shards removed by a concurrent reload_databases() are skipped.
+        """
+        if dbkeys is None:
+            dbkeys = list(self._sqluris)
+        for dbkey in sorted(dbkeys):
+            try:
+                db = self._get_db(dbkey)
+            except KeyError:
                 continue
+            yield db
 
-            Base = declarative_base()
-            if sqluri.startswith('mysql') or sqluri.startswith('pymysql'):
-                engine = create_engine(
-                    sqluri,
-                    pool_size=pool_size,
-                    pool_recycle=pool_recycle,
-                    pool_timeout=pool_timeout,
-                    max_overflow=max_overflow,
-                    pool_reset_on_return=pool_reset_on_return,
-                    logging_name='wimms'
-                )
-            else:
-                # XXX will use a shared pool next
-                engine = create_engine(sqluri, poolclass=NullPool)
+    def _create_all_tables(self, dbkeys=None):
+        """Create any missing tables, checking the shards in parallel."""
+        # Shards sharing a database only need checking once.
+        dbs = {}
+        for db in self._iter_dbs(dbkeys):
+            dbs.setdefault(db[ENGINE_INDEX], db)
+        _parallel_map(lambda db: self._create_tables(*db), dbs.values())
 
-            engine.echo = kw.get('echo', False)
+    def _get_all_user_rows(self, email, services):
+        """Fetch the user's records from just the shards for the services.
 
-            self._is_sqlite = (engine.driver == 'pysqlite')
-            if self._is_sqlite:
-                from wimms.sqliteschemas import get_cls  # NOQA
-            else:
-                from wimms.schemas import get_cls   # NOQA
+        The shards are queried in parallel, unless within a session(),
+        whose connections can only be used by the calling thread.
+        """
+        services_by_db = {}
+        for service in services:
+            dbkey = self._dbkey(service)
+            services_by_db.setdefault(dbkey, []).append(service)
 
-            services = get_cls('services', Base)
-            nodes = get_cls('nodes', Base)
-            users = get_cls('users', Base)
+        def fetch(dbkey):
+            db = self._get_db(dbkey)
+            return self._fetch_all_user_rows(db[ENGINE_INDEX],
+                                             db[USERS_INDEX], email,
+                                             services_by_db[dbkey])
+
+        dbkeys = sorted(services_by_db)
+        if len(dbkeys) == 1 or self._get_session() is not None:
+            results = [fetch(key) for key in dbkeys]
+        else:
+            results = _parallel_map(fetch, dbkeys)
+        rows_by_service = {}
+        for result in results:
+            rows_by_service.update(result)
+        return rows_by_service
+
+    def reload_databases(self, databases, create_tables=False,
+                         drain_timeout=60):
+        """Switch over to a new shard map, without restarting.
+
+        'databases' has the same format as for the constructor.  Shards
+        whose sqluri is unchanged keep their engine and cached service ids.
+        Engines for new shards are created on first use as usual, and any
+        engines no longer used by any shard are disposed of once the
+        connections checked out from them have been returned, or after
+        'drain_timeout' seconds.  From then on they raise BackendError
+        rather than connect.  That happens in a background thread,
+        which is returned so callers can join() it if they need to.
+
+        If the user filter is enabled, it should be rebuilt afterwards to
+        pick up the users of any shards that moved.
+        """
+        sqluris = self._parse_databases(databases)
+        with self._dbs_lock:
+            old_sqluris = self._sqluris
+            changed = set(dbkey for dbkey in set(old_sqluris) | set(sqluris)
+                          if old_sqluris.get(dbkey) != sqluris.get(dbkey))
+            dbs = dict((dbkey, db) for dbkey, db in self._dbs.items()
+                       if dbkey not in changed)
+            engines = {}
+            removed = []
+            for sqluri, engine in self._engines.items():
+                if sqluri in sqluris.values():
+                    engines[sqluri] = engine
+                else:
+                    removed.append(engine)
+            # Swap everything over at once; lookups that don't take the
+            # lock only ever see either the old or the new self._dbs.
+            self._sqluris = sqluris
+            self._engines = engines
+            self._dbs = dbs
+            self._set_backend_flags()
+            for service in list(self._cached_service_ids):
+                if self._dbkey(service) in changed:
+                    self._cached_service_ids.pop(service, None)
+            self._endpoint_patterns.invalidate()
+
+        if create_tables:
+            self._create_all_tables(changed & set(sqluris))
 
-            for table in (services, nodes, users):
-                table.metadata.bind = engine
-                if create_tables:
-                    table.create(checkfirst=True)
+        if not removed:
+            return None
+        thread = threading.Thread(target=self._drain_engines,
+                                  args=(removed, drain_timeout))
+        thread.daemon = True
+        thread.start()
+        return thread
 
-            self._dbs[self._dbkey(service)] = (engine, services, nodes, users)
+    def _drain_engines(self, engines, timeout):
+        """Dispose of engines once their connections are all checked in."""
+        deadline = time.time() + timeout
+        for engine in engines:
+            # Only QueuePool keeps count of its checked-out connections;
+            # the NullPool used for sqlite closes them on checkin anyway.
+            checkedout = getattr(engine.pool, 'checkedout', None)
+            while checkedout is not None and checkedout() > 0 and \
+                    time.time() < deadline:
+                time.sleep(0.1)
+            # Engine.dispose() would put a fresh pool in place, which any
+            # thread still holding the old shard could connect through, and
+            # nothing would ever close those connections.
+            pool, engine.pool = engine.pool, NullPool(_refuse_connection)
+            pool.dispose()
+            with self._guards_lock:
+                self._guards.pop(engine, None)
+            with self._group_committers_lock:
+                self._group_committers.pop(engine, None)
+            with self._deadline_engines_lock:
+                self._deadline_engines.discard(engine)
 
     def _dbkey(self, service):
         """Strip version number, returning just the service name."""
@@ -83,10 +318,10 @@ class ShardedSQLMetadata(SQLMetadata):
     def _get_engine(self, service=None):
         if service is None:
             raise NotImplementedError()
-        return self._dbs[self._dbkey(service)][ENGINE_INDEX]
+        return self._get_db(self._dbkey(service))[ENGINE_INDEX]
 
     def _get_table(self, service, index):
-        return self._dbs[self._dbkey(service)][index]
+        return self._get_db(self._dbkey(service))[index]
 
     def _get_services_table(self, service):
         return self._get_table(service, SERVICES_INDEX)
@@ -97,12 +332,13 @@ class ShardedSQLMetadata(SQLMetadata):
     def _get_users_table(self, service):
         return self._get_table(service, USERS_INDEX)
 
+    @with_timeout
     def get_patterns(self):
         """Returns all the service URL patterns."""
         # loop on all the tables to combine the pattern information.
         patterns = []
-        for service, elements in self._dbs.items():
-            engine = elements[0]
+        for elements in self._iter_dbs():
+            engine = elements[ENGINE_INDEX]
             table = elements[SERVICES_INDEX]
             try:
                 res = self._safe_execute(select([table]), engine=engine)
@@ -117,13 +353,15 @@ class ShardedSQLMetadata(SQLMetadata):
                 res.close()
         return patterns
 
+    @with_timeout
     def add_service(self, service, pattern):
         """Add definition for a new service."""
         engine = self._get_engine(service)
         return super(ShardedSQLMetadata, self).add_service(service, pattern,
                                                            engine=engine)
 
+    @with_timeout
     def retire_user(self, email):
-        for service, elements in self._dbs.items():
-            engine = elements[0]
+        for elements in self._iter_dbs():
+            engine = elements[ENGINE_INDEX]
             super(ShardedSQLMetadata, self).retire_user(email, engine=engine)
@@ -0,0 +1,73 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+In-process coalescing of concurrent identical calls.
+
+If a call for some key is already in flight when another thread asks for
+the same key, the second thread just waits for the first call to finish
+and shares its result, rather than repeating the work.
+
+The second thread only waits for as long as its own deadline allows, and
+if the first call fails by running out of its deadline, the second makes
+the call again rather than sharing the error.
+"""
+import sys
+import threading
+
+from wimms.deadline import DeadlineExceeded, time_left, is_expired
+
+
+class _Call(object):
+
+    __slots__ = ('result', 'exc_info', 'done')
+
+    def __init__(self):
+        self.result = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+
+class SingleFlight(object):
+    """Runs at most one call per key at a time, sharing its result."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, func, *args, **kwds):
+        """Call func(*args, **kwds), or wait for an in-flight call for key.
+
+        All the callers for a key get back the very same result object, so
+        it should be copied before being modified.
+        """
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            if call is None:
+                leader = True
+                call = self._calls[key] = _Call()
+            else:
+                leader = False
+                self.coalesced += 1
+        if leader:
+            try:
+                call.result = func(*args, **kwds)
+            except Exception:
+                call.exc_info = sys.exc_info()
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        elif not call.done.wait(time_left()):
+            raise DeadlineExceeded('deadline exceeded')
+        if call.exc_info is not None:
+            exc_type, exc_value, tb = call.exc_info
+            if not leader and issubclass(exc_type, DeadlineExceeded) and \
+                    not is_expired():
+                # The call ran out of the first caller's time, not ours.
+                return self.do(key, func, *args, **kwds)
+            raise exc_type, exc_value, tb
+        return call.result
@@ -0,0 +1,180 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+Capture of slow statements.
+
+The database's own slow log can't tell which wimms call a statement came
+from.  When a statement takes longer than the configured threshold, the
+backends record its name, the wimms method that ran it, its parameters with
+any email addresses hashed, and how long it took, along with the query plan
+of a sample of the slow SELECTs.  The time taken includes fetching the rows
+of the statement's result.  Records are kept in a bounded ring buffer that
+can be read or dumped as newline-delimited JSON.
+
+Email addresses are hashed with an HMAC keyed by a secret, so that they
+can't be recovered by hashing a list of known addresses.  The same secret
+should be configured on every host for their tokens to match; without one,
+each process uses a random secret of its own.
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import random
+import hashlib
+import threading
+from collections import deque
+
+
+def hash_email(email, secret):
+    """Get a stable token standing for an email address in the log."""
+    if isinstance(email, unicode):
+        email = email.encode('utf8')
+    return 'hmac-sha256:' + hmac.new(secret, email, hashlib.sha256).hexdigest()
+
+
+def redact_params(params, secret):
+    """Copy statement parameters, with the values of email keys hashed."""
+    redacted = {}
+    for key, value in params.items():
+        if 'email' in key and value is not None:
+            if isinstance(value, (list, tuple, set)):
+                value = [hash_email(item, secret) for item in value]
+            else:
+                value = hash_email(value, secret)
+        redacted[key] = value
+    return redacted
+
+
+def calling_method():
+    """Get the name of the outermost wimms function on the stack.
+
+    That is normally the public backend method called by the application.
+    """
+    name = None
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.startswith('wimms.') and module != 'wimms.deadline' and \
+                not module.startswith('wimms.tests'):
+            name = frame.f_code.co_name
+        frame = frame.f_back
+    return name
+
+
+class TimedResult(object):
+    """Wraps the result of a statement, to time the fetching of its rows.
+
+    'report' is called with the time taken since 'start', and the error if
+    any, once the result is closed or all its rows have been read.
+    """
+
+    def __init__(self, result, start, report):
+        self._result = result
+        self._start = start
+        self._report = report
+
+    def __getattr__(self, name):
+        return getattr(self._result, name)
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def fetchone(self):
+        return self._call('fetchone')
+
+    def fetchmany(self, size=None):
+        return self._call('fetchmany', size)
+
+    def fetchall(self):
+        return self._call('fetchall')
+
+    def first(self):
+        return self._call('first')
+
+    def scalar(self):
+        return self._call('scalar')
+
+    def close(self):
+        return self._call('close')
+
+    def _call(self, name, *args):
+        try:
+            value = getattr(self._result, name)(*args)
+        except Exception, exc:
+            exc_info = sys.exc_info()
+            self._done(exc)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if self._result.closed:
+            self._done()
+        return value
+
+    def _done(self, error=None):
+        report, self._report = self._report, None
+        if report is not None:
+            report(time.time() - self._start, error)
+
+
+class SlowQueryLog(object):
+    """Keeps the last 'size' statements that took 'threshold' seconds or more.
+
+    'explain_rate' is the fraction of the slow SELECTs whose query plan
+    should be captured as well, and 'secret' the key used to hash email
+    addresses.
+    """
+
+    def __init__(self, threshold, size=100, explain_rate=0, secret=None):
+        self.threshold = threshold
+        self.explain_rate = explain_rate
+        if secret is None:
+            secret = os.urandom(32)
+        elif isinstance(secret, unicode):
+            secret = secret.encode('utf8')
+        self.secret = secret
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.recorded = 0
+
+    def should_explain(self):
+        return self.explain_rate and random.random() < self.explain_rate
+
+    def redact(self, params):
+        return redact_params(params, self.secret)
+
+    def record(self, statement, method, params, duration, error=None,
+               plan=None):
+        entry = {
+            'timestamp': time.time(),
+            'statement': statement,
+            'method': method,
+            'params': params,
+            'duration': duration,
+            'error': error,
+            'plan': plan,
+        }
+        with self._lock:
+            self._entries.append(entry)
+            self.recorded += 1
+        return entry
+
+    def get_entries(self):
+        """Get the recorded statements, oldest first."""
+        with self._lock:
+            return list(self._entries)
+
+    def dump(self, stream):
+        """Write the recorded statements to the stream as NDJSON.
+
+        Returns the number of statements written.
+        """
+        entries = self.get_entries()
+        for entry in entries:
+            stream.write(json.dumps(entry, default=repr))
+            stream.write('\n')
+        return len(entries)
@@ -0,0 +1,138 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+A snapshot of the services and nodes tables, shared between processes.
+
+Pre-forked workers on the same host each keep their own caches, so without
+this every one of them has to look up each service id itself, and every
+node allocation re-reads the nodes table.  A SharedSnapshot lives in a
+memory-mapped file: one process periodically writes the current contents
+of the two tables into it, and all the others read them from there without
+any queries or locks.
+
+Consistency is ensured with a sequence lock.  The writer makes the sequence
+number odd while it updates the data and its length, and only makes it even
+again once they are both written, and a reader retries if the number was
+odd or changed while it was reading.
+Readers keep the decoded data for the last sequence number they saw, so the
+common case costs one small read from the mapping.
+"""
+import os
+import json
+import mmap
+import time
+import fcntl
+import struct
+
+
+# sequence number, time of last update, length of the data.
+_HEADER = struct.Struct('<QdI')
+_SEQUENCE = struct.Struct('<Q')
+_INFO = struct.Struct('<dI')
+
+# How many times a reader retries while the writer is busy.
+_READ_ATTEMPTS = 100
+
+
+class SharedSnapshot(object):
+    """JSON-encodable data shared between processes through a mapped file.
+
+    Only one process at a time may write to the snapshot, which it ensures
+    by calling acquire_writer() and only writing if that returned True.
+    """
+
+    def __init__(self, path, size=1024 * 1024):
+        self.path = path
+        self.size = size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        except Exception:
+            os.close(fd)
+            raise
+        self._fd = fd
+        self._lock_fd = None
+        self._writer_pid = None
+        self._seq = None
+        self._data = None
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def acquire_writer(self):
+        """Try to become the only process writing to the snapshot.
+
+        Returns True if this process holds the write lock, which it keeps
+        for as long as it has the snapshot open.
+        """
+        pid = os.getpid()
+        if self._writer_pid != pid:
+            if self._lock_fd is not None:
+                # Inherited from the process this one was forked from,
+                # which is still the writer.
+                os.close(self._lock_fd)
+                self._lock_fd = None
+            # flock() locks are shared by every process that inherits the
+            # descriptor, so each process opens the file for itself.
+            fd = os.open(self.path, os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                os.close(fd)
+                return False
+            self._lock_fd = fd
+            self._writer_pid = pid
+        return True
+
+    def write(self, data):
+        payload = json.dumps(data, separators=(',', ':'))
+        if _HEADER.size + len(payload) > self.size:
+            raise ValueError('snapshot is too large (%d bytes)'
+                             % len(payload))
+        seq = _SEQUENCE.unpack_from(self._mmap, 0)[0]
+        if seq & 1:
+            # A previous writer died half-way through.
+            seq += 1
+        _SEQUENCE.pack_into(self._mmap, 0, seq + 1)
+        self._mmap[_HEADER.size:_HEADER.size + len(payload)] = payload
+        _INFO.pack_into(self._mmap, _SEQUENCE.size, time.time(), len(payload))
+        _SEQUENCE.pack_into(self._mmap, 0, seq + 2)
+
+    def read(self, max_age=None):
+        """Get the snapshot data, or None if it's missing or too old.
+
+        None is also returned if the writer kept changing the data for the
+        whole time spent trying to read it.
+        """
+        for _ in xrange(_READ_ATTEMPTS):
+            seq, updated_at, length = _HEADER.unpack_from(self._mmap, 0)
+            if seq == 0:
+                return None
+            if seq & 1:
+                time.sleep(0)
+                continue
+            if max_age is not None and time.time() - updated_at > max_age:
+                return None
+            if seq == self._seq:
+                return self._data
+            if _HEADER.size + length > self.size:
+                # Read half-way through an update of the header.
+                continue
+            payload = self._mmap[_HEADER.size:_HEADER.size + length]
+            if _SEQUENCE.unpack_from(self._mmap, 0)[0] != seq:
+                continue
+            try:
+                data = json.loads(payload)
+            except ValueError:
+                continue
+            self._data = data
+            self._seq = seq
+            return data
+        return None
@@ -8,18 +8,53 @@ For each available service, we maintain a list of user accounts and their
 associated uid, node-assignment and metadata.  We also have a list of nodes
 with their load, capacity etc
 """
+import os
+import sys
+import math
 import time
+import heapq
+import random
+import functools
+import inspect
+import itertools
+import threading
 import traceback
+from operator import itemgetter
+from contextlib import contextmanager
 from mozsvc.exceptions import BackendError
 
 from sqlalchemy.sql import select, update, and_
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Connection
 from sqlalchemy.pool import NullPool
 from sqlalchemy.sql import text as sqltext, func as sqlfunc
+from sqlalchemy.sql.expression import TextClause, Select, UpdateBase
 from sqlalchemy.exc import OperationalError, TimeoutError
 
 from wimms import logger
+from wimms.groupcommit import GroupCommitter
+from wimms.singleflight import SingleFlight
+from wimms.bloom import UserFilter
+from wimms.breaker import (CircuitBreaker, CircuitOpenError,
+                           ConcurrencyLimiter)
+from wimms.deadline import get_deadline, with_timeout, DeadlineExceeded
+from wimms.snapshot import SharedSnapshot
+from wimms.endpoints import EndpointPatterns
+from wimms.slowlog import SlowQueryLog, TimedResult, calling_method
+from wimms.profiling import Profiler
+from wimms.schemas import (partition_users_ddl, add_users_partition_ddl,
+                           truncate_users_partition_ddl)
+
+
+# MySQL error codes for a statement that was cut short by one of the
+# timeouts we set: lock wait timeout, max_execution_time exceeded,
+# query interrupted, and MariaDB's max_statement_time exceeded.
+_MYSQL_TIMEOUT_ERRORS = (1205, 3024, 1317, 1969)
+
+# How much later than needed a driver timeout already set on a connection
+# may expire before it's worth a round trip to change it.
+_TIMEOUT_SLACK = 0.1
 
 
 # The maximum possible generation number.
@@ -32,12 +67,158 @@ def get_timestamp():
     return int(time.time() * 1000)
 
 
+def _grace_period_cutoff(grace_period, now=None):
+    """Get the timestamp before which replaced records may be cleaned up."""
+    if grace_period < 0:
+        grace_period = 60 * 60 * 24 * 7  # one week, in seconds
+    grace_period = int(grace_period * 1000)  # convert seconds -> millis
+    if now is None:
+        now = get_timestamp()
+    return now - grace_period
+
+
+class UserRecord(object):
+    """Compact record describing a user's current node assignment.
+
+    This supports the same item access as the plain dicts that get_user()
+    used to return, so callers can keep doing user['node'] etc, but it
+    uses __slots__ to avoid allocating a per-instance dict.
+    """
+
+    __slots__ = ('email', 'uid', 'node', 'generation', 'client_state',
+                 'old_client_states')
+
+    def __init__(self, email, uid, node, generation, client_state,
+                 old_client_states=None):
+        self.email = email
+        self.uid = uid
+        self.node = node
+        self.generation = generation
+        self.client_state = client_state
+        if old_client_states is None:
+            old_client_states = {}
+        self.old_client_states = old_client_states
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def get(self, key, default=None):
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+    def copy(self):
+        return UserRecord(self.email, self.uid, self.node, self.generation,
+                          self.client_state, dict(self.old_client_states))
+
+    def __eq__(self, other):
+        if isinstance(other, (UserRecord, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<UserRecord %r>' % (dict(self.items()),)
+
+
 _Base = declarative_base()
+# The partitioned users table has a different primary key than the plain
+# one, so it needs metadata of its own.
+_PartitionedBase = declarative_base()
+
+
+def pack_client_states(client_states):
+    """Pack a collection of client-state strings into a single string.
+
+    Each value is terminated by a comma, so that an empty collection and a
+    collection containing just the empty string can be told apart.  That
+    means the values themselves can't contain commas.
+    """
+    for state in client_states:
+        check_client_state(state)
+    return ''.join(state + ',' for state in sorted(client_states))
+
+
+def check_client_state(client_state):
+    """Reject client-state strings that pack_client_states() can't store."""
+    if client_state and ',' in client_state:
+        raise BackendError('invalid client-state string')
+
+
+def unpack_client_states(packed):
+    """Unpack a list of client-state strings from pack_client_states()."""
+    if not packed:
+        return []
+    return packed.split(',')[:-1]
+
+
+# Column positions in the raw rows fetched by _GET_USER_RECORDS.
+(_UID, _NODE, _GENERATION, _CLIENT_STATE, _CREATED_AT, _REPLACED_AT,
+ _HISTORY) = range(7)
+
+_generation_key = itemgetter(_GENERATION)
+_current_row_key = itemgetter(_GENERATION, _CREATED_AT, _UID)
+
+# Indexes of the fields of each node in the shared snapshot.
+(_NODE_NAME, _NODE_AVAILABLE, _NODE_LOAD, _NODE_CAPACITY,
+ _NODE_DOWNED) = range(5)
+
+
+# Each record stores the client-state values previously seen for the user,
+# so normally we only need to read the active record.  Retired records are
+# included so they take precedence over any that raced with the retirement.
+_GET_CURRENT_USER_RECORDS = sqltext("""\
+select
+    uid, node, generation, client_state, created_at, replaced_at,
+    client_state_history
+from
+    users
+where
+    email = :email
+and
+    service = :service
+and
+    (replaced_at is null or generation = :max_generation)
+order by
+    created_at desc, uid desc
+limit
+    20
+""")
 
 
 _GET_USER_RECORDS = sqltext("""\
 select
-    uid, node, generation, client_state, created_at, replaced_at
+    uid, node, generation, client_state, created_at, replaced_at,
+    client_state_history
 from
     users
 where
@@ -54,9 +235,22 @@ limit
 _CREATE_USER_RECORD = sqltext("""\
 insert into
     users
-    (service, email, node, generation, client_state, created_at, replaced_at)
+    (service, email, node, generation, client_state, created_at, replaced_at,
+     client_state_history)
 values
-    (:service, :email, :node, :generation, :client_state, :timestamp, NULL)
+    (:service, :email, :node, :generation, :client_state, :timestamp, NULL,
+     :client_state_history)
+""")
+
+
+_IMPORT_USER_RECORD = sqltext("""\
+insert into
+    users
+    (service, email, node, generation, client_state, created_at, replaced_at,
+     client_state_history)
+values
+    (:service, :email, :node, :generation, :client_state, :created_at,
+     :replaced_at, :client_state_history)
 """)
 
 
@@ -98,7 +292,7 @@ where
 
 _GET_OLD_USER_RECORDS_FOR_SERVICE = sqltext("""\
 select
-    uid, node
+    uid, node, email
 from
     users
 where
@@ -114,7 +308,8 @@ limit
 
 _GET_ALL_USER_RECORDS_FOR_SERVICE = sqltext("""\
 select
-    uid, node
+    uid, node, generation, client_state, created_at, replaced_at,
+    client_state_history
 from
     users
 where
@@ -126,6 +321,59 @@ order by
 """)
 
 
+# Keyset pagination over node_idx, for streaming out a node's assignments.
+_GET_NODE_USER_RECORDS = sqltext("""\
+select
+    uid, email, node, generation, client_state, created_at, replaced_at,
+    client_state_history
+from
+    users
+where
+    service = :service
+and
+    node = :node
+and
+    uid > :last_uid
+and
+    (replaced_at is null or :include_replaced)
+order by
+    uid
+limit
+    :limit
+""")
+
+
+_GET_SERVICE_USER_RECORDS = sqltext("""\
+select
+    uid, email, node, generation, client_state, created_at, replaced_at,
+    client_state_history
+from
+    users
+where
+    service = :service
+and
+    uid > :last_uid
+and
+    (replaced_at is null or :include_replaced)
+order by
+    uid
+limit
+    :limit
+""")
+
+
+_UPDATE_CLIENT_STATE_HISTORY = sqltext("""\
+update
+    users
+set
+    client_state_history = :client_state_history
+where
+    service = :service
+and
+    uid = :uid
+""")
+
+
 _REPLACE_USER_RECORD = sqltext("""\
 update
     users
@@ -138,6 +386,40 @@ and
 """)
 
 
+# Only replace a record that is still current, so that a batch operation
+# working from rows read earlier doesn't clobber a concurrent update.
+_REPLACE_CURRENT_USER_RECORD = sqltext("""\
+update
+    users
+set
+    replaced_at = :timestamp
+where
+    service = :service
+and
+    uid = :uid
+and
+    replaced_at is null
+""")
+
+
+# Whether the user has a record created after the given one, in the order
+# used by get_user() to pick the current record among those of the same
+# generation.
+_GET_NEWER_USER_RECORD = sqltext("""\
+select
+    uid
+from
+    users
+where
+    service = :service
+and
+    email = :email
+and
+    (created_at > :created_at or (created_at = :created_at and uid > :uid))
+limit 1
+""")
+
+
 _DELETE_USER_RECORD = sqltext("""\
 delete from
     users
@@ -148,16 +430,139 @@ and
 """)
 
 
+_GET_NODE_LOADS = sqltext("""\
+select
+    node, available, capacity, current_load
+from
+    nodes
+where
+    service = :service
+and
+    downed = 0
+""")
+
+
+# Apply the load from several new assignments to a node at once.
+_ADD_NODE_LOAD = sqltext("""\
+update
+    nodes
+set
+    available = available - :count,
+    current_load = current_load + :count
+where
+    service = :service
+and
+    node = :node
+""")
+
+
 WRITEABLE_FIELDS = ['available', 'current_load', 'capacity', 'downed',
                     'backoff']
 
 
+class _NodeAllocator(object):
+    """Assigns users to nodes in memory, mirroring get_best_node().
+
+    This lets the batch operations spread many users across the available
+    nodes while reading the nodes table only once per batch.  Nodes are
+    ordered by current_load / capacity, as get_best_node() does on sqlite;
+    on MySQL it compares the logarithms, which can order them differently.
+    """
+
+    def __init__(self, rows):
+        self._heap = []
+        for node, available, capacity, current_load in rows:
+            self._push(str(node), available, capacity, current_load)
+
+    def _push(self, node, available, capacity, current_load):
+        if available > 0 and capacity > current_load:
+            load = current_load * 1.0 / capacity
+            entry = (load, node, available, capacity, current_load)
+            heapq.heappush(self._heap, entry)
+
+    def allocate(self):
+        """Returns the least loaded node, and accounts for the new user."""
+        if not self._heap:
+            raise BackendError('unable to get a node')
+        _, node, available, capacity, current_load = heapq.heappop(self._heap)
+        self._push(node, available - 1, capacity, current_load + 1)
+        return node
+
+
+# Public methods that are left alone by the profiler.
+_UNPROFILED_METHODS = ('session', 'get_profile_stats', 'dump_profile')
+
+_statement_names = None
+
+
+def _statement_name(statement):
+    """Get a short name for a statement, for the slow query log."""
+    global _statement_names
+    if _statement_names is None:
+        _statement_names = dict((id(value), name)
+                                for name, value in globals().items()
+                                if isinstance(value, TextClause))
+    name = _statement_names.get(id(statement))
+    if name is not None:
+        return name
+    if isinstance(statement, Select):
+        return 'select from ' + ', '.join(str(from_.description)
+                                          for from_ in statement.froms)
+    if isinstance(statement, UpdateBase):
+        return '%s %s' % (statement.__visit_name__, statement.table.name)
+    text = getattr(statement, 'text', statement)
+    return ' '.join(unicode(text).split())[:80]
+
+
+def _is_select(statement):
+    if isinstance(statement, Select):
+        return True
+    text = getattr(statement, 'text', statement)
+    return isinstance(text, basestring) and \
+        text.lstrip().lower().startswith('select')
+
+
+def _is_mariadb(dialect):
+    return 'MariaDB' in (getattr(dialect, 'server_version_info', None) or ())
+
+
+class _Session(object):
+    """The connections pinned by SQLMetadata.session(), one per engine."""
+
+    def __init__(self, transaction):
+        self.transaction = transaction
+        self.connections = {}
+        self.transactions = []
+
+    def get_connection(self, engine):
+        connection = self.connections.get(engine)
+        if connection is None:
+            connection = engine.connect()
+            self.connections[engine] = connection
+            if self.transaction:
+                self.transactions.append(connection.begin())
+        return connection
+
+    def close(self, commit):
+        try:
+            for transaction in self.transactions:
+                if commit:
+                    transaction.commit()
+                else:
+                    transaction.rollback()
+        finally:
+            for connection in self.connections.values():
+                connection.close()
+
+
 class SQLMetadata(object):
 
     def __init__(self, sqluri, create_tables=False, pool_size=100,
                  pool_recycle=60, pool_timeout=30, max_overflow=10,
-                 pool_reset_on_return='rollback', **kw):
+                 pool_reset_on_return='rollback', partition_users=False,
+                 **kw):
         self._cached_service_ids = {}
+        self._init_features(**kw)
         self.sqluri = sqluri
         if pool_reset_on_return.lower() in ('', 'none'):
             pool_reset_on_return = None
@@ -183,18 +588,152 @@ class SQLMetadata(object):
         else:
             from wimms.schemas import get_cls  # NOQA
 
-        self.services = get_cls('services', _Base)
-        self.nodes = get_cls('nodes', _Base)
-        self.users = get_cls('users', _Base)
+        # Partitioning is a MySQL feature; on sqlite we just use a
+        # plain table and fall back to row-by-row deletes.
+        self._partition_users = partition_users and not self._is_sqlite
+
+        base = _PartitionedBase if self._partition_users else _Base
+        self.services = get_cls('services', base)
+        self.nodes = get_cls('nodes', base)
+        if self._partition_users:
+            self.users = get_cls('partitioned_users', base, 'users')
+        else:
+            self.users = get_cls('users', base)
 
         for table in (self.services, self.nodes, self.users):
             table.metadata.bind = self._engine
-            if create_tables:
-                table.create(checkfirst=True)
+
+        if create_tables:
+            self._create_tables(self._engine, self.services, self.nodes,
+                                self.users)
+
+        self._start_snapshot_refresher()
+
+    def _create_tables(self, engine, services, nodes, users):
+        """Create any missing tables in the given database."""
+        for table in (services, nodes, users):
+            table.create(engine, checkfirst=True)
+        if self._partition_users:
+            self._create_users_partitions(engine, services)
+
+    def _init_features(self, group_commit_delay=0, coalesce_requests=False,
+                       user_filter_capacity=0, user_filter_error_rate=0.01,
+                       breaker_failure_rate=0, breaker_min_calls=20,
+                       breaker_window=10, breaker_reset_timeout=30,
+                       max_inflight=0, max_queued=0, queue_timeout=1.0,
+                       snapshot_file=None, snapshot_size=1024 * 1024,
+                       snapshot_max_age=60, snapshot_refresh_interval=0,
+                       endpoint_patterns_max_age=300, slow_query_threshold=0,
+                       slow_query_log_size=100, slow_query_explain_rate=0,
+                       slow_query_secret=None, profile=False,
+                       profile_sample_rate=0, profile_signal=None,
+                       profile_dump_path='/tmp/wimms-profile.%(pid)d',
+                       **kw):
+        """Set up the optional features shared by all implementations."""
+        self._group_commit_delay = float(group_commit_delay)
+        self._group_committers = {}
+        self._group_committers_lock = threading.Lock()
+        self._singleflight = SingleFlight() if coalesce_requests else None
+        self._user_filter = None
+        if user_filter_capacity:
+            self._user_filter = UserFilter(int(user_filter_capacity),
+                                           float(user_filter_error_rate))
+        # Circuit breakers and concurrency limits are kept per engine,
+        # so that one struggling shard doesn't affect the others.
+        self._breaker_options = None
+        if float(breaker_failure_rate):
+            self._breaker_options = {
+                'failure_rate': float(breaker_failure_rate),
+                'min_calls': int(breaker_min_calls),
+                'window': int(breaker_window),
+                'reset_timeout': float(breaker_reset_timeout),
+            }
+        self._limiter_options = None
+        if int(max_inflight):
+            self._limiter_options = {
+                'max_inflight': int(max_inflight),
+                'max_queued': int(max_queued),
+                'queue_timeout': float(queue_timeout),
+            }
+        self._guards = {}
+        self._guards_lock = threading.Lock()
+        # The services and nodes can be read from a snapshot shared by all
+        # processes on the host, see wimms.snapshot.
+        self._snapshot = None
+        if snapshot_file:
+            self._snapshot = SharedSnapshot(snapshot_file, int(snapshot_size))
+        self._snapshot_max_age = float(snapshot_max_age)
+        self._snapshot_refresh_interval = float(snapshot_refresh_interval)
+        self._deadline_engines = set()
+        self._deadline_engines_lock = threading.Lock()
+        self._sessions = threading.local()
+        self._endpoint_patterns = EndpointPatterns(
+            self._load_endpoint_patterns, float(endpoint_patterns_max_age))
+        self._slow_query_log = None
+        if float(slow_query_threshold):
+            self._slow_query_log = SlowQueryLog(
+                float(slow_query_threshold), int(slow_query_log_size),
+                float(slow_query_explain_rate), slow_query_secret)
+        # Profiling can also be turned on without touching the config.
+        self._profiler = None
+        if profile or os.environ.get('WIMMS_PROFILE', '0') not in ('', '0'):
+            self._profiler = Profiler(float(profile_sample_rate))
+            self._profile_methods(self._profiler)
+            if profile_signal:
+                self._profiler.dump_on_signal(profile_signal,
+                                              profile_dump_path)
+
+    def _profile_methods(self, profiler):
+        """Replace the public methods with profiled versions."""
+        cls = type(self)
+        for name in dir(cls):
+            if name.startswith('_') or name in _UNPROFILED_METHODS:
+                continue
+            if inspect.ismethod(getattr(cls, name)):
+                setattr(self, name, profiler.wrap(name, getattr(self, name)))
+
+    def _start_snapshot_refresher(self):
+        """Start refreshing the shared snapshot, if so configured.
+
+        Every process may run a refresher, but only the one that manages
+        to become the snapshot's writer actually does any work; the others
+        stand by in case it goes away.
+        """
+        if self._snapshot is None or not self._snapshot_refresh_interval:
+            return
+
+        def refresh():
+            while True:
+                if self._snapshot.acquire_writer():
+                    try:
+                        self.refresh_snapshot()
+                    except Exception:
+                        logger.error(traceback.format_exc())
+                time.sleep(self._snapshot_refresh_interval)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
 
     def _get_engine(self, service=None):
         return self._engine
 
+    def _get_guards(self, engine):
+        """Get the (breaker, limiter) pair protecting the given engine."""
+        try:
+            return self._guards[engine]
+        except KeyError:
+            with self._guards_lock:
+                guards = self._guards.get(engine)
+                if guards is None:
+                    breaker = limiter = None
+                    if self._breaker_options is not None:
+                        breaker = CircuitBreaker(**self._breaker_options)
+                    if self._limiter_options is not None:
+                        limiter = ConcurrencyLimiter(**self._limiter_options)
+                    guards = self._guards[engine] = (breaker, limiter)
+            return guards
+
     def _safe_execute(self, *args, **kwds):
         """Execute an sqlalchemy query, raise BackendError on failure."""
         if hasattr(args[0], 'bind'):
@@ -210,79 +749,612 @@ class SQLMetadata(object):
         if 'service' in kwds:
             kwds['service'] = self._get_service_id(kwds['service'])
 
+        # Don't bother the database when the caller has run out of time.
+        expires = get_deadline()
+        if expires is not None and expires <= time.time():
+            raise DeadlineExceeded('deadline exceeded')
+
+        execute = self._execute
+        if self._slow_query_log is not None:
+            execute = self._execute_and_log_slow
+        if self._profiler is not None:
+            execute = functools.partial(self._profiler.time_statement,
+                                        execute)
+
+        if self._breaker_options is None and self._limiter_options is None:
+            return execute(engine, args, kwds)
+
+        # Connections share the guards of the engine they came from.
+        breaker, limiter = self._get_guards(engine.engine)
+        # Take a slot first, so that a half-open breaker's trial call can't
+        # then be turned away by the limiter and never report back.
+        if limiter is not None:
+            limiter.acquire()
+        if breaker is not None:
+            try:
+                breaker.before_call()
+            except CircuitOpenError:
+                if limiter is not None:
+                    limiter.release()
+                raise
+        success = True
         try:
-            return engine.execute(*args, **kwds)
+            return execute(engine, args, kwds)
+        except BackendError:
+            success = False
+            raise
+        finally:
+            if limiter is not None:
+                limiter.release()
+            if breaker is not None:
+                breaker.after_call(success)
+
+    def _execute(self, engine, args, kwds):
+        expires = get_deadline()
+        try:
+            session = self._get_session()
+            if session is not None and not isinstance(engine, Connection):
+                engine = session.get_connection(engine)
+            if expires is None:
+                return engine.execute(*args, **kwds)
+            pinned = session is not None and \
+                engine in session.connections.values()
+            return self._execute_with_deadline(engine, expires, args, kwds,
+                                               pinned)
         except (OperationalError, TimeoutError), exc:
             err = traceback.format_exc()
             logger.error(err)
+            if expires is not None and (expires <= time.time() or
+                                        self._is_timeout_error(exc)):
+                raise DeadlineExceeded(str(exc))
             raise BackendError(str(exc))
 
-    def get_user(self, service, email):
-        params = {'service': service, 'email': email}
-        res = self._safe_execute(_GET_USER_RECORDS, **params)
+    def _execute_and_log_slow(self, engine, args, kwds):
+        """Run _execute(), recording the statement if it's slow."""
+        start = time.time()
+        try:
+            result = self._execute(engine, args, kwds)
+        except Exception, exc:
+            exc_info = sys.exc_info()
+            self._check_slow_query(engine, args, kwds, time.time() - start,
+                                   exc)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if result.returns_rows and not result.closed:
+            # The rows may take a while to stream in as well.
+            return TimedResult(result, start, functools.partial(
+                self._check_slow_query, engine, args, kwds))
+        self._check_slow_query(engine, args, kwds, time.time() - start)
+        return result
+
+    def _check_slow_query(self, engine, args, kwds, duration, error=None):
+        log = self._slow_query_log
+        if duration < log.threshold:
+            return
+        try:
+            statement = args[0]
+            if len(args) > 1:
+                params = {'executemany': len(args[1])}
+            else:
+                params = {}
+                if not isinstance(statement, basestring):
+                    params.update(statement.compile().params)
+                params.update(kwds)
+            plan = None
+            if error is None and _is_select(statement) and \
+                    log.should_explain():
+                plan = self._explain(engine, statement, kwds)
+            log.record(_statement_name(statement), calling_method(),
+                       log.redact(params), duration,
+                       None if error is None else str(error), plan)
+        except Exception:
+            logger.error(traceback.format_exc())
+
+    def _explain(self, engine, statement, params):
+        """Get the query plan of a SELECT statement."""
+        dialect = engine.dialect
+        if dialect.name == 'sqlite':
+            prefix = 'EXPLAIN QUERY PLAN '
+        else:
+            prefix = 'EXPLAIN '
+        if isinstance(statement, basestring):
+            statement = sqltext(statement)
+        compiled = statement.compile(dialect=dialect)
+        params = compiled.construct_params(params)
+        if compiled.positional:
+            params = [params[name] for name in compiled.positiontup]
+        session = self._get_session()
+        if isinstance(engine, Connection) and engine.closed:
+            # The statement's rows were read after its block ended.
+            engine = engine.engine
+        if session is not None and not isinstance(engine, Connection):
+            engine = session.get_connection(engine)
+        if isinstance(engine, Connection):
+            connection = engine.connection
+            owned = False
+        else:
+            connection = engine.raw_connection()
+            owned = True
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(prefix + unicode(compiled), params)
+                return [list(row) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+        finally:
+            if owned:
+                connection.close()
+
+    def _execute_with_deadline(self, engine, expires, args, kwds,
+                               pinned=False):
+        """Execute a query with the driver's timeouts set to the deadline.
+
+        The timeouts are left in place until the connection goes back to
+        the pool, where they are reset by _reset_statement_timeout(), so
+        later statements only change them when their deadline differs.
+        sqlite's progress handler is removed straight away though, as it
+        would otherwise interrupt the fetching of the rows as well.
+
+        A connection pinned by session() may not go back to the pool until
+        well after the call that set the deadline, so its timeouts are
+        reset after each statement instead.
+        """
+        if isinstance(engine, Connection):
+            connection = engine
+            owned = False
+        else:
+            connection = engine.contextual_connect(close_with_result=True)
+            owned = True
+        try:
+            self._set_statement_timeout(connection, expires)
+            try:
+                return connection.execute(*args, **kwds)
+            finally:
+                # Unless the result already sent it back to the pool.
+                if not connection.closed and not connection.invalidated:
+                    if pinned:
+                        self._clear_statement_timeout(connection)
+                    elif connection.dialect.name == 'sqlite':
+                        dbapi_connection = connection.connection.connection
+                        dbapi_connection.set_progress_handler(None, 0)
+        except Exception:
+            if owned:
+                connection.close()
+            raise
+
+    def _watch_checkins(self, engine):
+        if engine in self._deadline_engines:
+            return
+        with self._deadline_engines_lock:
+            if engine not in self._deadline_engines:
+                event.listen(engine.pool, 'checkin',
+                             self._reset_statement_timeout)
+                self._deadline_engines.add(engine)
+
+    def _set_statement_timeout(self, connection, expires):
+        remaining = expires - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded('deadline exceeded')
+        self._watch_checkins(connection.engine)
+        dbapi_connection = connection.connection.connection
+        info = connection.info
+        dialect = connection.dialect.name
+        # Each of (name, value in seconds, slack, statement setting it).
+        if dialect == 'sqlite':
+            # sqlite has no statement timeout, but a progress handler that
+            # returns true makes it abort the statement as "interrupted".
+            dbapi_connection.set_progress_handler(
+                lambda: time.time() >= expires, 1000)
+            settings = [('busy_timeout', remaining, _TIMEOUT_SLACK,
+                         'PRAGMA busy_timeout = %d' % (remaining * 1000))]
+        elif _is_mariadb(connection.dialect):
+            settings = [('max_statement_time', remaining, _TIMEOUT_SLACK,
+                         'SET SESSION max_statement_time = %.3f' % remaining)]
+        else:
+            # max_execution_time only applies to SELECT; writes are bounded
+            # by how long they can wait for row locks.
+            lock_wait = max(1, math.ceil(remaining))
+            settings = [
+                ('max_execution_time', remaining, _TIMEOUT_SLACK,
+                 'SET SESSION max_execution_time = %d' % (remaining * 1000)),
+                ('innodb_lock_wait_timeout', lock_wait, 1,
+                 'SET SESSION innodb_lock_wait_timeout = %d' % lock_wait),
+            ]
+        applied = info.get('wimms_timeouts')
+        if applied is None:
+            applied = info['wimms_timeouts'] = {}
+        info['wimms_deadline'] = dialect
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value, slack, statement in settings:
+                current = applied.get(name)
+                if current is not None and \
+                        remaining <= current <= remaining + slack:
+                    continue
+                if dialect == 'sqlite' and 'wimms_busy_timeout' not in info:
+                    # Remember the driver's own, to restore it on checkin.
+                    cursor.execute('PRAGMA busy_timeout')
+                    info['wimms_busy_timeout'] = cursor.fetchone()[0]
+                cursor.execute(statement)
+                applied[name] = value
+        except connection.dialect.dbapi.Error, exc:
+            logger.error(traceback.format_exc())
+            if expires <= time.time():
+                raise DeadlineExceeded(str(exc))
+            raise BackendError(str(exc))
+        finally:
+            cursor.close()
+
+    def _clear_statement_timeout(self, connection):
+        fairy = connection.connection
+        try:
+            self._reset_statement_timeout(fairy.connection,
+                                          fairy._connection_record)
+        except connection.dialect.dbapi.Error:
+            # Rather than leave the timeouts in place for the rest of the
+            # session, have the connection replaced.
+            logger.error(traceback.format_exc())
+            connection.invalidate()
+
+    def _reset_statement_timeout(self, dbapi_connection, connection_record):
+        if dbapi_connection is None:
+            return
+        info = connection_record.info
+        dialect = info.pop('wimms_deadline', None)
+        if dialect is None:
+            return
+        applied = info.pop('wimms_timeouts', None)
+        if dialect == 'sqlite':
+            dbapi_connection.set_progress_handler(None, 0)
+            if not applied:
+                return
+            statement = 'PRAGMA busy_timeout = %d' % info['wimms_busy_timeout']
+        else:
+            if not applied:
+                return
+            statement = 'SET SESSION ' + ', '.join(
+                '%s = DEFAULT' % name for name in sorted(applied))
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(statement)
+        finally:
+            cursor.close()
+
+    def _is_timeout_error(self, exc):
+        orig = getattr(exc, 'orig', None)
+        if orig is None:
+            return False
+        if orig.args and orig.args[0] in _MYSQL_TIMEOUT_ERRORS:
+            return True
+        # This is what sqlite says when the progress handler aborts.
+        return str(orig) == 'interrupted'
+
+    @contextmanager
+    def session(self, transaction=False):
+        """Use a single connection per database for the rest of the block.
+
+        All the statements executed by this thread within the block share
+        that connection, instead of each checking one out of the pool and
+        resetting it on return.  With transaction=True they also share one
+        transaction per database, which is committed at the end of the
+        block, or rolled back if it raises.  With several shards there is
+        a transaction for each, and they are committed one by one.
+
+        Sessions don't nest; an inner block simply joins the outer one.
+        Group commit is bypassed for writes made within a session.
+        """
+        if self._get_session() is not None:
+            yield
+            return
+        session = self._sessions.session = _Session(transaction)
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            self._sessions.session = None
+            try:
+                session.close(commit=success)
+            except (OperationalError, TimeoutError), exc:
+                logger.error(traceback.format_exc())
+                if success:
+                    raise BackendError(str(exc))
+
+    def _get_session(self):
+        return getattr(self._sessions, 'session', None)
+
+    @contextmanager
+    def _connect(self, engine):
+        """Get a connection for running an explicit transaction on."""
+        session = self._get_session()
+        if session is not None:
+            # A transaction begun on it will be nested in the session's.
+            yield session.get_connection(engine)
+            return
+        connection = engine.connect()
         try:
-            # The query fetches rows ordered by created_at, but we want
-            # to ensure that they're ordered by (generation, created_at).
-            # This is almost always true, except for strange race conditions
-            # during row creation.  Sorting them is an easy way to enforce
-            # this without bloating the db index.
-            rows = res.fetchall()
-            rows.sort(key=lambda r: (r.generation, r.created_at), reverse=True)
+            yield connection
+        finally:
+            connection.close()
+
+    def _use_group_commit(self):
+        return self._group_commit_delay and self._get_session() is None
+
+    def get_breaker_stats(self):
+        """Returns circuit breaker state and queue depth for each engine."""
+        stats = {}
+        for engine, (breaker, limiter) in self._guards.items():
+            engine_stats = {}
+            if breaker is not None:
+                engine_stats.update(breaker.get_stats())
+            if limiter is not None:
+                engine_stats.update(limiter.get_stats())
+            stats[repr(engine.url)] = engine_stats
+        return stats
+
+    def get_slow_queries(self):
+        """Returns the statements in the slow query log, oldest first."""
+        if self._slow_query_log is None:
+            return []
+        return self._slow_query_log.get_entries()
+
+    def dump_slow_queries(self, stream):
+        """Write the slow query log to the stream as NDJSON."""
+        if self._slow_query_log is None:
+            return 0
+        return self._slow_query_log.dump(stream)
+
+    def get_profile_stats(self):
+        """Returns the call count and time spent in each profiled method.
+
+        The times are in seconds: 'wall' is the total, 'cpu' the CPU time
+        of the calling thread and 'db' the time spent executing statements.
+        """
+        if self._profiler is None:
+            return {}
+        return self._profiler.get_stats()
+
+    def dump_profile(self, stream):
+        """Write the profiling stats to the stream, as text."""
+        if self._profiler is not None:
+            self._profiler.dump(stream)
+
+    @with_timeout
+    def get_user(self, service, email, generation=None, client_state=None):
+        """Get the current record for a user, or None if they have none.
+
+        If generation or client_state are given, the record is also updated
+        with them just as update_user() would do, unless the user has been
+        retired.  That only costs extra statements when something actually
+        needs to change.
+        """
+        user = self._lookup_user(service, email)
+        if user is not None and user.generation < MAX_GENERATION:
+            if client_state is not None:
+                if client_state != user.client_state:
+                    self.update_user(service, user, generation, client_state)
+                    return user
+            if generation is not None and generation > user.generation:
+                self.update_user(service, user, generation)
+        return user
+
+    def _lookup_user(self, service, email):
+        user_filter = self._user_filter
+        if user_filter is not None:
+            if not user_filter.might_exist(service, email):
+                return None
+        if self._singleflight is None:
+            user = self._get_user(service, email)
+        else:
+            # Concurrent lookups of the same user share a single query.
+            key = ('get_user', service, email)
+            user = self._singleflight.do(key, self._get_user, service, email)
+            if user is not None:
+                user = user.copy()
+        if user is None and user_filter is not None:
+            user_filter.record_false_positive()
+        return user
+
+    def _get_user(self, service, email):
+        rows = self._get_user_rows(_GET_CURRENT_USER_RECORDS, service, email,
+                                   max_generation=MAX_GENERATION)
+        # If there's no active record, or it was written before we started
+        # keeping client-state history, then we need to look at the older
+        # records as well.
+        if not rows or rows[0][_HISTORY] is None:
+            rows = self._get_user_rows(_GET_USER_RECORDS, service, email)
             if not rows:
                 return None
-            # The first row is the most up-to-date user record.
-            # The rest give previously-seen client-state values.
-            cur_row = rows[0]
-            old_rows = rows[1:]
-            user = {
-                'email': email,
-                'uid': cur_row.uid,
-                'node': cur_row.node,
-                'generation': cur_row.generation,
-                'client_state': cur_row.client_state,
-                'old_client_states': {}
-            }
-            # If the current row is marked as replaced, and they haven't
-            # been retired, then create them a new node assignment.
-            if cur_row.replaced_at is not None:
-                if cur_row.generation < MAX_GENERATION:
-                    user = self.create_user(service, email,
-                                            cur_row.generation,
-                                            cur_row.client_state)
-            for old_row in old_rows:
-                # Colect any previously-seen client-state values.
-                if old_row.client_state != user['client_state']:
-                    user['old_client_states'][old_row.client_state] = True
-                # Make sure each old row is marked as replaced.
-                # They might not be, due to races in row creation.
-                if old_row.replaced_at is None:
-                    timestamp = cur_row.created_at
-                    self.replace_user_record(service, old_row.uid, timestamp)
-            return user
+        return self._merge_user_rows(service, email, rows)
+
+    def _merge_user_rows(self, service, email, rows):
+        """Build the user's current record from their rows for a service."""
+        # The first row is the most up-to-date user record.
+        # The rest give previously-seen client-state values.
+        cur_row = rows[0]
+        old_client_states = {}
+        for state in unpack_client_states(cur_row[_HISTORY]):
+            old_client_states[state] = True
+        for old_row in rows[1:]:
+            old_client_states[old_row[_CLIENT_STATE]] = True
+            for state in unpack_client_states(old_row[_HISTORY]):
+                old_client_states[state] = True
+        old_client_states.pop(cur_row[_CLIENT_STATE], None)
+        # If the current row is marked as replaced, and they haven't
+        # been retired, then create them a new node assignment.
+        if cur_row[_REPLACED_AT] is not None and \
+                cur_row[_GENERATION] < MAX_GENERATION:
+            user = self._reallocate_user(service, email, cur_row,
+                                         old_client_states)
+        else:
+            user = UserRecord(email, cur_row[_UID], cur_row[_NODE],
+                              cur_row[_GENERATION], cur_row[_CLIENT_STATE],
+                              old_client_states)
+        for old_row in rows[1:]:
+            # Make sure each old row is marked as replaced.
+            # They might not be, due to races in row creation.
+            if old_row[_REPLACED_AT] is None:
+                timestamp = cur_row[_CREATED_AT]
+                self.replace_user_record(service, old_row[_UID], timestamp)
+        return user
+
+    def _get_user_rows(self, query, service, email, **params):
+        """Fetch the user's records, most up-to-date first."""
+        res = self._safe_execute(query, service=service, email=email,
+                                 **params)
+        try:
+            # Read plain tuples straight from the DBAPI cursor, since
+            # building a RowProxy for each row is surprisingly costly.
+            rows = res.cursor.fetchall()
         finally:
             res.close()
-
+        # The query fetches rows ordered by created_at, but we want
+        # to ensure that they're ordered by (generation, created_at).
+        # This is almost always true, except for strange race conditions
+        # during row creation.  Sorting them is an easy way to enforce
+        # this without bloating the db index.  The sort is stable, so
+        # sorting on generation alone preserves the created_at ordering.
+        if len(rows) > 1:
+            rows.sort(key=_generation_key, reverse=True)
+        return rows
+
+    @with_timeout
+    def get_user_all_services(self, email, services=None):
+        """Get the user's current record for each of several services.
+
+        This reads the records for all the given services, or for every
+        known service by default, in a single query, and applies the same
+        rules to them as get_user().  Returns a dict mapping the name of
+        each service for which the user has any records to their record.
+
+        The known services are cached along with the endpoint patterns, so
+        a service added by another process may take as long to show up.
+        """
+        if services is None:
+            services = self._endpoint_patterns.get_services()
+        user_filter = self._user_filter
+        if user_filter is not None:
+            services = [service for service in services
+                        if user_filter.might_exist(service, email)]
+        users = {}
+        if not services:
+            return users
+        rows_by_service = self._get_all_user_rows(email, services)
+        for service, rows in rows_by_service.items():
+            users[service] = self._merge_user_rows(service, email, rows)
+        return users
+
+    def _get_all_user_rows(self, email, services):
+        return self._fetch_all_user_rows(self._get_engine(), self.users,
+                                         email, services)
+
+    def _fetch_all_user_rows(self, engine, users, email, services):
+        """Fetch the user's records for several services from one database.
+
+        Returns a dict mapping service names to lists of rows, ordered as
+        for _get_user_rows(), for the services with any records.
+        """
+        service_names = {}
+        for service in services:
+            service_names[self._get_service_id(service)] = service
+        query = select([users.c.service, users.c.uid, users.c.node,
+                        users.c.generation, users.c.client_state,
+                        users.c.created_at, users.c.replaced_at,
+                        users.c.client_state_history])
+        query = query.where(and_(users.c.email == email,
+                                 users.c.service.in_(list(service_names))))
+        res = self._safe_execute(query, engine=engine)
+        try:
+            rows = res.cursor.fetchall()
+        finally:
+            res.close()
+        rows_by_service = {}
+        for row in rows:
+            service = service_names[row[0]]
+            rows_by_service.setdefault(service, []).append(row[1:])
+        for rows in rows_by_service.values():
+            rows.sort(key=_current_row_key, reverse=True)
+        return rows_by_service
+
+    def _reallocate_user(self, service, email, cur_row, old_client_states):
+        """Create a new node assignment to replace the given user record."""
+        args = (service, email, cur_row[_GENERATION], cur_row[_CLIENT_STATE],
+                None, old_client_states)
+        if self._singleflight is None:
+            return self.create_user(*args)
+        # Concurrent callers that saw the same replaced record share a
+        # single new assignment, rather than each allocating their own.
+        key = ('reallocate', service, email, cur_row[_UID])
+        user = self._singleflight.do(key, self.create_user, *args)
+        return user.copy()
+
+    @with_timeout
+    def rebuild_user_filter(self):
+        """Rebuild the filter of known users by scanning all user records.
+
+        This must be run once before the filter is used, and then
+        periodically to pick up users created by other processes.
+        """
+        if self._user_filter is None:
+            raise BackendError('the user filter is not enabled')
+
+        def iter_users():
+            for row in self.get_patterns():
+                service = row.service
+                for user in self.iter_service_users(service,
+                                                    include_replaced=True):
+                    yield service, user.email
+
+        self._user_filter.rebuild(iter_users())
+
+    def get_user_filter_stats(self):
+        """Returns memory footprint and effectiveness of the user filter."""
+        if self._user_filter is None:
+            return {'ready': False}
+        return self._user_filter.get_stats()
+
+    def get_coalescing_stats(self):
+        """Returns the count of calls, and of those that were coalesced."""
+        if self._singleflight is None:
+            return {'calls': 0, 'coalesced': 0}
+        return {'calls': self._singleflight.calls,
+                'coalesced': self._singleflight.coalesced}
+
+    @with_timeout
     def create_user(self, service, email, generation=0, client_state='',
-                    timestamp=None):
+                    timestamp=None, old_client_states=()):
+        check_client_state(client_state)
         if timestamp is None:
             timestamp = get_timestamp()
-        node = self.get_best_node(service)
+        user_filter = self._user_filter
+        if user_filter is not None:
+            seen = user_filter.has_seen(service, email)
+            # Add them first, since reading a replaced record back below
+            # calls create_user() again to reallocate it.
+            user_filter.add(service, email)
+            if not seen:
+                # The "no such user" that led here may be stale, if another
+                # process created the user since the filter was built.
+                user = self._get_user(service, email)
+                if user is not None:
+                    return user
+        old_client_states = dict.fromkeys(old_client_states, True)
         params = {
-            'service': service, 'email': email, 'node': node,
+            'service': service, 'email': email, 'node': None,
             'generation': generation, 'client_state': client_state,
-            'timestamp': timestamp
-        }
-        res = self._safe_execute(_CREATE_USER_RECORD, **params)
-        res.close()
-        return {
-            'email': email,
-            'uid': res.lastrowid,
-            'node': node,
-            'generation': generation,
-            'client_state': client_state,
-            'old_client_states': {}
+            'timestamp': timestamp,
+            'client_state_history': pack_client_states(old_client_states),
         }
+        if self._use_group_commit():
+            # The node gets allocated along with the rest of the batch.
+            uid, node = self._group_insert_user_record(service, params)
+        else:
+            params['node'] = node = self.get_best_node(service)
+            uid = self._insert_user_record(service, params)
+        return UserRecord(email, uid, node, generation, client_state,
+                          old_client_states)
 
+    @with_timeout
     def update_user(self, service, user, generation=None, client_state=None):
         if client_state is None:
             # uid can stay the same, just update the generation number.
@@ -296,6 +1368,7 @@ class SQLMetadata(object):
                 res.close()
                 user['generation'] = max(generation, user['generation'])
         else:
+            check_client_state(client_state)
             # reject previously-seen client-state strings.
             if client_state == user['client_state']:
                 raise BackendError('previously seen client-state string')
@@ -307,14 +1380,15 @@ class SQLMetadata(object):
             else:
                 generation = user['generation']
             now = get_timestamp()
+            history = list(user['old_client_states'])
+            history.append(user['client_state'])
             params = {
                 'service': service, 'email': user['email'],
                 'node': user['node'], 'timestamp': now,
-                'generation': generation, 'client_state': client_state
+                'generation': generation, 'client_state': client_state,
+                'client_state_history': pack_client_states(history),
             }
-            res = self._safe_execute(_CREATE_USER_RECORD, **params)
-            res.close()
-            user['uid'] = res.lastrowid
+            user['uid'] = self._insert_user_record(service, params)
             user['generation'] = generation
             user['old_client_states'][user['client_state']] = True
             user['client_state'] = client_state
@@ -324,6 +1398,73 @@ class SQLMetadata(object):
             # will be undamaged.
             self.replace_user_records(service, user['email'], now)
 
+    def _insert_user_record(self, service, params):
+        """Insert a new user record, returning its uid."""
+        if self._use_group_commit():
+            return self._group_insert_user_record(service, params)[0]
+        res = self._safe_execute(_CREATE_USER_RECORD, **params)
+        res.close()
+        return res.lastrowid
+
+    def _group_insert_user_record(self, service, params):
+        """Insert a new user record as part of a group commit.
+
+        If the record has no node, one will be allocated for it when the
+        batch is written.  Returns a (uid, node) tuple.
+        """
+        engine = self._get_engine(service)
+        try:
+            committer = self._group_committers[engine]
+        except KeyError:
+            with self._group_committers_lock:
+                committer = self._group_committers.get(engine)
+                if committer is None:
+                    flush = functools.partial(self._write_user_records,
+                                              engine)
+                    committer = GroupCommitter(flush,
+                                               self._group_commit_delay)
+                    self._group_committers[engine] = committer
+        return committer.submit(params)
+
+    def _write_user_records(self, engine, batch):
+        """Write a batch of user records in a single transaction.
+
+        Records without a node are spread over the available nodes by
+        reading the nodes table once for the whole batch.  The records are
+        then inserted one at a time so that each gets its own reliable
+        lastrowid, but they share a single commit, and the load counters
+        are updated once per node.  Returns a (uid, node) for each record.
+        """
+        results = []
+        allocators = {}
+        node_counts = {}
+        with self._connect(engine) as connection:
+            with connection.begin():
+                for params in batch:
+                    service = params['service']
+                    if params['node'] is None:
+                        if service not in allocators:
+                            rows = self._get_node_loads(service, connection)
+                            allocators[service] = _NodeAllocator(rows)
+                        node = allocators[service].allocate()
+                        counts = node_counts.setdefault(service, {})
+                        counts[node] = counts.get(node, 0) + 1
+                        params = dict(params, node=node)
+                    res = self._safe_execute(_CREATE_USER_RECORD,
+                                             engine=connection, **params)
+                    res.close()
+                    results.append((res.lastrowid, params['node']))
+                for service, counts in node_counts.items():
+                    self._add_node_load(service, counts, connection)
+        return results
+
+    def get_group_commit_stats(self):
+        """Returns the count of records written and of batches used."""
+        items = sum(c.items for c in self._group_committers.values())
+        batches = sum(c.batches for c in self._group_committers.values())
+        return {'items': items, 'batches': batches}
+
+    @with_timeout
     def retire_user(self, email, engine=None):
         now = get_timestamp()
         params = {
@@ -338,6 +1479,7 @@ class SQLMetadata(object):
     # Methods for low-level user record management.
     #
 
+    @with_timeout
     def get_user_records(self, service, email):
         """Get all the user's records for a service, including the old ones."""
         params = {'service': service, 'email': email}
@@ -348,14 +1490,121 @@ class SQLMetadata(object):
         finally:
             res.close()
 
+    @with_timeout
+    def iter_node_users(self, service, node, include_replaced=False,
+                        batch_size=1000):
+        """Stream all the user records assigned to a node, in uid order.
+
+        Records are fetched in pages of at most batch_size rows using keyset
+        pagination on uid, so memory use stays flat however many users are
+        assigned to the node.  By default only active records are produced.
+        """
+        params = {'service': service, 'node': node}
+        return self._iter_user_records(_GET_NODE_USER_RECORDS, params,
+                                       include_replaced, batch_size)
+
+    @with_timeout
+    def iter_service_users(self, service, include_replaced=False,
+                           batch_size=1000):
+        """Stream all the user records for a service, in uid order."""
+        params = {'service': service}
+        return self._iter_user_records(_GET_SERVICE_USER_RECORDS, params,
+                                       include_replaced, batch_size)
+
+    def _iter_user_records(self, query, params, include_replaced, batch_size):
+        params['include_replaced'] = 1 if include_replaced else 0
+        params['limit'] = batch_size
+        last_uid = -1
+        while True:
+            params['last_uid'] = last_uid
+            res = self._safe_execute(query, **params)
+            try:
+                rows = res.fetchall()
+            finally:
+                res.close()
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                break
+            last_uid = rows[-1].uid
+
+    @with_timeout
+    def bulk_import_users(self, service, records, batch_size=1000, skip=0,
+                          checkpoint=None, update_node_counts=True):
+        """Insert many user records for a service, in large batches.
+
+        Each record is a dict with an 'email' key and optional 'node',
+        'generation', 'client_state', 'created_at' and 'replaced_at' keys.
+        Records without a node are assigned one as create_user() would.
+        Each batch is written with a single executemany inside its own
+        transaction, and the load counters on the nodes are then adjusted
+        once per node for the whole batch.
+
+        To resume an interrupted import, pass the count of records already
+        imported as 'skip'.  If given, checkpoint is called after each batch
+        commits with the count of records imported so far.  Returns the
+        total count of records imported, including skipped ones.
+        """
+        engine = self._get_engine(service)
+        service_id = self._get_service_id(service)
+        records = itertools.islice(records, skip, None)
+        done = skip
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            self._import_batch(service, service_id, engine, batch,
+                               update_node_counts)
+            done += len(batch)
+            if checkpoint is not None:
+                checkpoint(done)
+        return done
+
+    def _import_batch(self, service, service_id, engine, batch,
+                      update_node_counts):
+        allocator = None
+        node_counts = {}
+        params = []
+        now = get_timestamp()
+        for record in batch:
+            if self._user_filter is not None:
+                self._user_filter.add(service, record['email'])
+            node = record.get('node')
+            if node is None:
+                if allocator is None:
+                    allocator = _NodeAllocator(self._get_node_loads(service))
+                node = allocator.allocate()
+            check_client_state(record.get('client_state'))
+            replaced_at = record.get('replaced_at')
+            if replaced_at is None:
+                node_counts[node] = node_counts.get(node, 0) + 1
+            # Without a known history, leave it NULL so that get_user()
+            # knows to look for it in the user's older records.
+            history = record.get('old_client_states')
+            if history is not None:
+                history = pack_client_states(history)
+            params.append({
+                'service': service_id, 'email': record['email'],
+                'node': node, 'generation': record.get('generation', 0),
+                'client_state': record.get('client_state', ''),
+                'created_at': record.get('created_at', now),
+                'replaced_at': replaced_at,
+                'client_state_history': history,
+            })
+        with self._connect(engine) as connection:
+            with connection.begin():
+                res = self._safe_execute(_IMPORT_USER_RECORD, params,
+                                         engine=connection)
+                res.close()
+                if update_node_counts:
+                    self._add_node_load(service, node_counts, connection)
+
+    @with_timeout
     def get_old_user_records(self, service, grace_period=-1, limit=100):
         """Get user records that were replaced outside the grace period."""
-        if grace_period < 0:
-            grace_period = 60 * 60 * 24 * 7  # one week, in seconds
-        grace_period = int(grace_period * 1000)  # convert seconds -> millis
         params = {
             "service": service,
-            "timestamp": get_timestamp() - grace_period,
+            "timestamp": _grace_period_cutoff(grace_period),
             "limit": limit,
         }
         res = self._safe_execute(_GET_OLD_USER_RECORDS_FOR_SERVICE, **params)
@@ -365,6 +1614,80 @@ class SQLMetadata(object):
         finally:
             res.close()
 
+    @with_timeout
+    def compact_user_records(self, service, grace_period=-1, limit=100):
+        """Fold old replaced records into their user's current record.
+
+        This finds up to 'limit' records that were replaced outside the
+        grace period, adds their client-state values to the history kept
+        on the current record for each user, and deletes them.  Returns
+        the number of records deleted.
+        """
+        cutoff = _grace_period_cutoff(grace_period)
+        emails = set()
+        for row in self.get_old_user_records(service, grace_period, limit):
+            emails.add(row.email)
+        count = 0
+        for email in sorted(emails):
+            count += self._compact_user(service, email, cutoff)
+        return count
+
+    @with_timeout
+    def migrate_client_state_history(self, service, grace_period=-1,
+                                     batch_size=1000):
+        """Fill in the client-state history for all of a service's users.
+
+        Records created before the client_state_history column was added
+        have it set to NULL, which makes get_user() read all the user's
+        older records.  This fills it in for every active record, compacting
+        away any old records along the way.  Returns the count of users
+        that were updated.
+        """
+        cutoff = _grace_period_cutoff(grace_period)
+        count = 0
+        for row in self.iter_service_users(service, batch_size=batch_size):
+            if row.client_state_history is None:
+                self._compact_user(service, row.email, cutoff)
+                count += 1
+        return count
+
+    def _compact_user(self, service, email, cutoff):
+        rows = list(self.get_user_records(service, email))
+        if not rows:
+            return 0
+        # Same precedence as get_user(): generation, then created_at,
+        # then uid to break any remaining ties.
+        cur_row = max(rows, key=lambda row: (row.generation, row.created_at,
+                                             row.uid))
+        # The history must cover every other record, not just the ones
+        # being deleted, since get_user() will rely on it exclusively.
+        history = set(unpack_client_states(cur_row.client_state_history))
+        old_uids = []
+        for row in rows:
+            if row.uid == cur_row.uid:
+                continue
+            history.add(row.client_state)
+            history.update(unpack_client_states(row.client_state_history))
+            if row.replaced_at is not None and row.replaced_at < cutoff:
+                old_uids.append(row.uid)
+        history.discard(cur_row.client_state)
+        engine = self._get_engine(service)
+        with self._connect(engine) as connection:
+            with connection.begin():
+                history = pack_client_states(history)
+                res = self._safe_execute(_UPDATE_CLIENT_STATE_HISTORY,
+                                         engine=connection, service=service,
+                                         uid=cur_row.uid,
+                                         client_state_history=history)
+                res.close()
+                for uid in old_uids:
+                    res = self._safe_execute(_DELETE_USER_RECORD,
+                                             engine=connection,
+                                             service=service, uid=uid)
+                    res.close()
+        return len(old_uids)
+
+    @with_timeout
     def replace_user_records(self, service, email, timestamp=None):
         """Mark all existing service records for a user as replaced."""
         if timestamp is None:
@@ -375,6 +1698,7 @@ class SQLMetadata(object):
         res = self._safe_execute(_REPLACE_USER_RECORDS, **params)
         res.close()
 
+    @with_timeout
     def replace_user_record(self, service, uid, timestamp=None):
         """Mark an existing service record as replaced."""
         if timestamp is None:
@@ -385,6 +1709,7 @@ class SQLMetadata(object):
         res = self._safe_execute(_REPLACE_USER_RECORD, **params)
         res.close()
 
+    @with_timeout
     def delete_user_record(self, service, uid):
         """Delete the user record with the given uid."""
         params = {'service': service, 'uid': uid}
@@ -399,10 +1724,15 @@ class SQLMetadata(object):
         try:
             return self._cached_service_ids[service]
         except KeyError:
+            snapshot = self._read_snapshot()
+            if snapshot is not None and service in snapshot['services']:
+                service_id = snapshot['services'][service][0]
+                self._cached_service_ids[service] = service_id
+                return service_id
             services = self._get_services_table(service)
             query = select([services.c.id])
             query = query.where(services.c.service == service)
-            res = self._safe_execute(query)
+            res = self._safe_execute(query, engine=self._get_engine(service))
             row = res.fetchone()
             res.close()
             if row is None:
@@ -410,6 +1740,7 @@ class SQLMetadata(object):
             self._cached_service_ids[service] = row.id
             return row.id
 
+    @with_timeout
     def get_patterns(self):
         """Returns all the service URL patterns."""
         query = select([self.services])
@@ -420,6 +1751,7 @@ class SQLMetadata(object):
         res.close()
         return patterns
 
+    @with_timeout
     def add_service(self, service, pattern, **kwds):
         """Add definition for a new service."""
         res = self._safe_execute(sqltext("""
@@ -427,8 +1759,73 @@ class SQLMetadata(object):
           values (:servicename, :pattern)
         """), servicename=service, pattern=pattern, **kwds)
         res.close()
+        self._endpoint_patterns.invalidate()
+        if self._partition_users:
+            ddl = add_users_partition_ddl(res.lastrowid)
+            self._safe_execute(ddl, engine=kwds.get('engine')).close()
         return res.lastrowid
 
+    @with_timeout
+    def drop_service_users(self, service):
+        """Delete all the user records for a service.
+
+        This is intended for cleaning up after a service version has been
+        retired.  When the users table is partitioned it's done by
+        truncating the service's partition, which is much cheaper than
+        deleting the records one at a time.
+        """
+        if self._partition_users:
+            ddl = truncate_users_partition_ddl(self._get_service_id(service))
+            res = self._safe_execute(ddl, engine=self._get_engine(service))
+        else:
+            res = self._safe_execute(sqltext(
+                """
+                delete from users
+                where service=:service
+                """),
+                service=service
+            )
+        res.close()
+
+    def _create_users_partitions(self, engine, services):
+        """Partition the users table, if it's not already partitioned."""
+        res = self._safe_execute(sqltext(
+            """
+            select count(partition_name) from information_schema.partitions
+            where table_schema=database() and table_name='users'
+            """), engine=engine)
+        try:
+            if res.scalar():
+                return
+        finally:
+            res.close()
+        # Tables created before partitioning was enabled need their primary
+        # key changing first, which we leave to the operator.
+        res = self._safe_execute(sqltext(
+            """
+            select column_name from information_schema.key_column_usage
+            where table_schema=database() and table_name='users'
+            and constraint_name='PRIMARY'
+            """), engine=engine)
+        try:
+            primary_key = [row[0].lower() for row in res]
+        finally:
+            res.close()
+        if 'service' not in primary_key:
+            raise BackendError('the users table must have (uid, service) '
+                               'as its primary key to be partitioned')
+        res = self._safe_execute(select([services.c.id]), engine=engine)
+        try:
+            service_ids = [row.id for row in res]
+        finally:
+            res.close()
+        # A list-partitioned table needs at least one partition.
+        if not service_ids:
+            service_ids = [0]
+        ddl = partition_users_ddl(service_ids)
+        self._safe_execute(ddl, engine=engine).close()
+
+    @with_timeout
     def add_node(self, service, node, capacity, **kwds):
         """Add definition for a new node."""
         res = self._safe_execute(sqltext(
@@ -446,6 +1843,7 @@ class SQLMetadata(object):
         )
         res.close()
 
+    @with_timeout
     def remove_node(self, service, node, timestamp=None):
         """Remove definition for a node."""
         res = self._safe_execute(sqltext(
@@ -458,6 +1856,7 @@ class SQLMetadata(object):
         res.close()
         self.unassign_node(service, node, timestamp)
 
+    @with_timeout
     def unassign_node(self, service, node, timestamp=None):
         """Clear any assignments to a node."""
         if timestamp is None:
@@ -472,10 +1871,183 @@ class SQLMetadata(object):
         )
         res.close()
 
+    @with_timeout
+    def drain_node(self, service, node, batch_size=100, interval=1.0,
+                   max_batches=None, checkpoint=None):
+        """Move all users off a node, a batch at a time.
+
+        The node is first marked as downed so that it receives no new
+        assignments.  Its active users are then given new assignments in
+        batches of batch_size, pausing for 'interval' seconds between
+        batches so they don't all hit the remaining nodes at once.  Each
+        batch is spread over the remaining nodes according to their load
+        as read at the start of the batch, and written in one transaction
+        along with a single aggregated update of each node's counters.
+
+        Draining can be safely interrupted and started again, since each
+        batch picks up whatever users are still assigned to the node.
+        If given, checkpoint is called after each batch with the count of
+        users moved so far.  Returns the total count of users moved.
+        """
+        res = self._safe_execute(sqltext(
+            """
+            update nodes
+            set downed=1
+            where service=:service and node=:node
+            """),
+            service=service, node=node
+        )
+        res.close()
+        engine = self._get_engine(service)
+        service_id = self._get_service_id(service)
+        moved = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            if batches > 0 and interval > 0:
+                time.sleep(interval)
+            rows = self.iter_node_users(service, node, batch_size=batch_size)
+            rows = list(itertools.islice(rows, batch_size))
+            if not rows:
+                break
+            moved += self._move_users(service, service_id, engine, rows)
+            batches += 1
+            if checkpoint is not None:
+                checkpoint(moved)
+        return moved
+
+    def _move_users(self, service, service_id, engine, rows):
+        """Reassign the users of the given rows, returning how many moved.
+
+        Rows that were replaced since they were read, e.g. by a concurrent
+        update_user(), are skipped rather than resurrected.  So are rows
+        that are about to be, because update_user() has written the user's
+        new record but not yet marked the old ones as replaced.
+        """
+        allocator = _NodeAllocator(self._get_node_loads(service))
+        node_counts = {}
+        new_records = []
+        now = get_timestamp()
+        with self._connect(engine) as connection:
+            with connection.begin():
+                for row in rows:
+                    params = {'service': service, 'uid': row.uid,
+                              'timestamp': now}
+                    res = self._safe_execute(_REPLACE_CURRENT_USER_RECORD,
+                                             engine=connection, **params)
+                    res.close()
+                    if res.rowcount != 1:
+                        continue
+                    # The row is marked as replaced all the same, as
+                    # update_user() would have done, so the drain moves on.
+                    params = {'service': service, 'email': row.email,
+                              'created_at': row.created_at, 'uid': row.uid}
+                    res = self._safe_execute(_GET_NEWER_USER_RECORD,
+                                             engine=connection, **params)
+                    try:
+                        newer = res.fetchone()
+                    finally:
+                        res.close()
+                    if newer is not None:
+                        continue
+                    node = allocator.allocate()
+                    node_counts[node] = node_counts.get(node, 0) + 1
+                    new_records.append({
+                        'service': service_id, 'email': row.email,
+                        'node': node, 'generation': row.generation,
+                        'client_state': row.client_state,
+                        'created_at': now, 'replaced_at': None,
+                        'client_state_history': row.client_state_history,
+                    })
+                if new_records:
+                    res = self._safe_execute(_IMPORT_USER_RECORD,
+                                             new_records, engine=connection)
+                    res.close()
+                    self._add_node_load(service, node_counts, connection)
+        return len(new_records)
+
+    @with_timeout
+    def get_node_loads(self, service):
+        """Returns (node, available, capacity, current_load) for each node
+        that isn't downed.
+        """
+        return self._get_node_loads(service)
+
+    def _get_node_loads(self, service, engine=None):
+        """Returns (node, available, capacity, current_load) for each node."""
+        res = self._safe_execute(_GET_NODE_LOADS, service=service,
+                                 engine=engine)
+        try:
+            return res.fetchall()
+        finally:
+            res.close()
+
+    def _add_node_load(self, service, node_counts, engine):
+        """Adjust node counters for many new assignments at once."""
+        for node, count in sorted(node_counts.items()):
+            params = {'service': service, 'node': node, 'count': count}
+            res = self._safe_execute(_ADD_NODE_LOAD, engine=engine, **params)
+            res.close()
+
+    @with_timeout
     def get_best_node(self, service):
         """Returns the 'least loaded' node currently available, increments the
         active count on that node, and decrements the slots currently available
         """
+        node = self._select_best_node_from_snapshot(service)
+        # The snapshot may be out of date, so only take its node if it's
+        # still up and has room left.
+        if node is None or not self._take_node_slot(service, node, True):
+            node = self._select_best_node(service)
+            self._take_node_slot(service, node)
+        return node
+
+    def _take_node_slot(self, service, node, check_available=False):
+        """Update the counters of a node for a new user assigned to it.
+
+        Returns False if check_available is set and the node is downed,
+        has no slots left or is at capacity.
+        """
+        engine = self._get_engine(service)
+        nodes = self._get_nodes_table(service)
+        service = self._get_service_id(service)
+        where = [nodes.c.service == service, nodes.c.node == node]
+        if check_available:
+            where += [nodes.c.downed == 0, nodes.c.available > 0,
+                      nodes.c.capacity > nodes.c.current_load]
+        where = and_(*where)
+        fields = {'available': nodes.c.available - 1,
+                  'current_load': nodes.c.current_load + 1}
+        query = update(nodes, where, fields)
+        con = self._safe_execute(query, engine=engine, close=True)
+        rowcount = con.rowcount
+        con.close()
+        return rowcount > 0
+
+    def _select_best_node_from_snapshot(self, service):
+        """Pick a node using the shared snapshot, or None if there is none.
+
+        The loads in the snapshot are only updated every so often, so
+        rather than have every process pick the same least-loaded node
+        until then, this picks the less loaded of two random candidates.
+        """
+        snapshot = self._read_snapshot()
+        if snapshot is None:
+            return None
+        candidates = [node for node in snapshot['nodes'].get(service, ())
+                      if node[_NODE_AVAILABLE] > 0 and not node[_NODE_DOWNED]
+                      and node[_NODE_CAPACITY] > node[_NODE_LOAD]]
+        if not candidates:
+            # Let the database have the final say.
+            return None
+        if len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+        best = min(candidates, key=lambda node: float(node[_NODE_LOAD]) /
+                   node[_NODE_CAPACITY])
+        return str(best[_NODE_NAME])
+
+    def _select_best_node(self, service):
+        """Returns the 'least loaded' node, without updating its counters."""
+        engine = self._get_engine(service)
         nodes = self._get_nodes_table(service)
         service = self._get_service_id(service)
 
@@ -497,7 +2069,7 @@ class SQLMetadata(object):
             query = query.order_by(sqlfunc.log(nodes.c.current_load) /
                                    sqlfunc.log(nodes.c.capacity))
         query = query.limit(1)
-        res = self._safe_execute(query)
+        res = self._safe_execute(query, engine=engine)
         one = res.fetchone()
         if one is None:
             # unable to get a node
@@ -506,18 +2078,62 @@ class SQLMetadata(object):
 
         node = str(one.node)
         res.close()
-
-        # updating the table
-        where = [nodes.c.service == service, nodes.c.node == node]
-        where = and_(*where)
-        fields = {'available': nodes.c.available - 1,
-                  'current_load': nodes.c.current_load + 1}
-        query = update(nodes, where, fields)
-        con = self._safe_execute(query, close=True)
-        con.close()
-
         return node
 
+    def _load_endpoint_patterns(self, service):
+        snapshot = self._read_snapshot()
+        if snapshot is not None and \
+                (service is None or service in snapshot['services']):
+            return [(name, pattern) for name, (_, pattern)
+                    in snapshot['services'].iteritems()]
+        return [(row.service, row.pattern) for row in self.get_patterns()]
+
+    @with_timeout
+    def get_endpoint(self, service, user):
+        """Get the endpoint URL of a user record for the given service.
+
+        The service patterns are cached, and reloaded once they are older
+        than the endpoint_patterns_max_age setting.  When they are read
+        from the shared snapshot, which may itself be up to
+        snapshot_max_age seconds old, a change to a pattern can take the
+        sum of the two settings to show up.
+        """
+        pattern = self._endpoint_patterns.get(service)
+        return pattern.format(service, user['node'], user['uid'])
+
+    @with_timeout
+    def get_endpoints(self, service, users):
+        """Get the endpoint URLs of several user records, in order."""
+        pattern = self._endpoint_patterns.get(service)
+        return pattern.format_users(service, users)
+
+    def _read_snapshot(self):
+        if self._snapshot is None:
+            return None
+        return self._snapshot.read(self._snapshot_max_age)
+
+    @with_timeout
+    def refresh_snapshot(self):
+        """Write the current services and nodes to the shared snapshot."""
+        if self._snapshot is None:
+            raise BackendError('the shared snapshot is not enabled')
+        services = {}
+        nodes = {}
+        for row in self.get_patterns():
+            services[row.service] = [row.id, row.pattern]
+            table = self._get_nodes_table(row.service)
+            query = select([table]).where(table.c.service == row.id)
+            res = self._safe_execute(query,
+                                     engine=self._get_engine(row.service))
+            try:
+                nodes[row.service] = [
+                    [node.node, node.available, node.current_load,
+                     node.capacity, node.downed]
+                    for node in res]
+            finally:
+                res.close()
+        self._snapshot.write({'services': services, 'nodes': nodes})
+
     def _get_services_table(self, service):
         return self.services
 
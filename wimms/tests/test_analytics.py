@@ -0,0 +1,124 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import os
+import sys
+import uuid
+from StringIO import StringIO
+from unittest2 import TestCase, skipIf
+
+from wimms.sql import SQLMetadata
+from wimms.memory import MemoryMetadata
+from wimms.tests.test_memory import ticking_clock
+
+try:
+    import numpy  # NOQA
+except ImportError:
+    analytics = None
+else:
+    from wimms import analytics
+
+
+@skipIf(analytics is None, "analytics needs numpy")
+class TestAnalytics(TestCase):
+
+    def setUp(self):
+        self.backend = MemoryMetadata(clock=ticking_clock())
+        self.backend.add_service("sync-1.5", "{node}/1.5/{uid}")
+        self.backend.add_node("sync-1.5", "https://phx12", 100)
+        self.backend.add_node("sync-1.5", "https://phx13", 100)
+
+    def test_usage_stats(self):
+        for i in range(10):
+            self.backend.create_user("sync-1.5", "test%d@mozilla.com" % i)
+        for i in range(4):
+            email = "test%d@mozilla.com" % i
+            self.backend.get_user("sync-1.5", email, client_state="aaa")
+        self.backend.get_user("sync-1.5", "test0@mozilla.com",
+                              client_state="bbb")
+        stats = analytics.collect_stats(self.backend, "sync-1.5",
+                                        chunk_size=3)
+        self.assertEqual(stats.records, 15)
+        self.assertEqual(stats.active, 10)
+        self.assertEqual(stats.replaced, 5)
+        self.assertEqual(sorted(stats.active_per_node.values()), [5, 5])
+        self.assertEqual(stats.client_state_changes.tolist(), [6, 3, 1])
+        self.assertEqual(sum(stats.created_per_day.values()), 15)
+        churn = stats.churn_per_day()
+        self.assertEqual(len(churn), 1)
+        self.assertEqual(churn[0][1:], (5, 0.5))
+
+    def test_simulated_allocation_matches_get_best_node(self):
+        filename = "/tmp/wimms.analytics.%s.db" % uuid.uuid4().hex
+        backend = SQLMetadata("sqlite:///" + filename, create_tables=True)
+        try:
+            backend.add_service("sync-1.5", "{node}/1.5/{uid}")
+            for node, available, capacity, load in [
+                    ("a", 100, 97, 10), ("b", 150, 211, 10), ("c", 5, 101, 0),
+                    ("d", 0, 100, 0), ("e", 100, 50, 50)]:
+                backend.add_node("sync-1.5", node, capacity,
+                                 available=available, current_load=load)
+            backend.add_node("sync-1.5", "f", 100, downed=1)
+            allocations, unplaced = analytics.simulate_allocation(
+                backend.get_node_loads("sync-1.5"), 150)
+            for i in range(150):
+                backend.get_best_node("sync-1.5")
+            loads = dict((str(row[0]), row[3])
+                         for row in backend.get_node_loads("sync-1.5"))
+        finally:
+            os.remove(filename)
+        self.assertEqual(dict((a.node, a.current_load + a.assigned)
+                              for a in allocations), loads)
+        self.assertEqual(unplaced, 0)
+
+    def test_simulated_allocation_with_new_capacities(self):
+        nodes = [("a", 0, 100, 100), ("b", 10, 100, 90)]
+        allocations, unplaced = analytics.simulate_allocation(nodes, 50)
+        self.assertEqual([a.assigned for a in allocations], [0, 10])
+        self.assertEqual(unplaced, 40)
+        # Raising the capacity of a full node gives it more slots.
+        allocations, unplaced = analytics.simulate_allocation(
+            nodes, 50, {"a": 200})
+        self.assertEqual([a.assigned for a in allocations], [50, 0])
+        self.assertEqual(allocations[0].capacity, 200)
+        self.assertEqual(unplaced, 0)
+        # Lowering it takes slots away.
+        allocations, unplaced = analytics.simulate_allocation(
+            nodes, 50, {"b": 95})
+        self.assertEqual([a.assigned for a in allocations], [0, 5])
+        self.assertEqual(unplaced, 45)
+
+    def test_simulated_allocation_matches_new_users(self):
+        self.backend.add_node("sync-1.5", "https://phx14", 30)
+        self.backend.create_user("sync-1.5", "test@mozilla.com")
+        allocations, unplaced = analytics.simulate_allocation(
+            self.backend.get_node_loads("sync-1.5"), 80)
+        for i in range(80):
+            self.backend.create_user("sync-1.5", "new%d@mozilla.com" % i)
+        counts = dict((a.node, a.current_load + a.assigned)
+                      for a in allocations)
+        self.assertEqual(sorted(counts.items()), sorted(
+            (row[0], row[3])
+            for row in self.backend.get_node_loads("sync-1.5")))
+        self.assertEqual(unplaced, 0)
+
+    def test_report(self):
+        filename = "/tmp/wimms.analytics.%s.db" % uuid.uuid4().hex
+        sqluri = "sqlite:///" + filename
+        backend = SQLMetadata(sqluri, create_tables=True)
+        try:
+            backend.add_service("sync-1.5", "{node}/1.5/{uid}")
+            backend.add_node("sync-1.5", "https://phx12", 100)
+            backend.create_user("sync-1.5", "test@mozilla.com")
+            stdout, sys.stdout = sys.stdout, StringIO()
+            try:
+                analytics.main([sqluri, "sync-1.5", "--new-users", "200",
+                                "--capacity", "https://phx12=150"])
+                report = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+        finally:
+            os.remove(filename)
+        self.assertTrue("1 records, 1 active, 0 replaced" in report)
+        self.assertTrue("Simulated allocation of 200 new users" in report)
+        self.assertTrue("51 users could not be assigned a node" in report)
@@ -0,0 +1,63 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import threading
+from collections import defaultdict
+from unittest2 import TestCase
+
+from wimms.sql import get_timestamp
+from wimms.memory import MemoryMetadata
+from wimms.tests.test_sql import NodeAssignmentTests
+
+
+def ticking_clock():
+    """Get a clock that moves on at least a millisecond each time it's read.
+
+    Like the time taken by each statement against a database, that lets
+    the records written one after the other be told apart by timestamp.
+    """
+    lock = threading.Lock()
+    last = [0]
+
+    def clock():
+        with lock:
+            last[0] = max(get_timestamp(), last[0] + 1)
+            return last[0]
+
+    return clock
+
+
+class TestMemoryDB(NodeAssignmentTests, TestCase):
+
+    def setUp(self):
+        self.backend = MemoryMetadata(clock=ticking_clock())
+        super(TestMemoryDB, self).setUp()
+
+    def test_long_running_queries_are_interrupted_at_the_deadline(self):
+        self.skipTest("there are no queries to interrupt")
+
+    def test_concurrent_user_creation(self):
+        self.backend.add_node("sync-1.0", "https://phx13", 1000)
+
+        def create_users(prefix):
+            for i in range(50):
+                email = "%s%d@mozilla.com" % (prefix, i)
+                self.backend.create_user("sync-1.0", email)
+                self.backend.get_user("sync-1.0", email, client_state="aaa")
+
+        threads = [threading.Thread(target=create_users, args=("t%d-" % i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        node_counts = defaultdict(lambda: 0)
+        uids = set()
+        for row in self.backend.iter_service_users("sync-1.0"):
+            node_counts[row.node] += 1
+            uids.add(row.uid)
+            self.assertEqual(row.client_state, "aaa")
+        self.assertEqual(len(uids), 200)
+        nodes = self.backend._nodes[self.backend._get_service_id("sync-1.0")]
+        for node, count in node_counts.items():
+            self.assertEqual(nodes[node].current_load, count)
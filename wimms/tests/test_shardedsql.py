@@ -2,13 +2,16 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 import os
-from unittest2 import TestCase
+from unittest2 import TestCase, skipIf
+
+from mozsvc.exceptions import BackendError
 
 from wimms.shardedsql import ShardedSQLMetadata, ENGINE_INDEX
 from wimms.tests.test_sql import NodeAssignmentTests, TEMP_ID
 
 
 _SQLURI = os.environ.get('WIMMS_SQLURI', 'sqlite:////tmp/wimms.' + TEMP_ID)
+_IS_SQLITE = _SQLURI.startswith('sqlite')
 _SQLURI = 'sync-1.0;%s,queuey;%s' % (_SQLURI, _SQLURI)
 
 
@@ -30,3 +33,49 @@ class TestSQLShardedDB(NodeAssignmentTests, TestCase):
                 engine.execute('drop table services')
                 engine.execute('drop table nodes')
                 engine.execute('drop table users')
+
+    def test_shards_are_connected_to_lazily(self):
+        backend = ShardedSQLMetadata(_SQLURI)
+        self.assertEqual(backend._dbs, {})
+        user = backend.create_user("sync-1.0", "test1@mozilla.com")
+        self.assertEqual(user["node"], "https://phx12")
+        self.assertEqual(sorted(backend._dbs), ["sync"])
+        # Shards with the same database share an engine and table objects.
+        self.assertTrue(backend._get_engine("queuey") is
+                        backend._get_engine("sync-1.0"))
+        self.assertTrue(backend._get_users_table("queuey") is
+                        backend._get_users_table("sync-1.0"))
+        self.assertEqual(sorted(backend._dbs), ["queuey", "sync"])
+
+    @skipIf(not _IS_SQLITE, "moves a shard to another sqlite file")
+    def test_reloading_the_shard_map(self):
+        sqluri = _SQLURI.split(',')[0].split(';')[1]
+        filename = '/tmp/wimms.queuey.' + TEMP_ID
+        self.backend.create_user("sync-1.0", "test1@mozilla.com")
+        engine = self.backend._get_engine("sync-1.0")
+        self.backend._cached_service_ids["queuey-1.0"] = 42
+        try:
+            thread = self.backend.reload_databases(
+                'sync-1.0;%s,queuey;sqlite:///%s' % (sqluri, filename),
+                create_tables=True)
+            # The engine is still used by the sync shard.
+            self.assertEqual(thread, None)
+            self.assertTrue(self.backend._get_engine("sync-1.0") is engine)
+            self.assertFalse(self.backend._get_engine("queuey") is engine)
+            self.assertTrue("sync-1.0" in self.backend._cached_service_ids)
+            self.assertFalse("queuey-1.0" in self.backend._cached_service_ids)
+            user = self.backend.get_user("sync-1.0", "test1@mozilla.com")
+            self.assertEqual(user["node"], "https://phx12")
+            self.assertTrue(os.path.exists(filename))
+
+            queuey_engine = self.backend._get_engine("queuey")
+            thread = self.backend.reload_databases('sync-1.0;' + sqluri)
+            thread.join()
+            self.assertRaises(KeyError, self.backend._get_engine, "queuey")
+            self.assertEqual(self.backend._engines.values(), [engine])
+            # Threads still holding the removed engine can't reconnect.
+            self.assertRaises(BackendError, self.backend._safe_execute,
+                              "select 1", engine=queuey_engine)
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
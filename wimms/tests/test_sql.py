@@ -4,10 +4,32 @@
 from unittest2 import TestCase
 import os
 import uuid
+import json
+import signal
+import struct
+import threading
 import time
 from collections import defaultdict
 from mozsvc.exceptions import BackendError
-from wimms.sql import SQLMetadata, MAX_GENERATION, get_timestamp
+from StringIO import StringIO
+from wimms.sql import (SQLMetadata, MAX_GENERATION, get_timestamp, _Base,
+                       _PartitionedBase)
+from wimms.export import write_ndjson, write_csv
+from wimms.bloom import BloomFilter, UserFilter
+from wimms.deadline import deadline, is_expired, DeadlineExceeded
+from wimms.groupcommit import GroupCommitter
+from wimms.singleflight import SingleFlight
+from wimms.snapshot import SharedSnapshot
+from wimms.endpoints import EndpointPattern, EndpointPatterns
+from wimms.slowlog import hash_email
+from wimms.breaker import (CircuitBreaker, ConcurrencyLimiter,
+                           CircuitOpenError, OverloadedError)
+from wimms.schemas import (get_cls, partition_users_ddl,
+                           add_users_partition_ddl,
+                           truncate_users_partition_ddl)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.sql import text as sqltext
+from sqlalchemy import event
 
 
 TEMP_ID = uuid.uuid4().hex
@@ -41,6 +63,26 @@ class NodeAssignmentTests(object):
         user2 = self.backend.create_user("sync-1.0", "test2@mozilla.com")
         self.assertNotEqual(user1['node'], user2['node'])
 
+    def test_user_record_behaves_like_a_dict(self):
+        self.backend.create_user("sync-1.0", "test@mozilla.com",
+                                 generation=2, client_state="aaa")
+        user = self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.assertEqual(user, {
+            "email": "test@mozilla.com",
+            "uid": user["uid"],
+            "node": "https://phx12",
+            "generation": 2,
+            "client_state": "aaa",
+            "old_client_states": {},
+        })
+        self.assertEqual(user.get("node"), "https://phx12")
+        self.assertEqual(user.get("nonexistent", 42), 42)
+        self.assertTrue("generation" in user)
+        self.assertFalse("nonexistent" in user)
+        self.assertRaises(KeyError, user.__getitem__, "nonexistent")
+        user["generation"] = 3
+        self.assertEqual(user.generation, 3)
+
     def test_update_generation_number(self):
         user = self.backend.create_user("sync-1.0", "tarek@mozilla.com")
         self.assertEqual(user['generation'], 0)
@@ -127,6 +169,107 @@ class NodeAssignmentTests(object):
         self.assertEqual(user['client_state'], 'bbb')
         self.assertEqual(set(user['old_client_states']), set(("", "aaa")))
 
+    def test_client_states_with_commas_are_rejected(self):
+        # They couldn't be told apart in the client-state history.
+        with self.assertRaises(BackendError):
+            self.backend.create_user("sync-1.0", "test@mozilla.com",
+                                     client_state="aaa,bbb")
+        user = self.backend.create_user("sync-1.0", "test@mozilla.com")
+        with self.assertRaises(BackendError):
+            self.backend.update_user("sync-1.0", user, client_state="aaa,")
+        with self.assertRaises(BackendError):
+            self.backend.bulk_import_users("sync-1.0", [
+                {"email": "test2@mozilla.com"},
+                {"email": "test3@mozilla.com", "old_client_states": [","]},
+            ])
+        self.assertEqual(self.backend.get_user("sync-1.0",
+                                               "test@mozilla.com"), user)
+        self.assertEqual(self.backend.get_user("sync-1.0",
+                                               "test2@mozilla.com"), None)
+
+    def test_get_user_with_generation_and_client_state(self):
+        orig_user = self.backend.create_user("sync-1.0", "test@mozilla.com")
+        # Updating to a newer generation number.
+        user = self.backend.get_user("sync-1.0", "test@mozilla.com",
+                                     generation=42)
+        self.assertEqual(user["uid"], orig_user["uid"])
+        self.assertEqual(user["generation"], 42)
+        # Generation numbers can't go backwards.
+        user = self.backend.get_user("sync-1.0", "test@mozilla.com",
+                                     generation=17, client_state="")
+        self.assertEqual(user["uid"], orig_user["uid"])
+        self.assertEqual(user["generation"], 42)
+        # Changing client-state allocates a new uid.
+        user = self.backend.get_user("sync-1.0", "test@mozilla.com",
+                                     generation=43, client_state="aaa")
+        self.assertNotEqual(user["uid"], orig_user["uid"])
+        self.assertEqual(user["generation"], 43)
+        self.assertEqual(user["client_state"], "aaa")
+        self.assertEqual(set(user["old_client_states"]), set(("",)))
+        self.assertEqual(self.backend.get_user("sync-1.0",
+                                               "test@mozilla.com"), user)
+        # Previously-seen client-state values are rejected.
+        with self.assertRaises(BackendError):
+            self.backend.get_user("sync-1.0", "test@mozilla.com",
+                                  client_state="")
+        # Unknown users are not created.
+        user = self.backend.get_user("sync-1.0", "new@mozilla.com",
+                                     generation=12, client_state="aaa")
+        self.assertEqual(user, None)
+
+    def test_get_user_all_services(self):
+        email = "test@mozilla.com"
+        self.backend.add_node("sync-1.5", "https://phx13", 100)
+        self.backend.create_user("sync-1.0", email, client_state="aaa")
+        user = self.backend.create_user("sync-1.5", email)
+        self.backend.update_user("sync-1.5", user, client_state="bbb")
+        self.backend.create_user("sync-1.0", "other@mozilla.com")
+        users = self.backend.get_user_all_services(email)
+        self.assertEqual(sorted(users), ["sync-1.0", "sync-1.5"])
+        self.assertEqual(users["sync-1.0"],
+                         self.backend.get_user("sync-1.0", email))
+        self.assertEqual(users["sync-1.5"], user)
+        self.assertEqual(set(users["sync-1.5"]["old_client_states"]),
+                         set([""]))
+        # Only the requested services are looked at.
+        users = self.backend.get_user_all_services(
+            email, ["sync-1.5", "queuey-1.0"])
+        self.assertEqual(list(users), ["sync-1.5"])
+        # Replaced records get a new assignment, just as with get_user().
+        orig_user = self.backend.get_user("sync-1.0", email)
+        self.backend.replace_user_records("sync-1.0", email)
+        users = self.backend.get_user_all_services(email, ["sync-1.0"])
+        self.assertNotEqual(users["sync-1.0"]["uid"], orig_user["uid"])
+        self.assertEqual(users["sync-1.0"]["client_state"], "aaa")
+        self.assertEqual(
+            self.backend.get_user_all_services("new@mozilla.com"), {})
+        # The list of services is cached with the endpoint patterns, rather
+        # than read from the database every time.
+        get_patterns = self.backend.get_patterns
+        calls = []
+        self.backend.get_patterns = lambda: calls.append(1) or get_patterns()
+        for i in range(3):
+            users = self.backend.get_user_all_services(email)
+            self.assertEqual(sorted(users), ["sync-1.0", "sync-1.5"])
+        self.assertTrue(len(calls) <= 1)
+
+    def test_endpoints(self):
+        user = self.backend.create_user("sync-1.0", "test1@mozilla.com")
+        self.assertEqual(self.backend.get_endpoint("sync-1.0", user),
+                         "https://phx12/1.0/%d" % user["uid"])
+        self.backend.add_node("queuey-1.0", "https://phx13", 100)
+        users = [self.backend.create_user("queuey-1.0", email)
+                 for email in ("test1@mozilla.com", "test2@mozilla.com")]
+        self.assertEqual(self.backend.get_endpoints("queuey-1.0", users), [
+            "https://phx13/queuey-1.0/%d" % u["uid"] for u in users])
+        self.assertEqual(self.backend.get_endpoints("queuey-1.0", []), [])
+        self.assertRaises(BackendError, self.backend.get_endpoint,
+                          "nonexistent-1.0", user)
+        # Services added later are picked up straight away.
+        self.backend.add_service("sync-2.0", "{node}/2.0/{uid}")
+        self.assertEqual(self.backend.get_endpoint("sync-2.0", user),
+                         "https://phx12/2.0/%d" % user["uid"])
+
     def test_user_retirement(self):
         self.backend.create_user("sync-1.0", "test@mozilla.com")
         user1 = self.backend.get_user("sync-1.0", "test@mozilla.com")
@@ -175,6 +318,56 @@ class NodeAssignmentTests(object):
         old_records = list(self.backend.get_old_user_records(service, 0))
         self.assertEqual(len(old_records), 4)
 
+    def test_compaction_of_client_state_history(self):
+        service = "sync-1.0"
+        email = "test@mozilla.com"
+        user = self.backend.create_user(service, email)
+        for i in range(25):
+            self.backend.update_user(service, user, client_state="%032x" % i)
+        self.assertEqual(len(user["old_client_states"]), 25)
+        # History isn't limited by the number of records read.
+        user = self.backend.get_user(service, email)
+        self.assertEqual(len(user["old_client_states"]), 25)
+        self.assertTrue("" in user["old_client_states"])
+        self.assertEqual(self.backend.compact_user_records(service, 0), 25)
+        records = list(self.backend.get_user_records(service, email))
+        self.assertEqual(len(records), 1)
+        user = self.backend.get_user(service, email)
+        self.assertEqual(user["uid"], records[0].uid)
+        self.assertEqual(user["client_state"], "%032x" % 24)
+        self.assertEqual(len(user["old_client_states"]), 25)
+        with self.assertRaises(BackendError):
+            self.backend.update_user(service, user, client_state="")
+        # The history survives node reassignment.
+        self.backend.unassign_node(service, "https://phx12")
+        user = self.backend.get_user(service, email)
+        self.assertNotEqual(user["uid"], records[0].uid)
+        self.assertEqual(len(user["old_client_states"]), 25)
+
+    def test_migration_of_client_state_history(self):
+        service = "sync-1.0"
+        email = "test@mozilla.com"
+        # Records imported without history look like legacy records.
+        now = get_timestamp()
+        self.backend.bulk_import_users(service, [
+            {"email": email, "client_state": "aaa", "created_at": now - 2,
+             "replaced_at": now - 1},
+            {"email": email, "client_state": "bbb", "created_at": now - 1},
+        ])
+        user = self.backend.get_user(service, email)
+        self.assertEqual(user["client_state"], "bbb")
+        self.assertEqual(set(user["old_client_states"]), set(["aaa"]))
+        self.assertEqual(
+            self.backend.migrate_client_state_history(service, 0), 1)
+        self.assertEqual(
+            self.backend.migrate_client_state_history(service, 0), 0)
+        records = list(self.backend.get_user_records(service, email))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].client_state_history, "aaa,")
+        user = self.backend.get_user(service, email)
+        self.assertEqual(user["client_state"], "bbb")
+        self.assertEqual(set(user["old_client_states"]), set(["aaa"]))
+
     def test_node_reassignment_when_records_are_replaced(self):
         self.backend.create_user("sync-1.0", "test@mozilla.com",
                                  generation=42, client_state="aaa")
@@ -194,6 +387,12 @@ class NodeAssignmentTests(object):
         self.assertEqual(user2["uid"], user1["uid"])
         self.assertEqual(user2["generation"], MAX_GENERATION)
         self.assertEqual(user2["client_state"], user2["client_state"])
+        # Nor are retired users updated by get_user().
+        user3 = self.backend.get_user("sync-1.0", "test@mozilla.com",
+                                      generation=43, client_state="bbb")
+        self.assertEqual(user3, user2)
+        self.assertEqual(self.backend.get_user("sync-1.0",
+                                               "test@mozilla.com"), user2)
 
     def test_recovery_from_racy_record_creation(self):
         timestamp = get_timestamp()
@@ -228,6 +427,182 @@ class NodeAssignmentTests(object):
         old_records = list(self.backend.get_old_user_records("sync-1.0", 0))
         self.assertEqual(len(old_records), 1)
 
+    def test_streaming_export_of_node_assignments(self):
+        NODE1 = "https://phx12"
+        NODE2 = "https://phx13"
+        self.backend.add_node("sync-1.0", NODE2, 100)
+        emails = ["test%d@mozilla.com" % i for i in range(7)]
+        for email in emails:
+            self.backend.create_user("sync-1.0", email)
+        self.backend.add_node("sync-1.5", NODE1, 100)
+        self.backend.create_user("sync-1.5", "other@mozilla.com")
+        node1_users = list(self.backend.iter_node_users("sync-1.0", NODE1,
+                                                        batch_size=2))
+        node2_users = list(self.backend.iter_node_users("sync-1.0", NODE2,
+                                                        batch_size=2))
+        self.assertEqual(len(node1_users) + len(node2_users), 7)
+        self.assertTrue(all(row.node == NODE1 for row in node1_users))
+        uids = [row.uid for row in node1_users]
+        self.assertEqual(uids, sorted(uids))
+        all_users = list(self.backend.iter_service_users("sync-1.0",
+                                                         batch_size=3))
+        self.assertEqual(sorted(row.email for row in all_users), emails)
+        # Replaced records are only included on request.
+        self.backend.replace_user_records("sync-1.0", emails[0])
+        all_users = list(self.backend.iter_service_users("sync-1.0"))
+        self.assertEqual(len(all_users), 6)
+        all_users = list(self.backend.iter_service_users(
+            "sync-1.0", include_replaced=True))
+        self.assertEqual(len(all_users), 7)
+        # The records can be written straight out as NDJSON or CSV.
+        output = StringIO()
+        count = write_ndjson(self.backend.iter_service_users("sync-1.0"),
+                             output)
+        self.assertEqual(count, 6)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(json.loads(lines[0])["email"], emails[1])
+        output = StringIO()
+        count = write_csv(self.backend.iter_service_users("sync-1.0"), output)
+        self.assertEqual(count, 6)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 7)
+        self.assertTrue(lines[0].startswith("uid,email,node"))
+
+    def test_bulk_import_of_users(self):
+        NODE1 = "https://phx12"
+        NODE2 = "https://phx13"
+        self.backend.add_node("sync-1.0", NODE2, 100)
+        records = [{"email": "test%d@mozilla.com" % i} for i in range(10)]
+        records[0]["node"] = NODE2
+        records[0]["generation"] = 12
+        records[0]["client_state"] = "aaa"
+        records[1]["replaced_at"] = get_timestamp()
+        checkpoints = []
+        count = self.backend.bulk_import_users("sync-1.0", records,
+                                               batch_size=4,
+                                               checkpoint=checkpoints.append)
+        self.assertEqual(count, 10)
+        self.assertEqual(checkpoints, [4, 8, 10])
+        user = self.backend.get_user("sync-1.0", "test0@mozilla.com")
+        self.assertEqual(user["node"], NODE2)
+        self.assertEqual(user["generation"], 12)
+        self.assertEqual(user["client_state"], "aaa")
+        # Auto-assigned users are balanced across the nodes, and the
+        # replaced record does not count towards node load.
+        node_counts = defaultdict(lambda: 0)
+        for row in self.backend.iter_service_users("sync-1.0"):
+            node_counts[row.node] += 1
+        self.assertEqual(node_counts[NODE1] + node_counts[NODE2], 9)
+        self.assertTrue(abs(node_counts[NODE1] - node_counts[NODE2]) <= 1)
+        # The node counters were updated to match.
+        user = self.backend.create_user("sync-1.0", "new@mozilla.com")
+        if node_counts[NODE1] < node_counts[NODE2]:
+            self.assertEqual(user["node"], NODE1)
+        else:
+            self.assertEqual(user["node"], NODE2)
+        # An interrupted import can be resumed from a checkpoint.
+        records = [{"email": "more%d@mozilla.com" % i} for i in range(5)]
+        count = self.backend.bulk_import_users("sync-1.0", records, skip=3)
+        self.assertEqual(count, 5)
+        self.assertEqual(self.backend.get_user("sync-1.0",
+                                               "more2@mozilla.com"), None)
+        self.assertNotEqual(self.backend.get_user("sync-1.0",
+                                                  "more3@mozilla.com"), None)
+
+    def test_draining_a_node(self):
+        NODE1 = "https://phx12"
+        NODE2 = "https://phx13"
+        NODE3 = "https://phx14"
+        users = []
+        for i in range(5):
+            email = "test%d@mozilla.com" % i
+            users.append(self.backend.create_user("sync-1.0", email,
+                                                  generation=i))
+        self.backend.retire_user("test4@mozilla.com")
+        self.backend.add_node("sync-1.0", NODE2, 100)
+        self.backend.add_node("sync-1.0", NODE3, 100)
+        checkpoints = []
+        moved = self.backend.drain_node("sync-1.0", NODE1, batch_size=3,
+                                        interval=0, max_batches=1,
+                                        checkpoint=checkpoints.append)
+        self.assertEqual(moved, 3)
+        self.assertEqual(checkpoints, [3])
+        # Draining can pick up where it left off.
+        moved = self.backend.drain_node("sync-1.0", NODE1, batch_size=3,
+                                        interval=0)
+        self.assertEqual(moved, 1)
+        self.assertEqual(list(self.backend.iter_node_users("sync-1.0",
+                                                           NODE1)), [])
+        node_counts = defaultdict(lambda: 0)
+        for user in users[:4]:
+            new_user = self.backend.get_user("sync-1.0", user["email"])
+            self.assertNotEqual(new_user["uid"], user["uid"])
+            self.assertEqual(new_user["generation"], user["generation"])
+            self.assertEqual(new_user["client_state"], user["client_state"])
+            node_counts[new_user["node"]] += 1
+        self.assertEqual(node_counts[NODE2], 2)
+        self.assertEqual(node_counts[NODE3], 2)
+        # The retired user was left alone.
+        user = self.backend.get_user("sync-1.0", "test4@mozilla.com")
+        self.assertEqual(user["uid"], users[4]["uid"])
+        self.assertEqual(user["generation"], MAX_GENERATION)
+        # The drained node gets no new assignments.
+        for i in range(4):
+            user = self.backend.create_user("sync-1.0", "new%d@moz.com" % i)
+            self.assertNotEqual(user["node"], NODE1)
+
+    def test_dropping_all_users_for_a_service(self):
+        self.backend.add_node("sync-1.5", "https://phx12", 100)
+        self.backend.create_user("sync-1.0", "test1@mozilla.com")
+        self.backend.create_user("sync-1.0", "test2@mozilla.com")
+        self.backend.create_user("sync-1.5", "test1@mozilla.com")
+        self.backend.drop_service_users("sync-1.0")
+        self.assertEqual(list(self.backend.iter_service_users(
+            "sync-1.0", include_replaced=True)), [])
+        user = self.backend.get_user("sync-1.5", "test1@mozilla.com")
+        self.assertEqual(user["node"], "https://phx12")
+
+    def test_calls_are_bounded_by_their_timeout(self):
+        self.backend.create_user("sync-1.0", "test1@mozilla.com")
+        user = self.backend.get_user("sync-1.0", "test1@mozilla.com",
+                                     timeout=30)
+        self.assertEqual(user["node"], "https://phx12")
+        self.assertRaises(DeadlineExceeded, self.backend.get_user,
+                          "sync-1.0", "test1@mozilla.com", timeout=-1)
+        # The deadline also covers iterating over generators.
+        users = self.backend.iter_service_users("sync-1.0", timeout=30)
+        self.assertEqual(len(list(users)), 1)
+
+    def test_long_running_queries_are_interrupted_at_the_deadline(self):
+        if not self.backend._is_sqlite:
+            return
+        query = sqltext("with recursive r(n) as (select 1 union all "
+                        "select n + 1 from r) select count(*) from r")
+        start = time.time()
+        with deadline(0.05):
+            engine = self.backend._get_engine("sync-1.0")
+            self.assertRaises(DeadlineExceeded, self.backend._safe_execute,
+                              query, engine=engine)
+        self.assertTrue(time.time() - start < 5)
+        # The connection can be used normally afterwards.
+        self.backend.create_user("sync-1.0", "test1@mozilla.com")
+        user = self.backend.get_user("sync-1.0", "test1@mozilla.com")
+        self.assertEqual(user["node"], "https://phx12")
+
+    def test_calls_within_a_session(self):
+        with self.backend.session():
+            self.assertEqual(self.backend.get_user("sync-1.0",
+                                                   "test1@mozilla.com"), None)
+            user = self.backend.create_user("sync-1.0", "test1@mozilla.com")
+            with self.backend.session(transaction=True):
+                self.backend.update_user("sync-1.0", user, client_state="a")
+        with self.backend.session(transaction=True):
+            self.backend.create_user("sync-1.0", "test2@mozilla.com")
+        for email in ("test1@mozilla.com", "test2@mozilla.com"):
+            user = self.backend.get_user("sync-1.0", email)
+            self.assertEqual(user["node"], "https://phx12")
+
     def test_node_reassignment_and_removal(self):
         NODE1 = "https://phx12"
         NODE2 = "https://phx13"
@@ -300,7 +675,822 @@ class TestSQLDB(NodeAssignmentTests, TestCase):
             self.backend._safe_execute('drop table nodes;')
             self.backend._safe_execute('drop table users;')
 
+    def test_draining_does_not_undo_concurrent_updates(self):
+        self.backend.add_node("sync-1.0", "https://phx13", 100)
+        user = self.backend.create_user("sync-1.0", "test@mozilla.com")
+        rows = list(self.backend.iter_node_users("sync-1.0", user["node"]))
+        # The user changes their client state after the drain read them.
+        self.backend.update_user("sync-1.0", user, client_state="aaa")
+        moved = self.backend._move_users(
+            "sync-1.0", self.backend._get_service_id("sync-1.0"),
+            self.backend._engine, rows)
+        self.assertEqual(moved, 0)
+        user = self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.assertEqual(user["client_state"], "aaa")
+
+    def test_draining_does_not_undo_updates_in_progress(self):
+        self.backend.add_node("sync-1.0", "https://phx13", 100)
+        user = self.backend.create_user("sync-1.0", "test@mozilla.com")
+        rows = list(self.backend.iter_node_users("sync-1.0", user["node"]))
+        # The drain runs after update_user() has written the new record,
+        # but before it has marked the old one as replaced.
+        replace_user_records = self.backend.replace_user_records
+        pending = []
+        self.backend.replace_user_records = \
+            lambda *args: pending.append(args)
+        self.backend.update_user("sync-1.0", user, client_state="aaa")
+        del self.backend.replace_user_records
+        moved = self.backend._move_users(
+            "sync-1.0", self.backend._get_service_id("sync-1.0"),
+            self.backend._engine, rows)
+        self.assertEqual(moved, 0)
+        replace_user_records(*pending[0])
+        user = self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.assertEqual(user["client_state"], "aaa")
+        records = list(self.backend.get_user_records("sync-1.0",
+                                                     "test@mozilla.com"))
+        self.assertEqual(len(records), 2)
+
+    def test_rows_can_be_fetched_after_the_deadline(self):
+        if not self.backend._is_sqlite:
+            self.skipTest("the progress handler is specific to sqlite")
+        query = sqltext("with recursive r(n) as (select 1 union all "
+                        "select n + 1 from r limit 100000) select n from r")
+        engine = self.backend._get_engine("sync-1.0")
+        with deadline(0.05):
+            res = self.backend._safe_execute(query, engine=engine)
+            time.sleep(0.1)
+            # Only the statement itself is bounded by the deadline.
+            self.assertEqual(len(res.fetchall()), 100000)
+
+    def test_timeouts_are_only_changed_when_needed(self):
+        if not self.backend._is_sqlite:
+            self.skipTest("checks the sqlite busy timeout")
+        engine = self.backend._get_engine("sync-1.0")
+        with self.backend._connect(engine) as connection:
+            default = connection.execute("PRAGMA busy_timeout").scalar()
+            with deadline(30):
+                self.backend._safe_execute("select 1", engine=connection)
+                applied = connection.info["wimms_timeouts"]["busy_timeout"]
+                self.backend._safe_execute("select 1", engine=connection)
+                self.assertEqual(
+                    connection.info["wimms_timeouts"]["busy_timeout"],
+                    applied)
+                time.sleep(0.15)
+                self.backend._safe_execute("select 1", engine=connection)
+                self.assertTrue(
+                    connection.info["wimms_timeouts"]["busy_timeout"] <
+                    applied)
+            # This is what happens when it goes back to the pool.
+            fairy = connection.connection
+            self.backend._reset_statement_timeout(fairy.connection,
+                                                  fairy._connection_record)
+            self.assertEqual(
+                connection.execute("PRAGMA busy_timeout").scalar(), default)
+            self.assertFalse("wimms_timeouts" in connection.info)
+
+    def test_session_uses_a_single_connection(self):
+        checkouts = []
+        event.listen(self.backend._engine, "checkout",
+                     lambda *args: checkouts.append(1))
+        with self.backend.session():
+            self.backend.create_user("sync-1.0", "test1@mozilla.com")
+            self.backend.get_user("sync-1.0", "test1@mozilla.com",
+                                  client_state="aaa", timeout=30)
+        self.assertEqual(len(checkouts), 1)
+        # Changes made in a transaction are rolled back on error.
+        try:
+            with self.backend.session(transaction=True):
+                self.backend.create_user("sync-1.0", "test2@mozilla.com")
+                raise ValueError("oops")
+        except ValueError:
+            pass
+        self.assertEqual(self.backend.get_user("sync-1.0",
+                                               "test2@mozilla.com"), None)
+        loads = self.backend._get_node_loads("sync-1.0")
+        self.assertEqual(loads[0].current_load, 1)
+
+    def test_deadlines_end_with_their_statement_in_a_session(self):
+        with self.backend.session():
+            self.backend.create_user("sync-1.0", "test1@mozilla.com")
+            connection = self.backend._get_session().connections.values()[0]
+            self.backend.get_user("sync-1.0", "test1@mozilla.com",
+                                  timeout=0.5)
+            # Later statements in the session aren't bound by the timeout.
+            self.assertFalse("wimms_timeouts" in connection.info)
+            self.assertFalse("wimms_deadline" in connection.info)
+            time.sleep(0.5)
+            self.backend.create_user("sync-1.0", "test2@mozilla.com")
+        user = self.backend.get_user("sync-1.0", "test2@mozilla.com")
+        self.assertEqual(user["node"], "https://phx12")
+
+
+class TestSQLDBWithGroupCommit(TestSQLDB):
+
+    def setUp(self):
+        self.backend = SQLMetadata(self._SQLURI, create_tables=True,
+                                   group_commit_delay=0.001)
+        super(TestSQLDB, self).setUp()
+
+    def test_concurrent_creates_are_committed_in_batches(self):
+        self.backend._group_commit_delay = 0.05
+        self.backend.add_node("sync-1.0", "https://phx13", 100)
+        users = {}
+
+        def create_user(i):
+            email = "test%d@mozilla.com" % i
+            users[email] = self.backend.create_user("sync-1.0", email)
+
+        threads = [threading.Thread(target=create_user, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(users), 8)
+        # Each caller got back its own record.
+        self.assertEqual(len(set(user["uid"] for user in users.values())), 8)
+        for email, user in users.items():
+            self.assertEqual(self.backend.get_user("sync-1.0", email), user)
+        stats = self.backend.get_group_commit_stats()
+        self.assertEqual(stats["items"], 8)
+        self.assertTrue(stats["batches"] < 8)
+        # The node counters reflect the new assignments.
+        node_loads = dict((row.node, row.current_load) for row in
+                          self.backend._get_node_loads("sync-1.0"))
+        node_counts = defaultdict(lambda: 0)
+        for user in users.values():
+            node_counts[user["node"]] += 1
+        self.assertEqual(node_loads, node_counts)
+
+
+class TestSQLDBWithRequestCoalescing(TestSQLDB):
+
+    def setUp(self):
+        self.backend = SQLMetadata(self._SQLURI, create_tables=True,
+                                   coalesce_requests=True)
+        super(TestSQLDB, self).setUp()
+
+    def test_concurrent_lookups_share_a_single_reallocation(self):
+        orig_user = self.backend.create_user("sync-1.0", "test@mozilla.com")
+        self.backend.unassign_node("sync-1.0", "https://phx12")
+        # Slow down the lookups so that they overlap.
+        orig_get_user = self.backend._get_user
+
+        def slow_get_user(*args):
+            time.sleep(0.05)
+            return orig_get_user(*args)
+
+        self.backend._get_user = slow_get_user
+        users = []
+
+        def get_user():
+            users.append(self.backend.get_user("sync-1.0",
+                                               "test@mozilla.com"))
+
+        threads = [threading.Thread(target=get_user) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(users), 5)
+        new_uids = set(user["uid"] for user in users)
+        self.assertEqual(len(new_uids), 1)
+        self.assertNotEqual(users[0]["uid"], orig_user["uid"])
+        # Each caller got its own copy of the record.
+        self.assertEqual(len(set(id(user) for user in users)), 5)
+        # Only one new record was created.
+        records = list(self.backend.get_user_records("sync-1.0",
+                                                     "test@mozilla.com"))
+        self.assertEqual(len(records), 2)
+        stats = self.backend.get_coalescing_stats()
+        self.assertTrue(stats["calls"] >= 5)
+        self.assertTrue(stats["coalesced"] >= 1)
+
+
+class TestSQLDBWithUserFilter(TestSQLDB):
+
+    def setUp(self):
+        self.backend = SQLMetadata(self._SQLURI, create_tables=True,
+                                   user_filter_capacity=1000)
+        super(TestSQLDB, self).setUp()
+        self.backend.rebuild_user_filter()
+
+    def test_users_created_elsewhere_are_not_duplicated(self):
+        other_worker = SQLMetadata(self._SQLURI)
+        user = other_worker.create_user("sync-1.0", "test@mozilla.com")
+        self.assertEqual(self.backend.get_user("sync-1.0",
+                                               "test@mozilla.com"), None)
+        self.assertEqual(self.backend.create_user("sync-1.0",
+                                                  "test@mozilla.com"), user)
+        self.assertEqual(len(list(self.backend.get_user_records(
+            "sync-1.0", "test@mozilla.com"))), 1)
+        self.assertEqual(self.backend.get_user("sync-1.0",
+                                               "test@mozilla.com"), user)
+
+    def test_replaced_users_created_elsewhere_are_reallocated(self):
+        other_worker = SQLMetadata(self._SQLURI)
+        user = other_worker.create_user("sync-1.0", "test@mozilla.com")
+        other_worker.unassign_node("sync-1.0", "https://phx12")
+        self.assertEqual(self.backend.get_user("sync-1.0",
+                                               "test@mozilla.com"), None)
+        new_user = self.backend.create_user("sync-1.0", "test@mozilla.com")
+        self.assertNotEqual(new_user["uid"], user["uid"])
+        self.assertEqual(len(list(self.backend.get_user_records(
+            "sync-1.0", "test@mozilla.com"))), 2)
+        self.assertEqual(self.backend.get_user("sync-1.0",
+                                               "test@mozilla.com"), new_user)
+
+    def test_unknown_users_are_answered_from_the_filter(self):
+        self.backend.create_user("sync-1.0", "test1@mozilla.com")
+        # Simulate a user created by some other process.
+        self.backend.bulk_import_users("sync-1.0",
+                                       [{"email": "test2@mozilla.com"}])
+        self.backend._user_filter = UserFilter(1000)
+        self.assertEqual(self.backend.get_user_filter_stats(),
+                         {"ready": False})
+        self.assertNotEqual(self.backend.get_user("sync-1.0",
+                                                  "test1@mozilla.com"), None)
+        self.backend.rebuild_user_filter()
+        self.backend.create_user("sync-1.0", "test3@mozilla.com")
+        for i in (1, 2, 3):
+            user = self.backend.get_user("sync-1.0", "test%d@mozilla.com" % i)
+            self.assertNotEqual(user, None)
+        for i in range(100):
+            user = self.backend.get_user("sync-1.0", "new%d@mozilla.com" % i)
+            self.assertEqual(user, None)
+        stats = self.backend.get_user_filter_stats()
+        self.assertTrue(stats["ready"])
+        self.assertEqual(stats["keys"], 3)
+        self.assertEqual(stats["lookups"], 103)
+        self.assertTrue(stats["skipped"] > 90)
+        self.assertEqual(stats["skipped"] + stats["false_positives"], 100)
+        self.assertEqual(stats["observed_false_positive_rate"],
+                         stats["false_positives"] / 100.0)
+        self.assertTrue(stats["memory_bytes"] < 2000)
+
+
+class TestSQLDBWithSharedSnapshot(TestSQLDB):
+
+    _SNAPSHOT = '/tmp/wimms.snapshot.' + TEMP_ID
+
+    def setUp(self):
+        self.backend = SQLMetadata(self._SQLURI, create_tables=True,
+                                   snapshot_file=self._SNAPSHOT)
+        super(TestSQLDB, self).setUp()
+
+    def tearDown(self):
+        self.backend._snapshot.close()
+        os.remove(self._SNAPSHOT)
+        super(TestSQLDBWithSharedSnapshot, self).tearDown()
+
+    def test_nodes_and_services_are_read_from_the_snapshot(self):
+        self.assertTrue(self.backend._snapshot.acquire_writer())
+        self.backend.refresh_snapshot()
+        # Another process sees the same snapshot.
+        snapshot = SharedSnapshot(self._SNAPSHOT)
+        try:
+            self.assertFalse(snapshot.acquire_writer())
+            data = snapshot.read()
+            self.assertEqual(data["services"]["sync-1.0"][1],
+                             "{node}/1.0/{uid}")
+            self.assertEqual(data["nodes"]["sync-1.0"],
+                             [["https://phx12", 100, 0, 100, 0]])
+        finally:
+            snapshot.close()
+        # Until it's refreshed, allocations go by the snapshot...
+        self.backend.add_node("sync-1.0", "https://phx13", 100)
+        self.backend._safe_execute(sqltext(
+            "update nodes set current_load=50 "
+            "where node='https://phx12'")).close()
+        self.backend._cached_service_ids.clear()
+        user = self.backend.create_user("sync-1.0", "test1@mozilla.com")
+        self.assertEqual(user["node"], "https://phx12")
+        # ...except for nodes that have since been downed.
+        self.backend._safe_execute(sqltext(
+            "update nodes set downed=1 where node='https://phx12'")).close()
+        user = self.backend.create_user("sync-1.0", "test2@mozilla.com")
+        self.assertEqual(user["node"], "https://phx13")
+        self.backend.refresh_snapshot()
+        self.backend._safe_execute(sqltext(
+            "update nodes set downed=1 where node='https://phx13'")).close()
+        self.assertRaises(BackendError, self.backend.create_user,
+                          "sync-1.0", "test3@mozilla.com")
+        # A snapshot that's too old is ignored.
+        self.backend._snapshot_max_age = 0
+        self.assertEqual(self.backend._read_snapshot(), None)
+
+    def test_snapshot_nodes_are_not_filled_past_capacity(self):
+        self.assertTrue(self.backend._snapshot.acquire_writer())
+        self.backend.refresh_snapshot()
+        self.backend.add_node("sync-1.0", "https://phx13", 100)
+        # The node has filled up since, though it still has slots left.
+        self.backend._safe_execute(sqltext(
+            "update nodes set current_load=100 "
+            "where node='https://phx12'")).close()
+        user = self.backend.create_user("sync-1.0", "test1@mozilla.com")
+        self.assertEqual(user["node"], "https://phx13")
+        loads = dict((row.node, row.current_load)
+                     for row in self.backend._get_node_loads("sync-1.0"))
+        self.assertEqual(loads["https://phx12"], 100)
+
+    def test_endpoint_patterns_are_read_from_the_snapshot(self):
+        self.assertTrue(self.backend._snapshot.acquire_writer())
+        self.backend.refresh_snapshot()
+        self.backend._safe_execute(sqltext(
+            "update services set pattern='{node}/x/{uid}'")).close()
+        user = {"node": "https://phx12", "uid": 1}
+        self.assertEqual(self.backend.get_endpoint("sync-1.0", user),
+                         "https://phx12/1.0/1")
+        # Services missing from the snapshot are looked up in the database.
+        self.backend.add_service("sync-2.0", "{node}/2.0/{uid}")
+        self.assertEqual(self.backend.get_endpoint("sync-2.0", user),
+                         "https://phx12/2.0/1")
+        self.assertEqual(self.backend.get_endpoint("sync-1.0", user),
+                         "https://phx12/x/1")
+
+
+class TestSQLDBWithSlowQueryLog(TestSQLDB):
+
+    def setUp(self):
+        self.backend = SQLMetadata(self._SQLURI, create_tables=True,
+                                   slow_query_threshold=0.000001,
+                                   slow_query_log_size=10,
+                                   slow_query_explain_rate=1,
+                                   slow_query_secret="s3cret")
+        super(TestSQLDB, self).setUp()
+
+    def test_slow_queries_are_logged(self):
+        self.backend.create_user("sync-1.0", "test@mozilla.com")
+        self.backend.get_user("sync-1.0", "test@mozilla.com")
+        entry = self.backend.get_slow_queries()[-1]
+        self.assertEqual(entry["statement"], "_GET_CURRENT_USER_RECORDS")
+        self.assertEqual(entry["method"], "get_user")
+        self.assertEqual(entry["params"]["email"],
+                         hash_email("test@mozilla.com", "s3cret"))
+        self.assertTrue(entry["duration"] > 0)
+        self.assertEqual(entry["error"], None)
+        self.assertTrue(entry["plan"])
+        self.assertTrue("users" in str(entry["plan"]))
+        self.backend.unassign_node("sync-1.0", "https://phx12")
+        entry = self.backend.get_slow_queries()[-1]
+        self.assertEqual(entry["method"], "unassign_node")
+        self.assertTrue(entry["statement"].startswith("update users"))
+        self.assertEqual(entry["plan"], None)
+        self.backend.get_best_node("sync-1.0")
+        statements = [e["statement"] for e in self.backend.get_slow_queries()]
+        self.assertEqual(statements[-2:], ["select from nodes",
+                                           "update nodes"])
+        stream = StringIO()
+        self.assertEqual(self.backend.dump_slow_queries(stream), 10)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(json.loads(lines[-1])["method"], "get_best_node")
+        self.assertFalse("test@mozilla.com" in stream.getvalue())
+
+    def test_emails_are_hashed_with_the_secret(self):
+        token = hash_email("test@mozilla.com", "s3cret")
+        self.assertEqual(token, hash_email(u"test@mozilla.com", "s3cret"))
+        self.assertNotEqual(token, hash_email("test@mozilla.com", "other"))
+        self.assertNotEqual(token, hash_email("test2@mozilla.com", "s3cret"))
+
+    def test_fetching_the_rows_counts_towards_the_duration(self):
+        if not self.backend._is_sqlite:
+            self.skipTest("uses a sqlite query with slow-to-fetch rows")
+        query = sqltext("with recursive r(n) as (select 1 union all "
+                        "select n + 1 from r limit 300000) select n from r")
+        engine = self.backend._get_engine("sync-1.0")
+        log = self.backend._slow_query_log
+        log.threshold = 0.05
+        recorded = log.recorded
+        res = self.backend._safe_execute(query, engine=engine)
+        self.assertEqual(log.recorded, recorded)
+        self.assertEqual(len(res.fetchall()), 300000)
+        self.assertEqual(log.recorded, recorded + 1)
+        entry = self.backend.get_slow_queries()[-1]
+        self.assertTrue(entry["statement"].startswith("with recursive"))
+        self.assertTrue(entry["duration"] >= 0.05)
+
+
+class TestSQLDBWithProfiling(TestSQLDB):
+
+    def setUp(self):
+        self.backend = SQLMetadata(self._SQLURI, create_tables=True,
+                                   profile=True, profile_sample_rate=0.5)
+        super(TestSQLDB, self).setUp()
+
+    def test_methods_are_profiled(self):
+        self.backend._profiler.sample_rate = 1
+        self.backend.get_user("sync-1.0", "test@mozilla.com")
+        self.backend.create_user("sync-1.0", "test@mozilla.com")
+        self.backend.get_user("sync-1.0", "test@mozilla.com",
+                              client_state="aaa")
+        stats = self.backend.get_profile_stats()
+        self.assertEqual(stats["get_user"]["calls"], 2)
+        self.assertEqual(stats["get_user"]["profiled"], 2)
+        # Nested calls count towards the outermost one.
+        self.assertEqual(stats["create_user"]["calls"], 1)
+        self.assertFalse("update_user" in stats)
+        for method_stats in stats.values():
+            self.assertTrue(method_stats["statements"] > 0)
+            self.assertTrue(0 < method_stats["db"] <= method_stats["wall"])
+            self.assertTrue(method_stats["cpu"] > 0)
+        self.assertRaises(BackendError, self.backend.add_node,
+                          "nonexistent-1.0", "https://phx13", 100)
+        stats = self.backend.get_profile_stats()["add_node"]
+        self.assertEqual((stats["calls"], stats["errors"]), (2, 1))
+        stream = StringIO()
+        self.backend.dump_profile(stream)
+        self.assertTrue("get_user" in stream.getvalue())
+        self.assertTrue("function calls" in stream.getvalue())
+
+    def test_generators_are_profiled_while_iterating(self):
+        for i in range(3):
+            self.backend.create_user("sync-1.0", "test%d@mozilla.com" % i)
+        users = self.backend.iter_service_users("sync-1.0", batch_size=2)
+        self.assertFalse("iter_service_users" in
+                         self.backend.get_profile_stats())
+        self.assertEqual(len(list(users)), 3)
+        stats = self.backend.get_profile_stats()["iter_service_users"]
+        self.assertEqual((stats["calls"], stats["errors"]), (1, 0))
+        self.assertEqual(stats["statements"], 2)
+        self.assertTrue(0 < stats["db"] <= stats["wall"])
+        # Stopping early still counts as a call.
+        users = self.backend.iter_node_users("sync-1.0", "https://phx12")
+        users.next()
+        users.close()
+        stats = self.backend.get_profile_stats()["iter_node_users"]
+        self.assertEqual((stats["calls"], stats["errors"]), (1, 0))
+        self.assertEqual(stats["statements"], 1)
+
+    def test_profile_is_dumped_on_signal(self):
+        filename = "/tmp/wimms.profile." + TEMP_ID
+        backend = SQLMetadata(self._SQLURI, profile=True,
+                              profile_signal="SIGUSR2",
+                              profile_dump_path=filename)
+        try:
+            backend.get_patterns()
+            os.kill(os.getpid(), signal.SIGUSR2)
+            with open(filename) as f:
+                self.assertTrue("get_patterns" in f.read())
+        finally:
+            signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+            os.remove(filename)
+
+    def test_profiling_can_be_enabled_from_the_environment(self):
+        backend = SQLMetadata(self._SQLURI)
+        self.assertEqual(backend._profiler, None)
+        self.assertFalse("get_user" in backend.__dict__)
+        self.assertEqual(backend.get_profile_stats(), {})
+        os.environ["WIMMS_PROFILE"] = "1"
+        try:
+            backend = SQLMetadata(self._SQLURI)
+        finally:
+            del os.environ["WIMMS_PROFILE"]
+        backend.get_patterns()
+        self.assertEqual(backend.get_profile_stats()["get_patterns"]["calls"],
+                         1)
+
+
+class TestSharedSnapshot(TestCase):
+
+    def test_snapshot_read_and_write(self):
+        filename = '/tmp/wimms.snapshot.' + uuid.uuid4().hex
+        writer = SharedSnapshot(filename, 1024)
+        reader = SharedSnapshot(filename, 1024)
+        try:
+            self.assertEqual(reader.read(), None)
+            writer.write({"a": 1})
+            self.assertEqual(reader.read(), {"a": 1})
+            self.assertTrue(reader.read() is reader.read())
+            writer.write({"a": 2})
+            self.assertEqual(reader.read(), {"a": 2})
+            self.assertRaises(ValueError, writer.write, "x" * 1024)
+            # A half-written snapshot is never returned.
+            writer._mmap[0:8] = "\x05" + "\x00" * 7
+            self.assertEqual(reader.read(), None)
+            writer.write({"a": 3})
+            self.assertEqual(reader.read(), {"a": 3})
+            # Nor is one whose length doesn't match the data.
+            for length in (1024, 3):
+                struct.pack_into("<I", writer._mmap, 16, length)
+                self.assertEqual(SharedSnapshot(filename, 1024).read(), None)
+        finally:
+            writer.close()
+            reader.close()
+            os.remove(filename)
+
+    def test_forked_processes_do_not_share_the_write_lock(self):
+        filename = '/tmp/wimms.snapshot.' + uuid.uuid4().hex
+        snapshot = SharedSnapshot(filename, 1024)
+        try:
+            self.assertTrue(snapshot.acquire_writer())
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os._exit(2 if snapshot.acquire_writer() else 0)
+                finally:
+                    os._exit(1)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            self.assertTrue(snapshot.acquire_writer())
+        finally:
+            snapshot.close()
+            os.remove(filename)
+
+
+class TestEndpointPatterns(TestCase):
+
+    def test_formatting(self):
+        for pattern in ("{node}/1.5/{uid}", "{service}://{node}/{uid}",
+                        "{node}/100%/{uid}", "{{node}}/{uid}", "{node}",
+                        "{uid:08d}/{node!r}", "{node.upper}", "static"):
+            expected = pattern.format(uid=42, node="https://phx12",
+                                      service="sync-1.5")
+            self.assertEqual(EndpointPattern(pattern).format(
+                "sync-1.5", "https://phx12", 42), expected)
+
+    def test_bad_patterns_fail_when_used(self):
+        for pattern in ("{node}/{uid", "{nonexistent}", "{0}"):
+            pattern = EndpointPattern(pattern)
+            self.assertRaises((ValueError, KeyError, IndexError),
+                              pattern.format, "sync-1.5", "https://phx12", 42)
+
+    def test_reloading(self):
+        services = {"sync-1.5": "{node}/1.5/{uid}", "sync-2.0": None}
+        loads = []
+
+        def load(service):
+            loads.append(service)
+            if services is None:
+                raise BackendError("database is down")
+            return services.items()
+
+        patterns = EndpointPatterns(load, max_age=0.1)
+        self.assertEqual(patterns.get("sync-1.5").pattern, "{node}/1.5/{uid}")
+        self.assertRaises(BackendError, patterns.get, "sync-2.0")
+        self.assertRaises(BackendError, patterns.get, "sync-3.0")
+        self.assertEqual(len(loads), 1)
+        services["sync-1.5"] = "{node}/1.5/user/{uid}"
+        self.assertEqual(patterns.get("sync-1.5").pattern, "{node}/1.5/{uid}")
+        time.sleep(0.2)
+        self.assertEqual(patterns.get("sync-1.5").pattern,
+                         "{node}/1.5/user/{uid}")
+        self.assertEqual(len(loads), 2)
+        # Reload errors are logged, and the old patterns kept meanwhile.
+        services = None
+        patterns.invalidate()
+        self.assertEqual(patterns.get("sync-1.5").pattern,
+                         "{node}/1.5/user/{uid}")
+        time.sleep(0.2)
+        self.assertRaises(BackendError, patterns.get, "sync-3.0")
+
+    def test_listing_services(self):
+        services = {"sync-1.5": "{node}/1.5/{uid}", "sync-2.0": None}
+        loads = []
+
+        def load(service):
+            loads.append(service)
+            if services is None:
+                raise BackendError("database is down")
+            return services.items()
+
+        patterns = EndpointPatterns(load, max_age=0.1)
+        self.assertEqual(sorted(patterns.get_services()),
+                         ["sync-1.5", "sync-2.0"])
+        self.assertEqual(patterns.get("sync-1.5").pattern, "{node}/1.5/{uid}")
+        self.assertEqual(loads, [None])
+        services["sync-3.0"] = "{node}/3.0/{uid}"
+        self.assertEqual(len(patterns.get_services()), 2)
+        patterns.invalidate()
+        self.assertEqual(len(patterns.get_services()), 3)
+        # Reload errors keep the old list.
+        services = None
+        patterns.invalidate()
+        self.assertEqual(len(patterns.get_services()), 3)
+        self.assertRaises(BackendError, EndpointPatterns(load).get_services)
+
+
+class TestBloomFilter(TestCase):
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add("key%d" % i)
+        for i in range(1000):
+            self.assertTrue("key%d" % i in bloom)
+        false_positives = sum(1 for i in range(10000)
+                              if "other%d" % i in bloom)
+        self.assertTrue(false_positives < 300)
+        self.assertAlmostEqual(bloom.false_positive_rate, 0.01, places=2)
+        self.assertEqual(bloom.memory_footprint, 1199)
+
+
+class TestSharedCallDeadlines(TestCase):
+
+    def _run_in_thread(self, func, *args):
+        outcome = {}
+
+        def run():
+            try:
+                outcome["result"] = func(*args)
+            except Exception, exc:
+                outcome["error"] = exc
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread, outcome
+
+    def test_group_commits_are_waited_for_until_the_deadline(self):
+        batches = []
+        committer = GroupCommitter(lambda items: batches.append(items) or
+                                   items, 0.2)
+        thread, outcome = self._run_in_thread(committer.submit, "a")
+        time.sleep(0.02)
+        start = time.time()
+        with deadline(0.05):
+            self.assertRaises(DeadlineExceeded, committer.submit, "b")
+        self.assertTrue(time.time() - start < 0.15)
+        thread.join()
+        self.assertEqual(outcome, {"result": "a"})
+        # The item that timed out wasn't written.
+        self.assertEqual(batches, [["a"]])
+
+    def test_group_commits_outlive_the_deadline_of_their_leader(self):
+        batches = []
+
+        def flush(items):
+            if is_expired():
+                raise DeadlineExceeded("deadline exceeded")
+            batches.append(items)
+            return items
+
+        committer = GroupCommitter(flush, 0.05)
+
+        def submit_with_deadline(item):
+            with deadline(0.01):
+                return committer.submit(item)
+
+        thread, outcome = self._run_in_thread(submit_with_deadline, "a")
+        time.sleep(0.02)
+        self.assertEqual(committer.submit("b"), "b")
+        thread.join()
+        self.assertTrue(isinstance(outcome["error"], DeadlineExceeded))
+        self.assertEqual(batches, [["b"]])
+
+    def test_coalesced_calls_are_waited_for_until_the_deadline(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        threading.Timer(1, release.set).start()
+        thread, outcome = self._run_in_thread(
+            flight.do, "key", lambda: release.wait() and "result")
+        time.sleep(0.02)
+        start = time.time()
+        with deadline(0.05):
+            self.assertRaises(DeadlineExceeded, flight.do, "key", list)
+        self.assertTrue(time.time() - start < 0.5)
+        release.set()
+        thread.join()
+        self.assertEqual(outcome, {"result": "result"})
+
+    def test_coalesced_calls_outlive_the_deadline_of_the_first(self):
+        flight = SingleFlight()
+
+        def call():
+            time.sleep(0.05)
+            if is_expired():
+                raise DeadlineExceeded("deadline exceeded")
+            return "result"
+
+        def call_with_deadline():
+            with deadline(0.01):
+                return flight.do("key", call)
+
+        thread, outcome = self._run_in_thread(call_with_deadline)
+        time.sleep(0.02)
+        self.assertEqual(flight.do("key", call), "result")
+        thread.join()
+        self.assertTrue(isinstance(outcome["error"], DeadlineExceeded))
+        self.assertEqual(flight.coalesced, 1)
+
+
+class TestCircuitBreaker(TestCase):
+
+    def test_breaker_trips_on_failure_rate_and_recovers(self):
+        breaker = CircuitBreaker(failure_rate=0.5, min_calls=4,
+                                 reset_timeout=0.05)
+        for success in (True, False, True):
+            breaker.before_call()
+            breaker.after_call(success)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.before_call()
+        breaker.after_call(False)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+        time.sleep(0.05)
+        # A single trial call is let through, which fails.
+        breaker.before_call()
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+        breaker.after_call(False)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        time.sleep(0.05)
+        # The next trial succeeds, closing the breaker.
+        breaker.before_call()
+        breaker.after_call(True)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.before_call()
+        stats = breaker.get_stats()
+        self.assertEqual(stats["trips"], 2)
+        self.assertEqual(stats["rejected"], 2)
+
+    def test_concurrency_limiter(self):
+        limiter = ConcurrencyLimiter(2, max_queued=1, queue_timeout=0.01)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(limiter.get_stats()["inflight"], 2)
+        # With one slot in the queue, we wait and time out.
+        self.assertRaises(OverloadedError, limiter.acquire)
+        limiter.release()
+        limiter.acquire()
+        stats = limiter.get_stats()
+        self.assertEqual(stats["inflight"], 2)
+        self.assertEqual(stats["queued"], 0)
+        self.assertEqual(stats["overloaded"], 1)
+
+    def test_failing_database_trips_the_breaker(self):
+        backend = SQLMetadata("sqlite:////nonexistent/wimms.db",
+                              breaker_failure_rate=0.5, breaker_min_calls=2,
+                              max_inflight=10)
+        for _ in range(2):
+            self.assertRaises(BackendError, backend.add_service,
+                              "sync-1.0", "{node}/1.0/{uid}")
+        self.assertRaises(CircuitOpenError, backend.add_service,
+                          "sync-1.0", "{node}/1.0/{uid}")
+        stats = backend.get_breaker_stats()
+        self.assertEqual(len(stats), 1)
+        stats = stats.values()[0]
+        self.assertEqual(stats["state"], "open")
+        self.assertEqual(stats["failures"], 2)
+        self.assertEqual(stats["rejected"], 1)
+        self.assertEqual(stats["inflight"], 0)
+
+    def test_overload_does_not_swallow_the_trial_call(self):
+        backend = SQLMetadata("sqlite:////nonexistent/wimms.db",
+                              breaker_failure_rate=0.5, breaker_min_calls=2,
+                              breaker_reset_timeout=0.05, max_inflight=1)
+        for _ in range(2):
+            self.assertRaises(BackendError, backend.add_service,
+                              "sync-1.0", "{node}/1.0/{uid}")
+        time.sleep(0.05)
+        # The limiter turns away the call that would have been the trial.
+        breaker, limiter = backend._get_guards(backend._get_engine())
+        limiter.acquire()
+        self.assertRaises(OverloadedError, backend.add_service,
+                          "sync-1.0", "{node}/1.0/{uid}")
+        limiter.release()
+        # So the next call still gets to try the database.
+        with self.assertRaises(BackendError) as cm:
+            backend.add_service("sync-1.0", "{node}/1.0/{uid}")
+        self.assertFalse(isinstance(cm.exception, CircuitOpenError))
+        stats = backend.get_breaker_stats().values()[0]
+        self.assertEqual(stats["state"], "open")
+        self.assertEqual(stats["trips"], 2)
+        self.assertEqual(stats["inflight"], 0)
+
+
+class TestUsersPartitioningDDL(TestCase):
+
+    def test_partitioning_ddl(self):
+        self.assertEqual(partition_users_ddl([3, 1]),
+                         "ALTER TABLE users PARTITION BY LIST (service) "
+                         "(PARTITION p1 VALUES IN (1), "
+                         "PARTITION p3 VALUES IN (3))")
+        self.assertEqual(add_users_partition_ddl(4),
+                         "ALTER TABLE users ADD PARTITION "
+                         "(PARTITION p4 VALUES IN (4))")
+        self.assertEqual(truncate_users_partition_ddl(4),
+                         "ALTER TABLE users TRUNCATE PARTITION p4")
+
+    def test_partitioned_users_table_includes_service_in_primary_key(self):
+        users = get_cls('partitioned_users', declarative_base(), 'users')
+        self.assertEqual(users.name, 'users')
+        self.assertEqual([col.name for col in users.primary_key.columns],
+                         ['uid', 'service'])
+
+    def test_partitioned_users_table_has_its_own_metadata(self):
+        plain = get_cls('users', _Base)
+        partitioned = get_cls('partitioned_users', _PartitionedBase, 'users')
+        self.assertEqual([col.name for col in plain.primary_key.columns],
+                         ['uid'])
+        self.assertEqual([col.name for col in partitioned.primary_key.columns],
+                         ['uid', 'service'])
+
 
 if os.environ.get('WIMMS_MYSQLURI', None) is not None:
     class TestMySQLDB(TestSQLDB):
         _SQLURI = os.environ.get('WIMMS_MYSQLURI')
+
+    class TestPartitionedMySQLDB(TestMySQLDB):
+
+        def setUp(self):
+            self.backend = SQLMetadata(self._SQLURI, create_tables=True,
+                                       partition_users=True)
+            super(TestSQLDB, self).setUp()